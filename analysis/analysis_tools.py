@@ -8,6 +8,13 @@ import glob
 import datetime
 import json
 import re
+import warnings
+import time
+import itertools
+import threading
+import tracemalloc
+import collections
+import concurrent.futures
 from pathlib import Path
 import numpy as np
 import scipy.optimize
@@ -19,16 +26,32 @@ import pandas as pd
 # import tiffile # todo: can I get rid of this in favor of tifffile?
 import tifffile
 
+# optional FFT backend
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
 import fit
 
 # I/O for metadata and image files
-def parse_mm_metadata(metadata_dir, file_pattern="*metadata*.txt"):
+# name of the file storing parsed metadata, which is written in the directory passed to parse_mm_metadata()
+metadata_cache_fname = "mm_metadata_index.npz"
+
+def parse_mm_metadata(metadata_dir, file_pattern="*metadata*.txt", use_cache=True):
     """
     Parse all micromanager metadata files in subdirectories of metadata_dir. MM metadata is stored as JSON
     object in text file.
 
+    Parsing the metadata of large acquisitions is slow, so the result is stored in metadata_dir in the file
+    metadata_cache_fname, and loaded from there by later calls. The cache is ignored, and rewritten, if the names,
+    sizes or modification times of the metadata files have changed.
+
     :param str metadata_dir: directory storing metadata files
     :param str file_pattern: file pattern which metadata files must match
+    :param bool use_cache: if True, load parsed metadata from the cache if it is up to date, and otherwise try to
+    write it
 
     :return: df_images: dataframe object summarizing images described in metadata file
     :return: dims:
@@ -45,6 +68,13 @@ def parse_mm_metadata(metadata_dir, file_pattern="*metadata*.txt"):
     if metadata_paths == []:
         raise FileExistsError("No metadata files matching pattern '%s' found." % file_pattern)
 
+    cache_fname = os.path.join(metadata_dir, metadata_cache_fname)
+    if use_cache:
+        signature = _get_metadata_signature(metadata_dir, metadata_paths, file_pattern)
+        cached = _load_metadata_cache(cache_fname, metadata_dir, signature)
+        if cached is not None:
+            return cached
+
     # open first metadata and get roi_size few important pieces of information
     with open(metadata_paths[0], 'r') as f:
         datastore = json.load(f)
@@ -150,9 +180,144 @@ def parse_mm_metadata(metadata_dir, file_pattern="*metadata*.txt"):
 
     image_metadata['ImageIndexInFile'] = image_pos_in_file
 
+    if use_cache:
+        _save_metadata_cache(cache_fname, metadata_dir, signature, image_metadata, dims, summary)
+
     return image_metadata, dims, summary
 
-def read_dataset(md, time_indices=None, channel_indices=None, z_indices=None, xy_indices=None, user_indices={}, dtype=np.uint16):
+def _get_metadata_signature(metadata_dir, metadata_paths, file_pattern):
+    """
+    String identifying the metadata files, which changes if any file is added, removed, or modified
+    """
+    files = []
+    for p in metadata_paths:
+        stat = os.stat(p)
+        files.append([os.path.relpath(p, metadata_dir), stat.st_mtime_ns, stat.st_size])
+
+    return json.dumps({"file_pattern": file_pattern, "files": files})
+
+def _save_metadata_cache(fname, metadata_dir, signature, image_metadata, dims, summary):
+    """
+    Store parsed metadata as one array per column. Numeric columns keep their type, string columns are stored as
+    unicode arrays, and anything else is stored as JSON strings, so the cache can be loaded without pickle.
+    Directories are stored relative to metadata_dir, so the cache remains valid if the data is moved.
+    """
+    # write to a temporary file first, so an interrupted write cannot leave a corrupted cache
+    fname_temp = fname + ".tmp"
+    try:
+        columns = {}
+        kinds = []
+        for ii, c in enumerate(image_metadata.columns):
+            if c == "directory":
+                arr = np.array([os.path.relpath(d, metadata_dir) for d in image_metadata[c]], dtype=str)
+                kind = "directory"
+            else:
+                arr = image_metadata[c].to_numpy()
+                kind = "array"
+                if arr.dtype == object:
+                    if all(isinstance(v, str) for v in arr):
+                        arr = arr.astype(str)
+                    else:
+                        arr = np.array([json.dumps(v) for v in arr], dtype=str)
+                        kind = "json"
+
+            columns["column_%d" % ii] = arr
+            kinds.append(kind)
+
+        header = {"signature": signature, "columns": list(image_metadata.columns), "kinds": kinds,
+                  "dims": dims, "summary": summary}
+
+        with open(fname_temp, "wb") as f:
+            np.savez(f, header=np.array(json.dumps(header)), **columns)
+        os.replace(fname_temp, fname)
+    except (OSError, TypeError, ValueError) as e:
+        # e.g. data directory is read-only, or metadata contains values which cannot be stored as JSON. The cache
+        # only avoids parsing the metadata again, so continue without it
+        warnings.warn("could not write metadata cache '%s': %s" % (fname, e))
+        if os.path.exists(fname_temp):
+            try:
+                os.remove(fname_temp)
+            except OSError:
+                pass
+
+def _load_metadata_cache(fname, metadata_dir, signature):
+    """
+    Load metadata stored by _save_metadata_cache(). Return None if there is no cache, or if it is out of date
+    """
+    if not os.path.exists(fname):
+        return None
+
+    try:
+        with np.load(fname, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+            if header["signature"] != signature:
+                return None
+
+            columns = {}
+            for ii, (c, kind) in enumerate(zip(header["columns"], header["kinds"])):
+                arr = data["column_%d" % ii]
+                if kind in ["directory", "json"]:
+                    # decode each distinct value once
+                    vals, inverse = np.unique(arr, return_inverse=True)
+                    if kind == "directory":
+                        vals = [str(Path(metadata_dir, d)) for d in vals]
+                    else:
+                        vals = [json.loads(v) for v in vals]
+                    arr = [vals[jj] for jj in inverse]
+                elif arr.dtype.kind == "U":
+                    arr = arr.astype(object)
+                columns[c] = arr
+    except (OSError, ValueError, KeyError) as e:
+        warnings.warn("could not read metadata cache '%s': %s" % (fname, e))
+        return None
+
+    return pd.DataFrame(columns), header["dims"], header["summary"]
+
+class MetadataIndex:
+    def __init__(self, md, keys=("FrameIndex", "ChannelIndex", "SliceIndex", "PositionIndex")):
+        """
+        Index of the rows of a metadata table by the values of several columns, so images with given indices can be
+        found without scanning the whole table
+
+        :param md: metadata Pandas datable, as created by parse_mm_metadata()
+        :param keys: columns to index, e.g. ("FrameIndex", "ChannelIndex", "SliceIndex", "PositionIndex",
+        "UserSimIndex")
+        """
+        self.md = md
+        self.keys = list(keys)
+
+        # {(value of key 0, value of key 1, ...): row numbers}
+        groups = md.groupby(self.keys, sort=False).indices
+        self.groups = {(k if isinstance(k, tuple) else (k,)): v for k, v in groups.items()}
+        self.values = {k: np.unique(md[k]) for k in self.keys}
+
+    def lookup(self, **indices):
+        """
+        Find rows with the given values
+
+        :param indices: {column name: value or list of values}. Columns which are not provided, or are None, may
+        have any value. Columns which are not indexed are filtered by scanning the rows found for the indexed columns
+        :return rows: row numbers in increasing order
+        """
+        values = []
+        for k in self.keys:
+            v = indices.get(k)
+            values.append(self.values[k] if v is None else np.atleast_1d(v))
+
+        rows = [self.groups[v] for v in itertools.product(*values) if v in self.groups]
+        if rows:
+            rows = np.sort(np.concatenate(rows))
+        else:
+            rows = np.zeros(0, dtype=int)
+
+        for k, v in indices.items():
+            if k not in self.keys and v is not None:
+                rows = rows[np.isin(self.md[k].values[rows], np.atleast_1d(v))]
+
+        return rows
+
+def read_dataset(md, time_indices=None, channel_indices=None, z_indices=None, xy_indices=None, user_indices={},
+                 dtype=np.uint16, index=None):
     """
     Load a set of images from MicroManager metadata, read using parse_mm_metadata()
 
@@ -162,48 +327,28 @@ def read_dataset(md, time_indices=None, channel_indices=None, z_indices=None, xy
     :param z_indices:
     :param xy_indices:
     :param user_indices: {"name": indices}
-    :param file_pattern:
+    :param index: MetadataIndex of md. When reading many sets of images, create this once and pass it here, to
+    avoid scanning the full table for each set. If None, the table is scanned.
     :return:
     """
 
     # md, dims, summary = parse_mm_metadata(dir)
 
-    def check_array(arr, ls):
-        to_use = np.zeros(arr.shape, dtype=np.bool)
-        for l in ls:
-            to_use = np.logical_or(to_use, arr == l)
-
-        return to_use
-
-    to_use = np.ones(md.shape[0], dtype=np.bool)
-
-    if time_indices is not None:
-        if not isinstance(time_indices, list):
-            time_indices = [time_indices]
-        to_use = np.logical_and(to_use, check_array(md["FrameIndex"], time_indices))
+    indices = {"FrameIndex": time_indices, "PositionIndex": xy_indices, "SliceIndex": z_indices,
+               "ChannelIndex": channel_indices}
+    indices.update(user_indices)
 
-    if xy_indices is not None:
-        if not isinstance(xy_indices, list):
-            xy_indices = [xy_indices]
-        to_use = np.logical_and(to_use, check_array(md["PositionIndex"], xy_indices))
-
-    if z_indices is not None:
-        if not isinstance(z_indices, list):
-            z_indices = [z_indices]
-        to_use = np.logical_and(to_use, check_array(md["SliceIndex"], z_indices))
-
-    if channel_indices is not None:
-        if not isinstance(channel_indices, list):
-            channel_indices = [channel_indices]
-        to_use = np.logical_and(to_use, check_array(md["ChannelIndex"], channel_indices))
-
-    for k, v in user_indices.items():
-        if not isinstance(v, list):
-            v = [v]
-        to_use = np.logical_and(to_use, check_array(md[k], v))
-
-    fnames = [os.path.join(d, p) for d, p in zip(md["directory"][to_use], md["FileName"][to_use])]
-    slices = md["ImageIndexInFile"][to_use]
+    if index is not None:
+        rows = index.lookup(**indices)
+    else:
+        to_use = np.ones(md.shape[0], dtype=bool)
+        for k, v in indices.items():
+            if v is not None:
+                to_use = np.logical_and(to_use, np.isin(md[k].values, np.atleast_1d(v)))
+        rows = np.flatnonzero(to_use)
+
+    fnames = [os.path.join(d, p) for d, p in zip(md["directory"].values[rows], md["FileName"].values[rows])]
+    slices = md["ImageIndexInFile"].values[rows]
     imgs = read_multi_tiff(fnames, slices)
 
     return imgs
@@ -260,44 +405,258 @@ def read_tiff(fname, slices=None, offset=None, skip=None):
 
     return imgs, tiff_metadata
 
-def read_multi_tiff(fnames, slice_indices):
+# open TIFF files, kept so that reading more images from the same file does not require parsing it again
+tiff_file_cache_size = 16
+_tiff_file_cache = collections.OrderedDict()
+_tiff_file_cache_lock = threading.Lock()
+
+class _CachedTiffFile:
+    def __init__(self, fname, stat):
+        self.fname = fname
+        self.stat = stat
+        # memory map of the whole file, created the first time an uncompressed page is read
+        self.memmap = None
+        # TiffFile seeks in a shared file handle, so must only be used from one thread at a time
+        self.lock = threading.Lock()
+        self.tif = None
+        self._open()
+
+    def _open(self):
+        """
+        Open the file. Must be called with lock held, except from __init__. Entries may be closed by the cache while
+        another thread still holds them, so they are opened again on use
+        """
+        self.tif = tifffile.TiffFile(self.fname)
+        # keep parsed pages, so their offsets do not need to be found again
+        self.tif.pages.cache = True
+
+    def get_page(self, index):
+        """
+        Return a read-only view of the data of page index, or None if it cannot be memory mapped, e.g. because it is
+        compressed. Then it must be read using read_page()
+        """
+        with self.lock:
+            if self.tif is None:
+                self._open()
+
+            page = self.tif.pages[int(index)]
+            if not page.is_memmappable:
+                return None
+
+            if self.memmap is None:
+                self.memmap = np.memmap(self.fname, dtype=np.uint8, mode="r")
+
+            offset, _ = page.is_contiguous
+            dtype = np.dtype(self.tif.byteorder + page.dtype.char)
+            nbytes = int(np.prod(page.shape)) * dtype.itemsize
+
+        return self.memmap[offset:offset + nbytes].view(dtype).reshape(page.shape)
+
+    def read_page(self, index, out=None):
+        with self.lock:
+            if self.tif is None:
+                self._open()
+
+            return self.tif.pages[int(index)].asarray(out=out)
+
+    def close(self):
+        """
+        Close the file. Views returned by get_page() remain valid, since they keep their own reference to the memory
+        map
+        """
+        with self.lock:
+            self.memmap = None
+            if self.tif is not None:
+                self.tif.close()
+                self.tif = None
+
+def _get_tiff_file(fname):
+    """
+    Get open TIFF file from the cache, opening it if it is not there. Files which have been modified since they were
+    opened are opened again
+    """
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    stat = (stat.st_mtime_ns, stat.st_size)
+
+    with _tiff_file_cache_lock:
+        entry = _tiff_file_cache.get(fname)
+        if entry is not None and entry.stat == stat:
+            _tiff_file_cache.move_to_end(fname)
+            return entry
+
+    entry_new = _CachedTiffFile(fname, stat)
+
+    with _tiff_file_cache_lock:
+        entry = _tiff_file_cache.pop(fname, None)
+        _tiff_file_cache[fname] = entry_new
+
+        # close least recently used files
+        closed = [] if entry is None else [entry]
+        while len(_tiff_file_cache) > tiff_file_cache_size:
+            closed.append(_tiff_file_cache.popitem(last=False)[1])
+
+    for e in closed:
+        e.close()
+
+    return entry_new
+
+def clear_tiff_file_cache():
+    """
+    Close all TIFF files opened by read_multi_tiff() or read_tiff_frame()
+    """
+    with _tiff_file_cache_lock:
+        entries = list(_tiff_file_cache.values())
+        _tiff_file_cache.clear()
+
+    for e in entries:
+        e.close()
+
+def read_tiff_frame(fname, index):
+    """
+    Read a single image from a TIFF file. Open files are kept in a cache, so reading many images from the same file
+    only parses the file once.
+
+    :param fname: path to file
+    :param index: index of image in file
+    :return img: if the image is stored uncompressed, this is a read-only view of a memory map of the file, so no
+    data is read until it is accessed. Otherwise it is a new array.
+    """
+    tif = _get_tiff_file(fname)
+    img = tif.get_page(index)
+    if img is None:
+        img = tif.read_page(index)
+
+    return img
+
+def read_multi_tiff(fnames, slice_indices, out=None):
     """
     Load multiple images and slices, defined by lists fnames and slice_indices,
-    and return in same order as inputs. Automatically load all images from each file without multiple reads.
+    and return in same order as inputs. Open files are kept in a cache, so repeated calls do not parse the same file
+    again, and uncompressed images are copied directly from a memory map of the file to the output array.
 
     # todo: right now only supports tifs, but in general could support other image types
     # todo: should also return metadata
 
     :param fnames:
     :param slice_indices:
+    :param out: array of size len(fnames) x ny x nx to store images in. If None, a new array is created
 
     :return imgs:
     """
-    # counter for files
-    inds = np.arange(len(fnames))
-    slice_indices = np.array(slice_indices)
-    # only want to load each tif once, in case roi_size single tif has multiple images
-    fnames_unique = list(set(fnames))
-    fnames_unique.sort()
-
+    slice_indices = np.asarray(slice_indices)
     # Tells us which unique filename the slice_indices correspond to
-    inds_to_unique = np.array([i for fn in fnames for i, fnu in enumerate(fnames_unique) if fn == fnu])
+    fnames_unique, inds_to_unique = np.unique(np.asarray(fnames, dtype=str), return_inverse=True)
 
-    # load tif files, store results in roi_size list
-    imgs = [''] * len(fnames)
     for ii, fu in enumerate(fnames_unique):
-        slices = slice_indices[inds_to_unique == ii]
-        imgs_curr, _ = read_tiff(fu, slices)
+        tif = _get_tiff_file(fu)
 
         # this is necessary in case e.g. one file has images [1,3,7] and another has [2,6,10]
-        for jj, ind in enumerate(inds[inds_to_unique == ii]):
-            imgs[ind] = imgs_curr[jj, :, :]
-
-    # if any([isinstance(im, str) for im in imgs]):
-    #     raise ValueError()
-    imgs = np.asarray(imgs)
-
-    return imgs
+        for ind in np.flatnonzero(inds_to_unique == ii):
+            img = tif.get_page(slice_indices[ind])
+
+            if out is None:
+                if img is None:
+                    img = tif.read_page(slice_indices[ind])
+                out = np.zeros((len(fnames),) + img.shape, dtype=img.dtype.newbyteorder("="))
+
+            if img is None:
+                tif.read_page(slice_indices[ind], out=out[ind])
+            else:
+                out[ind] = img
+
+    if out is None:
+        out = np.zeros(0)
+
+    return out
+
+class Prefetcher:
+    def __init__(self, load_fn, args, n_ahead=2, n_workers=1):
+        """
+        Iterate over the results of load_fn(*a) for a in args, loading the next items in background threads while
+        the current item is processed. This is useful when load_fn is limited by reading files, which releases the GIL.
+
+        Items are returned in the order of args. Exceptions raised by load_fn are raised when the item is reached.
+
+        :param load_fn: function loading one item
+        :param args: list of argument tuples for load_fn, in the order the items are needed
+        :param n_ahead: maximum number of items loaded ahead of the item being processed. Each item is held in memory
+        until it is returned
+        :param n_workers: number of threads used for loading
+        """
+        if n_ahead < 1:
+            raise ValueError("n_ahead must be at least 1, but was %d" % n_ahead)
+
+        self.load_fn = load_fn
+        self.args = list(args)
+        self.n_ahead = n_ahead
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+        self._futures = collections.deque()
+        self._next_submit = 0
+        self._lock = threading.Lock()
+
+        # time spent waiting for items which were not loaded yet, and time spent loading items
+        self.wait_time = 0.
+        self.load_time = 0.
+        self.nreturned = 0
+
+        self._submit()
+
+    def _load(self, a):
+        tstart = time.perf_counter()
+        result = self.load_fn(*a)
+        with self._lock:
+            self.load_time += time.perf_counter() - tstart
+
+        return result
+
+    def _submit(self):
+        while len(self._futures) < self.n_ahead and self._next_submit < len(self.args):
+            self._futures.append(self._executor.submit(self._load, self.args[self._next_submit]))
+            self._next_submit += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._futures:
+            raise StopIteration
+
+        tstart = time.perf_counter()
+        result = self._futures.popleft().result()
+        self.wait_time += time.perf_counter() - tstart
+        self.nreturned += 1
+
+        self._submit()
+
+        return result
+
+    def __len__(self):
+        return len(self.args)
+
+    def get_stats(self):
+        """
+        :return stats: {'items', 'wait_time_s', 'load_time_s'}. If wait_time_s is a large fraction of the total
+        processing time, processing is limited by loading
+        """
+        return {"items": self.nreturned, "wait_time_s": self.wait_time, "load_time_s": self.load_time}
+
+    def close(self):
+        """
+        Cancel loading items which have not started, and wait for items being loaded
+        """
+        for f in self._futures:
+            f.cancel()
+        self._futures.clear()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
 def save_tiff(img, save_fname, dtype='uint16', tif_metadata=None, other_metadata=None,
               axes_order='ZYX', hyperstack=False, **kwargs):
@@ -324,6 +683,37 @@ def save_tiff(img, save_fname, dtype='uint16', tif_metadata=None, other_metadata
 
     tifffile.imwrite(save_fname, img.astype(dtype), dtype=dtype, imagej=True, **kwargs)
 
+def save_tiff_memmap(save_fname, shape, dtype='float32', axes_order='ZYX', **kwargs):
+    """
+    Create an ImageJ hyperstack tiff file and return a memory map of its data. This allows large stacks to be
+    written one image at a time, without holding the full stack in memory. Data is written to disk when the memory
+    map is flushed or deleted.
+
+    :param save_fname: path to save file
+    :param shape: shape of the stack, with axes in the order given by axes_order
+    :param dtype: data type to save tif as
+    :param axes_order: a string consisting of some of the characters TZCYX. Must end with 'YX'
+    :param kwargs: passed through to tifffile.memmap()
+    :return stack: memory map of the data, with axes in the order given by axes_order
+    """
+    if len(shape) != len(axes_order):
+        raise ValueError("shape has %d dimensions, but axes_order has %d" % (len(shape), len(axes_order)))
+
+    # ImageJ hyperstacks are stored in TZCYX order
+    axes_hyperstack = 'TZCYX'
+    if not all([a in axes_hyperstack for a in axes_order]) or axes_order[-2:] != 'YX':
+        raise ValueError("axes_order must consist of characters from 'TZCYX' and end with 'YX', but was '%s'" % axes_order)
+
+    shape_hyperstack = tuple([shape[axes_order.index(a)] if a in axes_order else 1 for a in axes_hyperstack])
+    stack = tifffile.memmap(save_fname, shape=shape_hyperstack, dtype=dtype, imagej=True, **kwargs)
+
+    # remove axes which are not in axes_order and put the remaining ones in the requested order
+    axes_present = [a for a in axes_hyperstack if a in axes_order]
+    stack = stack.reshape(tuple([shape[axes_order.index(a)] for a in axes_present]))
+    stack = np.transpose(stack, [axes_present.index(a) for a in axes_order])
+
+    return stack
+
 def parse_imagej_tiff_tag(tag):
     """
     Parse information from the TIFF "ImageDescription" tag saved by ImageJ. This tag has the form
@@ -897,14 +1287,15 @@ def expand_im(img, mx=2, my=2):
 
     :return img_resampled:
     """
-    img_resampled = fft.ifft2(expand_fourier_sp(fft.fft2(img), mx=mx, my=my, centered=False))
+    img_resampled = ift2(expand_fourier_sp(ft2(img, centered=False), mx=mx, my=my, centered=False), centered=False)
     return img_resampled
 
 def expand_fourier_sp(img_ft, mx=2, my=2, centered=True):
     """
     Expand image by factors of mx and my while keeping Fourier content constant.
 
-    :param img_ft: frequency space representation of image
+    :param img_ft: frequency space representation of image. If this has more than two dimensions, expand each image
+    along the last two axes
     :param mx: factor to resample image along the x-direction
     :param my: factor to resample image along the y-direction
     :param centered: if True assume img_ft has undergone an fftshift so that zero-frequency components are in the center
@@ -915,7 +1306,7 @@ def expand_fourier_sp(img_ft, mx=2, my=2, centered=True):
     if mx == 1 and my == 1:
         return img_ft
 
-    ny, nx = img_ft.shape
+    ny, nx = img_ft.shape[-2:]
     fx_old = get_fft_frqs(nx)
     fy_old = get_fft_frqs(ny)
 
@@ -923,39 +1314,39 @@ def expand_fourier_sp(img_ft, mx=2, my=2, centered=True):
     fy_new = get_fft_frqs(ny * my, dt=0.5)
 
     if not centered:
-        img_ft = fft.fftshift(img_ft)
+        img_ft = fft.fftshift(img_ft, axes=(-2, -1))
 
     ix_start = np.where(fx_new == fx_old[0])[0][0]
     iy_start = np.where(fy_new == fy_old[0])[0][0]
 
-    img_ft_exp = np.zeros((ny * my, nx * mx), dtype=np.complex)
-    img_ft_exp[iy_start : iy_start + ny, ix_start:ix_start + nx] = img_ft
+    img_ft_exp = np.zeros(img_ft.shape[:-2] + (ny * my, nx * mx), dtype=np.result_type(img_ft.dtype, np.complex64))
+    img_ft_exp[..., iy_start : iy_start + ny, ix_start:ix_start + nx] = img_ft
 
     # todo: if even array has one extra negative frequency. Now I've added its positive freq
     # partner, so shouldn't I have to put complex conjugate of that value in partner spot?
     # yes, and divide by 2!
     if np.mod(nx, 2) == 0:
         ix_ops = np.where(fx_new == -fx_old[0])[0][0]
-        img_ft_exp[:, ix_start] = 0.5 * img_ft_exp[:, ix_start]
-        img_ft_exp[:, ix_ops] = img_ft_exp[:, ix_start]
+        img_ft_exp[..., :, ix_start] = 0.5 * img_ft_exp[..., :, ix_start]
+        img_ft_exp[..., :, ix_ops] = img_ft_exp[..., :, ix_start]
 
     if np.mod(ny, 2) == 0:
         iy_ops = np.where(fy_new == - fy_old[0])[0][0]
-        img_ft_exp[iy_start, :] = 0.5 * img_ft_exp[iy_start, :]
-        img_ft_exp[iy_ops, :] = img_ft_exp[iy_start, :]
+        img_ft_exp[..., iy_start, :] = 0.5 * img_ft_exp[..., iy_start, :]
+        img_ft_exp[..., iy_ops, :] = img_ft_exp[..., iy_start, :]
 
     # but will have double corrected for [iy_start, ix_start], [iy_start, ix_ops], [iy_ops, ix_start], and [iy_ops, ix_ops]
     if np.mod(ny, 2) == 0 and np.mod(nx, 2) == 0:
-        img_ft_exp[iy_start, ix_start] = 2 * img_ft_exp[iy_start, ix_start]
-        img_ft_exp[iy_start, ix_ops] = 2 * img_ft_exp[iy_start, ix_ops]
-        img_ft_exp[iy_ops, ix_start] = 2 * img_ft_exp[iy_ops, ix_start]
-        img_ft_exp[iy_ops, ix_ops] = 2 * img_ft_exp[iy_ops, ix_ops]
+        img_ft_exp[..., iy_start, ix_start] = 2 * img_ft_exp[..., iy_start, ix_start]
+        img_ft_exp[..., iy_start, ix_ops] = 2 * img_ft_exp[..., iy_start, ix_ops]
+        img_ft_exp[..., iy_ops, ix_start] = 2 * img_ft_exp[..., iy_ops, ix_start]
+        img_ft_exp[..., iy_ops, ix_ops] = 2 * img_ft_exp[..., iy_ops, ix_ops]
 
     # correct normalization
-    img_ft_exp = mx * my * img_ft_exp
+    img_ft_exp *= mx * my
 
     if not centered:
-        img_ft_exp = fft.ifftshift(img_ft_exp)
+        img_ft_exp = fft.ifftshift(img_ft_exp, axes=(-2, -1))
 
     return img_ft_exp
 
@@ -1220,7 +1611,410 @@ def map_intervals(vals, from_intervals, to_intervals):
 
     return vals_out
 
+# profiling
+# spans currently open in each thread. FFT's computed by ft2() and related functions are counted in all open spans
+_profile_state = threading.local()
+
+class Profiler:
+    def __init__(self, fname=None, trace_memory=False, **fields):
+        """
+        Collect machine readable records of the time spent in named spans of code. Spans are opened with
+        span(), and may be nested. Each record contains the wall time, the CPU time of this process, the number of
+        2D FFT's computed with ft2(), ift2(), rft2() or irft2(), and optionally the memory allocated.
+
+        CPU time is measured with time.process_time(), so includes all threads of this process but not work done in
+        other processes, e.g. by joblib workers.
+
+        :param fname: if not None, each record is appended to this file as one line of JSON as soon as its span ends
+        :param trace_memory: if True, record the bytes allocated during each span using tracemalloc, which is started
+        if it is not already running. This slows down code which allocates many small objects.
+        :param fields: added to every record, e.g. to identify the image being processed
+        """
+        self.fname = fname
+        self.trace_memory = trace_memory
+        self.fields = fields
+        self.records = []
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self._file = None
+        self._lock = threading.Lock()
+
+    def span(self, name, **fields):
+        """
+        Context manager recording the time spent in a block of code
+
+        :param name: name of this span. Records also contain the names of the enclosing spans of this profiler,
+        as a path "outer/inner"
+        :param fields: added to the record of this span
+        :return span: ProfileSpan. After the block ends, its record is available as span.record
+        """
+        return ProfileSpan(self, name, fields)
+
+    def add_record(self, record):
+        with self._lock:
+            self.records.append(record)
+
+            if self.fname is not None:
+                if self._file is None:
+                    self._file = open(self.fname, "a")
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+    def summary(self):
+        """
+        Aggregate records by span path, see summarize_profile()
+        """
+        return summarize_profile(self.records)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __getstate__(self):
+        # file handles and locks cannot be pickled, e.g. when passing a profiler to another process
+        state = dict(self.__dict__)
+        state["_file"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+class ProfileSpan:
+    def __init__(self, profiler, name, fields):
+        self.profiler = profiler
+        self.name = name
+        self.fields = fields
+        self.record = None
+        self.ffts = 0
+
+    def __enter__(self):
+        if not hasattr(_profile_state, "spans"):
+            _profile_state.spans = []
+        spans = _profile_state.spans
+
+        self.parent = None
+        for s in reversed(spans):
+            if s.profiler is self.profiler:
+                self.parent = s
+                break
+
+        self.path = self.name if self.parent is None else "%s/%s" % (self.parent.path, self.name)
+
+        if self.profiler.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # remember the peak of the enclosing spans before it is reset
+            for s in spans:
+                if s.mem_start is not None:
+                    s.mem_peak = max(s.mem_peak, peak)
+            self.mem_start = current
+            self.mem_peak = current
+            tracemalloc.reset_peak()
+        else:
+            self.mem_start = None
+
+        spans.append(self)
+        self.start_time = time.time()
+        self.tstart = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.perf_counter() - self.tstart
+        cpu_time = time.process_time() - self.cpu_start
+        _profile_state.spans.remove(self)
+
+        self.record = dict(self.profiler.fields)
+        self.record.update({"name": self.name, "path": self.path, "start_time": self.start_time,
+                            "wall_time_s": wall_time, "cpu_time_s": cpu_time, "ffts": self.ffts,
+                            "bytes_allocated": None, "peak_bytes": None})
+
+        if self.mem_start is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.mem_peak = max(self.mem_peak, peak)
+            self.record.update({"bytes_allocated": current - self.mem_start, "peak_bytes": self.mem_peak - self.mem_start})
+
+            for s in _profile_state.spans:
+                if s.mem_start is not None:
+                    s.mem_peak = max(s.mem_peak, self.mem_peak)
+
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+
+        self.record.update(self.fields)
+        self.profiler.add_record(self.record)
+
+        return False
+
+    @property
+    def wall_time(self):
+        return self.record["wall_time_s"]
+
+def _count_ffts(shape, axes):
+    """
+    Add the number of 2D FFT's computed along axes of an array with this shape to all open profiling spans
+    """
+    spans = getattr(_profile_state, "spans", None)
+    if not spans:
+        return
+
+    axes = np.mod(axes, len(shape))
+    nffts = int(np.prod([n for ii, n in enumerate(shape) if ii not in axes]))
+    for s in spans:
+        s.ffts += nffts
+
+def summarize_profile(records):
+    """
+    Aggregate profiling records by span path
+
+    :param records: list of records produced by Profiler
+    :return summary: dictionary {path: {"count", "wall_time_s", "mean_wall_time_s", "min_wall_time_s",
+    "max_wall_time_s", "cpu_time_s", "ffts", "max_peak_bytes"}}. Times and FFT counts are totals over all records
+    """
+    summary = {}
+    for r in records:
+        s = summary.setdefault(r["path"], {"count": 0, "wall_time_s": 0., "min_wall_time_s": np.inf,
+                                           "max_wall_time_s": 0., "cpu_time_s": 0., "ffts": 0,
+                                           "max_peak_bytes": None})
+        s["count"] += 1
+        s["wall_time_s"] += r["wall_time_s"]
+        s["min_wall_time_s"] = min(s["min_wall_time_s"], r["wall_time_s"])
+        s["max_wall_time_s"] = max(s["max_wall_time_s"], r["wall_time_s"])
+        s["cpu_time_s"] += r["cpu_time_s"]
+        s["ffts"] += r["ffts"]
+        if r.get("peak_bytes") is not None:
+            s["max_peak_bytes"] = max(s["max_peak_bytes"] or 0, r["peak_bytes"])
+
+    for s in summary.values():
+        s["mean_wall_time_s"] = s["wall_time_s"] / s["count"]
+
+    return summary
+
 # fft tools
+# FFT service. All FFT's in the SIM and OTF code go through ft2() and ift2(), so the backend and number of threads
+# can be selected in one place using set_fft_backend()
+_fft_settings = {'backend': 'scipy', 'workers': None, 'planner_effort': 'FFTW_MEASURE'}
+_fftw_plans = {}
+_fftw_lock = threading.Lock()
+
+def set_fft_backend(backend="scipy", workers=None, planner_effort="FFTW_MEASURE"):
+    """
+    Select the library used to compute FFT's by ft2() and ift2()
+
+    :param str backend: "scipy" or "pyfftw". pyfftw must be installed to use "pyfftw"
+    :param int workers: number of threads used per FFT. If None, use the backend default (one thread). If -1,
+    use all cores
+    :param str planner_effort: FFTW planner effort, e.g. "FFTW_ESTIMATE" or "FFTW_MEASURE". Plans are computed once
+    for each array shape and data type and then reused. Only used with the pyfftw backend.
+    :return:
+    """
+    if backend not in ["scipy", "pyfftw"]:
+        raise ValueError("backend must be 'scipy' or 'pyfftw', but was '%s'" % backend)
+
+    if backend == "pyfftw" and pyfftw is None:
+        raise ValueError("backend 'pyfftw' was selected, but pyfftw is not installed")
+
+    _fft_settings.update({'backend': backend, 'workers': workers, 'planner_effort': planner_effort})
+    with _fftw_lock:
+        _fftw_plans.clear()
+
+def get_fft_backend():
+    """
+    Get the current FFT settings
+
+    :return settings: {'backend', 'workers', 'planner_effort'}
+    """
+    return dict(_fft_settings)
+
+def _fftw_execute(kind, m, axes, s=None):
+    """
+    Compute an FFT using a cached FFTW plan for this array shape, data type, and axes
+
+    :param kind: "fftn", "ifftn", "rfftn" or "irfftn"
+    :param m: array
+    :param axes: axes to transform along
+    :param s: shape of the output along axes. Only needed for "irfftn"
+    :return m_ft:
+    """
+    workers = _fft_settings['workers']
+    if workers is None:
+        workers = 1
+    elif workers < 0:
+        workers = os.cpu_count()
+
+    key = (kind, m.shape, m.dtype.str, axes, s)
+    with _fftw_lock:
+        if key not in _fftw_plans:
+            builder = getattr(pyfftw.builders, kind)
+            _fftw_plans[key] = builder(pyfftw.empty_aligned(m.shape, dtype=m.dtype), s=s, axes=axes, threads=workers,
+                                       planner_effort=_fft_settings['planner_effort'], avoid_copy=False)
+
+        # plan output array is reused between calls, so must copy
+        return _fftw_plans[key](m).copy()
+
+def _expand_hermitian(m_rft, nx):
+    """
+    Get the full FFT along the last two axes of a real array from its real-to-complex FFT, which contains only the
+    non-negative frequencies along the last axis, using m_ft(-f) = m_ft(f).conj()
+
+    :param m_rft: real-to-complex FFT, of size ... x ny x (nx // 2 + 1). Frequencies are not centered
+    :param nx: size of the last axis of the real array
+    :return m_ft: ... x ny x nx
+    """
+    ny, nx_half = m_rft.shape[-2:]
+
+    m_ft = np.zeros(m_rft.shape[:-1] + (nx,), dtype=m_rft.dtype)
+    m_ft[..., :nx_half] = m_rft
+
+    ky_neg = np.mod(-np.arange(ny), ny)
+    kx_neg = nx - np.arange(nx_half, nx)
+    m_ft[..., nx_half:] = m_rft[..., ky_neg, :][..., kx_neg].conj()
+
+    return m_ft
+
+def ft2(m, centered=True, axes=(-2, -1)):
+    """
+    2D Fourier transform using the backend selected by set_fft_backend()
+
+    :param m: array to transform
+    :param centered: if True, the zero position of m and the zero frequency of the result are centered,
+     i.e. compute fftshift(fft2(ifftshift(m)))
+    :param axes: axes to transform along
+    :return m_ft:
+    """
+    axes = tuple(axes)
+    m = np.asarray(m)
+    _count_ffts(m.shape, axes)
+
+    if centered:
+        m = fft.ifftshift(m, axes=axes)
+
+    if _fft_settings['backend'] == "pyfftw":
+        if np.isrealobj(m) and tuple(np.mod(axes, m.ndim)) == (m.ndim - 2, m.ndim - 1):
+            m_ft = _expand_hermitian(_fftw_execute("rfftn", m, axes), m.shape[-1])
+        else:
+            m_ft = _fftw_execute("fftn", m, axes)
+    else:
+        # real inputs are handled by a real-to-complex transform internally, and the shifted copy can be overwritten
+        m_ft = fft.fft2(m, axes=axes, overwrite_x=centered, workers=_fft_settings['workers'])
+
+    if centered:
+        m_ft = fft.fftshift(m_ft, axes=axes)
+
+    return m_ft
+
+def ift2(m_ft, centered=True, axes=(-2, -1)):
+    """
+    2D inverse Fourier transform using the backend selected by set_fft_backend()
+
+    :param m_ft: array to transform
+    :param centered: if True, the zero frequency of m_ft and the zero position of the result are centered,
+     i.e. compute fftshift(ifft2(ifftshift(m_ft)))
+    :param axes: axes to transform along
+    :return m:
+    """
+    axes = tuple(axes)
+    m_ft = np.asarray(m_ft)
+    _count_ffts(m_ft.shape, axes)
+
+    if centered:
+        m_ft = fft.ifftshift(m_ft, axes=axes)
+
+    if _fft_settings['backend'] == "pyfftw":
+        m = _fftw_execute("ifftn", m_ft, axes)
+    else:
+        m = fft.ifft2(m_ft, axes=axes, overwrite_x=centered, workers=_fft_settings['workers'])
+
+    if centered:
+        m = fft.fftshift(m, axes=axes)
+
+    return m
+
+def rft2(m, centered=True):
+    """
+    2D Fourier transform of a real array along its last two axes, keeping only the non-negative x-frequencies.
+    The negative x-frequencies can be recovered from m_ft(-f) = m_ft(f).conj(), see expand_rft2(). This requires
+    about half the memory and time of ft2()
+
+    :param m: real array, of size ... x ny x nx
+    :param centered: if True, the zero position of m is centered, and the zero y-frequency of the result is centered.
+     The x-frequencies are always ordered 0, 1, ..., nx // 2, i.e. as given by scipy.fft.rfftfreq()
+    :return m_rft: ... x ny x (nx // 2 + 1)
+    """
+    m = np.asarray(m)
+    if np.iscomplexobj(m):
+        raise ValueError("rft2() requires a real array")
+    _count_ffts(m.shape, (-2, -1))
+
+    if centered:
+        m = fft.ifftshift(m, axes=(-2, -1))
+
+    if _fft_settings['backend'] == "pyfftw":
+        m_rft = _fftw_execute("rfftn", m, (-2, -1))
+    else:
+        m_rft = fft.rfft2(m, axes=(-2, -1), workers=_fft_settings['workers'])
+
+    if centered:
+        m_rft = fft.fftshift(m_rft, axes=-2)
+
+    return m_rft
+
+def irft2(m_rft, nx, centered=True):
+    """
+    Inverse of rft2(), giving a real array from the non-negative x-frequencies of its Fourier transform
+
+    :param m_rft: ... x ny x (nx // 2 + 1)
+    :param nx: size of the last axis of the real array
+    :param centered: whether m_rft was computed with centered=True. If so, the zero position of the result is centered
+    :return m: real array of size ... x ny x nx
+    """
+    m_rft = np.asarray(m_rft)
+    if m_rft.shape[-1] != nx // 2 + 1:
+        raise ValueError("m_rft has %d columns, but expected nx // 2 + 1 = %d" % (m_rft.shape[-1], nx // 2 + 1))
+
+    ny = m_rft.shape[-2]
+    _count_ffts(m_rft.shape, (-2, -1))
+
+    if centered:
+        m_rft = fft.ifftshift(m_rft, axes=-2)
+
+    if _fft_settings['backend'] == "pyfftw":
+        m = _fftw_execute("irfftn", m_rft, (-2, -1), s=(ny, nx))
+    else:
+        m = fft.irfft2(m_rft, s=(ny, nx), axes=(-2, -1), workers=_fft_settings['workers'])
+
+    if centered:
+        m = fft.fftshift(m, axes=(-2, -1))
+
+    return m
+
+def expand_rft2(m_rft, nx, centered=True):
+    """
+    Get the full 2D Fourier transform from the output of rft2()
+
+    :param m_rft: ... x ny x (nx // 2 + 1)
+    :param nx: size of the last axis of the real array
+    :param centered: whether m_rft was computed with centered=True. The output is centered in the same way as ft2()
+    :return m_ft: ... x ny x nx
+    """
+    if m_rft.shape[-1] != nx // 2 + 1:
+        raise ValueError("m_rft has %d columns, but expected nx // 2 + 1 = %d" % (m_rft.shape[-1], nx // 2 + 1))
+
+    if centered:
+        m_rft = fft.ifftshift(m_rft, axes=-2)
+
+    m_ft = _expand_hermitian(m_rft, nx)
+
+    if centered:
+        m_ft = fft.fftshift(m_ft, axes=(-2, -1))
+
+    return m_ft
+
 def get_fft_frqs(length, dt=1, centered=True, mode='symmetric'):
     """
     Get frequencies associated with FFT, ordered from largest magnitude negative to largest magnitude positive.
@@ -1319,6 +2113,149 @@ def get_fft_pos(length, dt=1, centered=True, mode='symmetric'):
 
     return pos
 
+# cached frequency grids
+# the same frequency grids and masks are needed many times per frame by the SIM fitting and reconstruction
+# functions, so keep the most recently used ones. Cached arrays are read-only so they can be shared safely.
+frequency_grid_cache_size = 32
+frequency_grid_cache_max_bytes = 1e9
+_frequency_grid_cache = collections.OrderedDict()
+_frequency_grid_cache_stats = {"hits": 0, "misses": 0}
+_frequency_grid_cache_lock = threading.Lock()
+
+def _frequency_axis_key(frqs):
+    """
+    Describe an evenly spaced frequency axis by (length, first value, spacing). Return None if the axis is not
+    evenly spaced, in which case grids using it are not cached.
+    """
+    frqs = np.asarray(frqs)
+    if frqs.ndim != 1 or frqs.size < 2:
+        return None
+
+    df = frqs[1] - frqs[0]
+    if not np.allclose(np.diff(frqs), df, rtol=1e-8, atol=0):
+        return None
+
+    return frqs.size, float(frqs[0]), float(df)
+
+def _get_cached_grid(key, grid_fn):
+    """
+    Return grid_fn() from the cache if key is present, and otherwise compute it and add it to the cache.
+
+    :param key: hashable key, or None to skip the cache
+    :param grid_fn: function with no arguments which computes the array
+    :return arr: read-only array
+    """
+    if key is not None:
+        with _frequency_grid_cache_lock:
+            if key in _frequency_grid_cache:
+                _frequency_grid_cache.move_to_end(key)
+                _frequency_grid_cache_stats["hits"] += 1
+                return _frequency_grid_cache[key]
+
+    arr = grid_fn()
+    arr.flags.writeable = False
+
+    if key is not None:
+        with _frequency_grid_cache_lock:
+            _frequency_grid_cache_stats["misses"] += 1
+            _frequency_grid_cache[key] = arr
+
+            # evict least recently used grids
+            while len(_frequency_grid_cache) > 1 and \
+                    (len(_frequency_grid_cache) > frequency_grid_cache_size or
+                     sum([v.nbytes for v in _frequency_grid_cache.values()]) > frequency_grid_cache_max_bytes):
+                _frequency_grid_cache.popitem(last=False)
+
+    return arr
+
+def get_frequency_grids(fxs, fys, dtype=float):
+    """
+    Get 2D frequency grids and the radial frequency map. The radial map is cached, so repeated calls with the same
+    frequencies do not allocate new arrays.
+
+    :param fxs: 1D array of x-frequencies
+    :param fys: 1D array of y-frequencies
+    :param dtype: data type of the radial frequency map
+    :return fxfx: read-only grid of x-frequencies, of size len(fys) x len(fxs)
+    :return fyfy: read-only grid of y-frequencies
+    :return ff: read-only grid of sqrt(fx^2 + fy^2)
+    """
+    fxs = np.asarray(fxs)
+    fys = np.asarray(fys)
+    shape = (fys.size, fxs.size)
+
+    xkey = _frequency_axis_key(fxs)
+    ykey = _frequency_axis_key(fys)
+    key = None if xkey is None or ykey is None else ("ff", xkey, ykey, np.dtype(dtype).str)
+
+    ff = _get_cached_grid(key, lambda: np.sqrt(fxs[None, :] ** 2 + fys[:, None] ** 2).astype(dtype, copy=False))
+
+    return np.broadcast_to(fxs[None, :], shape), np.broadcast_to(fys[:, None], shape), ff
+
+def get_frequency_mask(fxs, fys, fmax, fmin=0):
+    """
+    Get mask of points in frequency space with fmin <= |f| <= fmax, e.g. the support of the OTF or an annulus.
+    The mask is cached.
+
+    :param fxs: 1D array of x-frequencies
+    :param fys: 1D array of y-frequencies
+    :param fmax: maximum frequency. May be np.inf
+    :param fmin: minimum frequency
+    :return mask: read-only boolean array of size len(fys) x len(fxs)
+    """
+    xkey = _frequency_axis_key(fxs)
+    ykey = _frequency_axis_key(fys)
+    key = None if xkey is None or ykey is None else ("mask", xkey, ykey, float(fmin), float(fmax))
+
+    def mask_fn():
+        _, _, ff = get_frequency_grids(fxs, fys)
+        return np.logical_and(ff >= fmin, ff <= fmax)
+
+    return _get_cached_grid(key, mask_fn)
+
+def get_frequency_inds(fxs, fys, fmax, fmin=0):
+    """
+    Get flattened indices of points in frequency space with fmin <= |f| <= fmax. These can be used to select the
+    points from an image with np.take(img.reshape(-1), inds), which is faster than indexing with a boolean mask.
+    The indices are cached.
+
+    :param fxs: 1D array of x-frequencies
+    :param fys: 1D array of y-frequencies
+    :param fmax: maximum frequency. May be np.inf
+    :param fmin: minimum frequency
+    :return inds: read-only 1D array of indices
+    """
+    xkey = _frequency_axis_key(fxs)
+    ykey = _frequency_axis_key(fys)
+    key = None if xkey is None or ykey is None else ("inds", xkey, ykey, float(fmin), float(fmax))
+
+    return _get_cached_grid(key, lambda: np.flatnonzero(get_frequency_mask(fxs, fys, fmax, fmin=fmin)))
+
+def get_frequency_grid_cache_info():
+    """
+    Get statistics for the frequency grid cache
+
+    :return info: dictionary with entries "hits", "misses", "entries", "nbytes", "maxsize" and "max_bytes"
+    """
+    with _frequency_grid_cache_lock:
+        info = {"hits": _frequency_grid_cache_stats["hits"],
+                "misses": _frequency_grid_cache_stats["misses"],
+                "entries": len(_frequency_grid_cache),
+                "nbytes": sum([v.nbytes for v in _frequency_grid_cache.values()]),
+                "maxsize": frequency_grid_cache_size,
+                "max_bytes": frequency_grid_cache_max_bytes}
+
+    return info
+
+def clear_frequency_grid_cache():
+    """
+    Remove all grids from the frequency grid cache and reset the hit and miss counts
+    """
+    with _frequency_grid_cache_lock:
+        _frequency_grid_cache.clear()
+        _frequency_grid_cache_stats["hits"] = 0
+        _frequency_grid_cache_stats["misses"] = 0
+
 def get_spline_fn(x1, x2, y1, y2, dy1, dy2):
     """
 
@@ -1447,7 +2384,7 @@ def translate_im(img, shift, dx=1, dy=None):
     # 2. multiply by exponential factor
     # 3. inverse ft
     exp_factor = np.exp(1j * 2 * np.pi * (shift[0] * fyfy + shift[1] * fxfx))
-    img_shifted = fft.fftshift(fft.ifft2(exp_factor * fft.fft2(fft.ifftshift(img))))
+    img_shifted = fft.fftshift(ift2(exp_factor * ft2(fft.ifftshift(img), centered=False), centered=False))
 
     return img_shifted
 
@@ -1459,8 +2396,10 @@ def translate_ft(img_ft: np.ndarray, shift_frq, dx=1, dy=None, apodization=None)
 
     This is an approximation to the Whittaker-Shannon interpolation formula which can be performed using only FFT's
 
-    :param img_ft: fourier transform, with frequencies centered using fftshift
-    :param shift_frq: [fx, fy]. Frequency in hertz (i.e. angular frequency is k = 2*pi*f)
+    :param img_ft: fourier transform, with frequencies centered using fftshift. If this has more than two
+    dimensions, each image along the last two axes is translated
+    :param shift_frq: [fx, fy]. Frequency in hertz (i.e. angular frequency is k = 2*pi*f). May also be an array of
+    size ... x 2, in which case the shifts are broadcast against the leading dimensions of img_ft
     :param dx: pixel size (sampling rate) of real space image in x-direction
     :param dy: pixel size (sampling rate) of real space image in y-direction
     :param apodization: apodization function applied (in both k- and real- space)
@@ -1478,16 +2417,22 @@ def translate_ft(img_ft: np.ndarray, shift_frq, dx=1, dy=None, apodization=None)
     # 3. multiply by exponential factor
     # 4. take fourier transform, then shift frequencies back using fftshift
 
-    ny, nx = img_ft.shape
+    ny, nx = img_ft.shape[-2:]
     # must use symmetric frequency representation to do correctly!
     # we are using the FT shift theorem to approximate the Whittaker-Shannon interpolation formula,
     # but we get an extra phase if we don't use the symmetric rep. AND only works perfectly if size odd
     x = get_fft_pos(nx, dx, centered=False, mode='symmetric')
     y = get_fft_pos(ny, dy, centered=False, mode='symmetric')
 
-    exp_factor = np.exp(-1j * 2 * np.pi * (shift_frq[0] * x[None, :] + shift_frq[1] * y[:, None]))
+    shift_frq = np.asarray(shift_frq)
+    exp_factor = np.exp(-1j * 2 * np.pi * (shift_frq[..., 0, None, None] * x[None, :] +
+                                           shift_frq[..., 1, None, None] * y[:, None]))
+    # keep precision of input
+    exp_factor = exp_factor.astype(np.result_type(img_ft.dtype, np.complex64), copy=False)
     #ifft2(ifftshift(img_ft)) = ifftshift(img)
-    img_ft_shifted = fft.fftshift(fft.fft2(apodization * exp_factor * fft.ifft2(fft.ifftshift(img_ft * apodization))))
+    img_ft_shifted = fft.fftshift(ft2(apodization * exp_factor *
+                                      ift2(fft.ifftshift(img_ft * apodization, axes=(-2, -1)), centered=False),
+                                      centered=False), axes=(-2, -1))
 
     return img_ft_shifted
 
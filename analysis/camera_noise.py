@@ -570,8 +570,8 @@ def simulated_img(ground_truth, max_photons, cam_gains, cam_offsets, cam_readout
 
         # blur image with otf/psf
         # todo: maybe should add an "imaging forward model" function to fit_psf.py and call it here.
-        gt_ft = fft.fftshift(fft.fft2(fft.ifftshift(ground_truth)))
-        img_blurred = max_photons * fft.fftshift(fft.ifft2(fft.ifftshift(gt_ft * otf))).real
+        gt_ft = tools.ft2(ground_truth)
+        img_blurred = max_photons * tools.ift2(gt_ft * otf).real
         img_blurred[img_blurred < 0] = 0
     else:
         img_blurred = max_photons * ground_truth
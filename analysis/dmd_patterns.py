@@ -1004,7 +1004,7 @@ def get_intensity_fourier_components_xform(pattern, affine_xform, roi, vec_a, ve
     pattern_xformed = affine.affine_xform_mat(pattern, xform_roi, img_coords_roi, mode="interp")
     # pattern_xformed = affine.affine_xform_mat(pattern, affine_xform, img_coords, mode="interp")
     # pattern_xformed = pattern_xformed[roi[0]:roi[1], roi[2]:roi[3]]
-    pattern_xformed_ft = fft.fftshift(fft.fft2(fft.ifftshift(pattern_xformed)))
+    pattern_xformed_ft = tools.ft2(pattern_xformed)
 
     fxs = tools.get_fft_frqs(pattern_xformed.shape[1], dt=1)
     fys = tools.get_fft_frqs(pattern_xformed.shape[0], dt=1)
@@ -2133,7 +2133,7 @@ def plot_sim_pattern_sets(patterns, vas, vbs, wavelength=None, pitch=7560):
         # 2D window from broadcasting
         window = window_x * window_y
 
-        ft = fft.fftshift(fft.fft2(fft.ifftshift(window * patterns[ii, 0])))
+        ft = tools.ft2(window * patterns[ii, 0])
         plt.imshow(np.abs(ft) / np.abs(ft).max(), norm=PowerNorm(gamma=0.1), extent=extent)
 
         # dominant frequencies of underlying patterns
@@ -68,7 +68,7 @@ def otf2psf(otf, dfx=1, dfy=1):
     :return:
     """
     ny, nx = otf.shape
-    psf = fft.fftshift(fft.ifft2(fft.ifftshift(otf))).real
+    psf = tools.ift2(otf).real
     dx = 1 / (dfx * nx)
     dy = 1 / (dfy * ny)
     xs = tools.get_fft_pos(nx, dt=dx)
@@ -78,7 +78,7 @@ def otf2psf(otf, dfx=1, dfy=1):
 
 def psf2otf(psf, dx=1, dy=1):
     ny, nx = psf.shape
-    otf = fft.fftshift(fft.fft2(fft.ifftshift(psf)))
+    otf = tools.ft2(psf)
     fxs = tools.get_fft_pos(nx, dt=dx)
     fys = tools.get_fft_pos(ny, dt=dy)
 
@@ -1409,7 +1409,7 @@ def export_psf_otf(imgs, dx, dz, wavelength, ni, rois, fit3ds, fit2ds, expected_
         # correct problematic PSF points before calculating mtf
         psf2d[np.isnan(psf2d)] = 0
         psf2d[psf2d < 0] = 0
-        mtf = np.abs(fft.fftshift(fft.fft2(fft.ifftshift(psf2d))))
+        mtf = np.abs(tools.ft2(psf2d))
         fx = tools.get_fft_frqs(mtf.shape[0], dt=dx)
         fy = fx
         dfx = fx[1] - fx[0]
@@ -247,7 +247,7 @@ def get_all_fourier_exp(imgs, frq_vects_theory, roi, pixel_size_um, fmax_img,
         img = icrop - bg
         img[img < 0] = 1e-6
 
-        img_ft = fft.fftshift(fft.fft2(fft.ifftshift(img * window)))
+        img_ft = tools.ft2(img * window)
         noise_power = sim_reconstruction.get_noise_power(img_ft, fxs, fys, fmax_img)
     else:
         raise Exception()
@@ -267,7 +267,7 @@ def get_all_fourier_exp(imgs, frq_vects_theory, roi, pixel_size_um, fmax_img,
             img[img < 0] = 1e-6
 
             # fft
-            img_ft = fft.fftshift(fft.fft2(fft.ifftshift(img * window)))
+            img_ft = tools.ft2(img * window)
             # get noise
             noise_power = sim_reconstruction.get_noise_power(img_ft, fxs, fys, fmax_img)
 
@@ -523,7 +523,7 @@ def plot_pattern(img, va, vb, frq_vects, fmax_img, pixel_size_um, dmd_size, affi
 
 
     window = scipy.signal.windows.hann(nx)[None, :] * scipy.signal.windows.hann(ny)[:, None]
-    img_ft = fft.fftshift(fft.fft2(fft.ifftshift(img_roi * window)))
+    img_ft = tools.ft2(img_roi * window)
 
     # plot results
     figh = plt.figure(figsize=figsize)
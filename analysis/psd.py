@@ -10,7 +10,10 @@ Moisan, L. J Math Imaging Vis (2011) 39: 161.
 doi.org/10.1007/s10851-010-0227-1
 """
 
+import functools
 import numpy as np
+from scipy import fft
+import analysis_tools as tools
 
 def periodic_smooth_decomp(I: np.ndarray) -> (np.ndarray, np.ndarray):
     '''Performs periodic-smooth image decomposition
@@ -18,24 +21,93 @@ def periodic_smooth_decomp(I: np.ndarray) -> (np.ndarray, np.ndarray):
     Parameters
     ----------
     I : np.ndarray
-        [M, N] image. will be coerced to a float.
+        [..., M, N] image or stack of images. will be coerced to a float.
 
     Returns
     -------
     P : np.ndarray
-        [M, N] image, float. periodic portion.
+        [..., M, N] image, float. periodic portion.
     S : np.ndarray
-        [M, N] image, float. smooth portion.
+        [..., M, N] image, float. smooth portion.
     '''
     u = I.astype(np.float64)
-    v = u2v(u)
-    v_fft = np.fft.fftn(v)
-    s = v2s(v_fft)
-    s_i = np.fft.ifftn(s)
-    s_f = np.real(s_i)
-    p = u - s_f # u = p + s
+    p = periodic_component(u)
+    s_f = u - p # u = p + s
     return p, s_f
 
+def periodic_component(I: np.ndarray) -> np.ndarray:
+    '''Computes the periodic component of an image or a stack of images
+
+    The boundary image `v` is nonzero only on the outermost rows and
+    columns, so its DFT is the sum of a term which depends on the 1D DFT of
+    the row differences and a term which depends on the 1D DFT of the
+    column differences. Only one inverse real FFT of the full image size is
+    needed to get the smooth component.
+
+    Parameters
+    ----------
+    I : np.ndarray
+        [..., M, N] image or stack of images. Single precision images are
+        processed in single precision, and all others are coerced to float64.
+
+    Returns
+    -------
+    P : np.ndarray
+        [..., M, N] image, float. periodic portion.
+    '''
+    dtype = np.float32 if I.dtype == np.float32 else np.float64
+    u = np.asarray(I, dtype=dtype)
+    M, N = u.shape[-2:]
+
+    # v[0, :] = u[-1, :] - u[0, :], v[-1, :] = -v[0, :], and similarly for the columns
+    a_hat = fft.rfft(u[..., -1, :] - u[..., 0, :], axis=-1)
+    b_hat = fft.fft(u[..., :, -1] - u[..., :, 0], axis=-1)
+
+    # DFT of v for the non-negative frequencies along the last axis
+    row_phase, col_phase, den_inv = _get_psd_factors(M, N, np.dtype(dtype).str)
+    v_hat = a_hat[..., None, :] * row_phase[:, None] + b_hat[..., :, None] * col_phase[None, :]
+    v_hat *= den_inv
+
+    s = tools.irft2(v_hat, N, centered=False)
+    return u - s
+
+@functools.lru_cache(maxsize=16)
+def _get_psd_factors(M: int, N: int, dtype_str: str) -> (np.ndarray, np.ndarray, np.ndarray):
+    '''Get the factors used by `periodic_component` for an image size
+
+    Parameters
+    ----------
+    M, N : int
+        image size
+    dtype_str : str
+        real data type of the image
+
+    Returns
+    -------
+    row_phase : np.ndarray
+        [M] 1 - exp(2*pi*i*q/M)
+    col_phase : np.ndarray
+        [N // 2 + 1] 1 - exp(2*pi*i*r/N)
+    den_inv : np.ndarray
+        [M, N // 2 + 1] 1 / (2*cos(2*pi*q/M) + 2*cos(2*pi*r/N) - 4), with
+        the zero frequency set to 0
+    '''
+    q = np.arange(M)
+    r = np.arange(N // 2 + 1)
+    dtype = np.dtype(dtype_str)
+    dtype_complex = np.result_type(dtype, np.complex64)
+
+    row_phase = (1 - np.exp(2j * np.pi * q / M)).astype(dtype_complex)
+    col_phase = (1 - np.exp(2j * np.pi * r / N)).astype(dtype_complex)
+
+    den = 2 * np.cos(2 * np.pi * q / M)[:, None] + 2 * np.cos(2 * np.pi * r / N)[None, :] - 4
+    den_inv = np.divide(1, den, out=np.zeros(den.shape), where=den != 0).astype(dtype)
+
+    for arr in [row_phase, col_phase, den_inv]:
+        arr.flags.writeable = False
+
+    return row_phase, col_phase, den_inv
+
 def u2v(u: np.ndarray) -> np.ndarray:
     '''Converts the image `u` into the image `v`
 
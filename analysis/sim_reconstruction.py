@@ -11,11 +11,16 @@ import fit
 
 # general imports
 import pickle
+import json
 import os
 import time
 import datetime
 import warnings
 import shutil
+import threading
+import queue
+import collections
+import concurrent.futures
 import joblib
 
 # numerical tools
@@ -39,7 +44,8 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
                        crop_sizes=None, use_scmos_cal=False, scmos_calibration_file=None, widefield_only=False,
                        nangles=3, nphases=3, npatterns_ignored=0, saving=True,
                        zinds_to_use=None, tinds_to_use=None, xyinds_to_use=None,
-                       save_tif_stack=True, **kwargs):
+                       save_tif_stack=True, streaming=False, parameter_tracking=None, n_workers=1,
+                       n_prefetch=2, progress_callback=None, trace_memory=False, **kwargs):
     """
     Reconstruct entire folder of SIM data and save results in TIF stacks. Responsible for loading relevant data
     (images, affine transformations, SIM pattern information), selecting images to recombine from metadata, and
@@ -71,13 +77,33 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
     :param bool npatterns_ignored: number of patterns to ignore at the start of each channel.
     :param bool saving: if True, save results
     :param bool save_tif_stack:
+    :param bool streaming: if True, write each result to disk as soon as it is reconstructed instead of holding all
+    results in memory until the end. If save_tif_stack is also True, the returned stacks are memory maps of the
+    saved files.
     :param str sim_data_export_fname:
-    :param **kwargs: passed through to reconstruction
+    :param dict parameter_tracking: if not None, dictionary of keyword arguments for SimParameterTracker. Then
+    SIM parameters are fully fit only on reference images, and reused for the other images of the same channel.
+    :param int n_workers: number of processes used to reconstruct images in parallel. Each image (channel, time,
+    position, z-slice) is reconstructed independently, and results are stored in acquisition order. Cannot be
+    combined with parameter_tracking, which requires images to be processed in order.
+    :param int n_prefetch: number of sets of images loaded ahead of the images being reconstructed. Loading,
+    cropping and conversion to photons are done in a background thread
+    :param progress_callback: if not None, function called with a dictionary {'folder', 'frames_done',
+    'frames_total', 'elapsed_time_s', 'frames_per_s', 'frame_time_s', 'io_wait_time_s'} each time an image has
+    been reconstructed. io_wait_time_s is the total time spent waiting for images to load
+    :param bool trace_memory: if True, record the bytes allocated in each stage of the reconstruction. This
+    slows down the reconstruction, see analysis_tools.Profiler
+    :param **kwargs: passed through to reconstruction. In particular, diagnostics="none" skips keeping intermediate
+    arrays and generating figures for each image. These can be recomputed later using recompute_diagnostics()
 
     :return np.ndarray imgs_sr:
     :return np.ndarray imgs_wf:
     :return np.ndarray imgs_deconvolved:
     :return np.ndarray imgs_os:
+
+    For each folder, the wall time, CPU time and number of FFT's of each stage of the reconstruction of each image
+    are recorded. If saving, these records are written to "performance.jsonl", and a summary of the records, the
+    throughput and the time spent waiting for images to load to "performance_report.json", in the results directory.
     """
 
     nfolders = len(data_root_paths)
@@ -91,6 +117,9 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
     if channel_inds is None:
         channel_inds = list(range(ncolors))
 
+    if n_workers > 1 and parameter_tracking is not None:
+        raise ValueError("parameter_tracking cannot be used with n_workers > 1")
+
     # ensure crop_sizes is a list the same size as number of folders
     if not isinstance(crop_sizes, list):
         crop_sizes = [crop_sizes]
@@ -191,6 +220,9 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
 
         # load metadata
         metadata, dims, summary = tools.parse_mm_metadata(rpath)
+        # index images by the coordinates used to select them, so each set of images is found without a full scan
+        metadata_index = tools.MetadataIndex(metadata, ["FrameIndex", "PositionIndex", "SliceIndex",
+                                                        "UserChannelIndex", "UserSimIndex"])
         start_time = datetime.datetime.strptime(summary['StartTime'],  '%Y-%d-%m;%H:%M:%S.%f')
         nz = dims['z']
         nxy = dims['position']
@@ -221,8 +253,8 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
         # set up image size
         # load one file to check size
         fname = os.path.join(rpath, metadata['FileName'].values[0])
-        im, _ = tools.read_tiff(fname, [metadata['ImageIndexInFile'].values[0]])
-        _, ny_raw, nx_raw = im.shape
+        im = tools.read_tiff_frame(fname, metadata['ImageIndexInFile'].values[0])
+        ny_raw, nx_raw = im.shape
         if crop_image:
             # or pick ROI
             roi = tools.get_centered_roi(img_center, [crop_size, crop_size])
@@ -247,7 +279,23 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
         imgs_os = []
         imgs_wf = []
         imgs_deconvolved = []
-        counter = 1
+
+        # when streaming or saving individual files, results are written to disk by a background thread as soon as
+        # each image is reconstructed, instead of being held in memory
+        if saving and (streaming or not save_tif_stack):
+            if save_tif_stack:
+                stack_shape = (ncolors, nt_used * nxy_used, nz_used)
+            else:
+                stack_shape = None
+            writer = SimResultWriter(sim_results_path, stack_shape, start_time=start_time)
+        else:
+            writer = None
+
+        # #################################
+        # reconstruction settings for each channel. These are shared by all images of the channel
+        # #################################
+        channel_settings = []
+        parameter_trackers = []
         for kk in range(ncolors):
             sim_options = {'pixel_size': pixel_size, 'wavelength': emission_wavelengths[kk], 'na': na}
 
@@ -255,10 +303,13 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
             fmax = 1 / (0.5 * emission_wavelengths[kk] / na)
             fx = tools.get_fft_frqs(nx, sim_options['pixel_size'])
             fy = tools.get_fft_frqs(ny, sim_options['pixel_size'])
-            ff = np.sqrt(fx[None, :] ** 2 + fy[:, None] ** 2)
+            _, _, ff = tools.get_frequency_grids(fx, fy)
             otf = otf_fn(ff, fmax)
             otf[ff >= fmax] = 0
 
+            # frequency grids, OTF's and apodization are the same for every image in this channel
+            geometry = get_reconstruction_geometry(nx, ny, pixel_size, na, emission_wavelengths[kk], otf=otf)
+
             # guess frequencies/phases
             frqs_guess = np.zeros((nangles, 2))
             phases_guess = np.zeros((nangles, nphases))
@@ -272,88 +323,146 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
             # convert from 1/mirrors to 1/um
             frqs_guess = frqs_guess / pixel_size
 
-            # analyze pictures
-            for ii in tinds_to_use_temp:
-                for bb in xyinds_to_use_temp:
-                    for aa in zinds_to_use_temp:
-                        tstart = time.process_time()
+            channel_settings.append({'options': sim_options, 'frqs_guess': frqs_guess, 'phases_guess': phases_guess,
+                                     'otf': otf, 'geometry': geometry})
+
+            if parameter_tracking is not None:
+                parameter_trackers.append(SimParameterTracker(**parameter_tracking))
+            else:
+                parameter_trackers.append(None)
+
+        def load_imgs(kk, ii, bb, aa):
+            # find images and load them
+            raw_imgs = tools.read_dataset(metadata, z_indices=aa, xy_indices=bb, time_indices=ii,
+                                          user_indices={"UserChannelIndex": channel_inds[kk],
+                                          "UserSimIndex": list(range(npatterns_ignored, npatterns_ignored + nangles * nphases))},
+                                          index=metadata_index)
+
+            # error if we have wrong number of images
+            if np.shape(raw_imgs)[0] != (nangles * nphases):
+                raise ValueError("Found %d images, but expected %d images at channel=%d,"
+                                 " zindex=%d, tindex=%d, xyindex=%d" % (
+                                 np.shape(raw_imgs)[0], nangles * nphases,
+                                 channel_inds[kk], aa, ii, bb))
+
+            # optionally convert from ADC to photons
+            # todo: not very useful to do this way...
+            if use_scmos_cal:
+                imgs_sim = camera_noise.adc2photons(raw_imgs, gain_map, offsets)
+            else:
+                imgs_sim = raw_imgs
+
+            # reshape to [nangles, nphases, ny, nx]
+            imgs_sim = imgs_sim.reshape((nangles, nphases, raw_imgs.shape[1], raw_imgs.shape[2]))
+            imgs_sim = imgs_sim[:, :, roi[0]:roi[1], roi[2]:roi[3]]
 
+            return imgs_sim
+
+        def store_results(frame, results, elapsed_time, records):
+            kk, it, ii, ib, bb, iz, aa = frame
+            profile_records.extend(records)
+
+            if writer is not None:
+                file_identifier = "nc=%d_nt=%d_nxy=%d_nz=%d" % (kk, ii, bb, aa)
+                writer.write((kk, it * nxy_used + ib, iz), file_identifier, results)
+            else:
+                imgs_wf.append(results['widefield'])
+                imgs_os.append(results['sim_os'])
+                if not widefield_only:
+                    imgs_sr.append(results['sim_sr'])
+                    imgs_deconvolved.append(results['deconvolved'])
+
+            print("%d/%d from %s in %0.2fs" % (len(stored) + 1, len(frame_inds), folder, elapsed_time))
+            stored.append(frame)
+
+            if progress_callback is not None:
+                folder_elapsed_time = time.perf_counter() - folder_tstart
+                progress_callback({'folder': folder, 'frames_done': len(stored), 'frames_total': len(frame_inds),
+                                   'elapsed_time_s': folder_elapsed_time,
+                                   'frames_per_s': len(stored) / folder_elapsed_time,
+                                   'frame_time_s': elapsed_time, 'io_wait_time_s': reader.wait_time})
+
+        # #################################
+        # analyze pictures
+        # #################################
+        frame_inds = [(kk, it, ii, ib, bb, iz, aa) for kk in range(ncolors)
+                                                   for it, ii in enumerate(tinds_to_use_temp)
+                                                   for ib, bb in enumerate(xyinds_to_use_temp)
+                                                   for iz, aa in enumerate(zinds_to_use_temp)]
+        stored = []
+        profile_records = []
+        folder_tstart = time.perf_counter()
+
+        if n_workers > 1:
+            # each worker process receives the shared channel settings once. Frequency fitting in the workers does
+            # not start its own joblib pool, since the frames are already being processed in parallel
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                          initializer=_init_reconstruction_worker,
+                                                          initargs=(channel_settings, dict(kwargs, n_jobs=1),
+                                                                    trace_memory))
+        else:
+            pool = None
+
+        # frames being reconstructed by the pool, in acquisition order
+        pending = collections.deque()
+
+        try:
+            # load, crop and convert the next images in a background thread while the current images are
+            # reconstructed
+            with tools.Prefetcher(load_imgs, [f[::2] for f in frame_inds], n_ahead=n_prefetch) as reader:
+                for frame, imgs_sim in zip(frame_inds, reader):
+                    kk, it, ii, ib, bb, iz, aa = frame
+
+                    # where we will store results for this particular set
+                    if saving and not widefield_only:
                         identifier = "%.0fnm_nt=%d_nxy=%d_nz=%d" % (excitation_wavelengths[kk] * 1e3, ii, bb, aa)
-                        file_identifier = "nc=%d_nt=%d_nxy=%d_nz=%d" % (kk, ii, bb, aa)
-
-                        # where we will store results for this particular set
-                        if not widefield_only:
-                            sim_diagnostics_path = os.path.join(sim_results_path, identifier)
-                            if not os.path.exists(sim_diagnostics_path):
-                                os.mkdir(sim_diagnostics_path)
-
-                        # find images and load them
-                        raw_imgs = tools.read_dataset(metadata, z_indices=aa, xy_indices=bb, time_indices=ii,
-                                           user_indices={"UserChannelIndex": channel_inds[kk],
-                                           "UserSimIndex": list(range(npatterns_ignored, npatterns_ignored + nangles * nphases))})
-
-                        # error if we have wrong number of images
-                        if np.shape(raw_imgs)[0] != (nangles * nphases):
-                            raise ValueError("Found %d images, but expected %d images at channel=%d,"
-                                            " zindex=%d, tindex=%d, xyindex=%d" % (
-                                            np.shape(raw_imgs)[0], nangles * nphases,
-                                            channel_inds[kk], aa, ii, bb))
-
-                        # optionally convert from ADC to photons
-                        # todo: not very useful to do this way...
-                        if use_scmos_cal:
-                            imgs_sim = camera_noise.adc2photons(raw_imgs, gain_map, offsets)
-                        else:
-                            imgs_sim = raw_imgs
-
-                        # reshape to [nangles, nphases, ny, nx]
-                        imgs_sim = imgs_sim.reshape((nangles, nphases, raw_imgs.shape[1], raw_imgs.shape[2]))
-                        imgs_sim = imgs_sim[:, :, roi[0]:roi[1], roi[2]:roi[3]]
-
-                        # instantiate reconstruction object
-                        r = SimImageSet(sim_options, imgs_sim, frqs_guess, phases_guess=phases_guess, otf=otf,
-                                        save_dir=sim_diagnostics_path, **kwargs)
-
-                        # if not saving stack, maybe want to handle in class?
-                        if saving and not save_tif_stack:
-                            fname = os.path.join(sim_results_path, "sim_os_%s.tif" % file_identifier)
-                            tools.save_tiff(r.imgs_os, fname, dtype='float32', datetime=start_time)
-
-                            fname = os.path.join(sim_results_path, "widefield_%s.tif" % file_identifier)
-                            tools.save_tiff(r.widefield, fname, dtype='float32', datetime=start_time)
-                        else:
-                            # store widefield and os
-                            imgs_os.append(r.imgs_os)
-                            imgs_wf.append(r.widefield)
-
-                        if not widefield_only:
-                            # do reconstruction
-                            r.reconstruct()
-                            r.plot_figs()
-
-                            if saving and not save_tif_stack:
-                                fname = os.path.join(sim_results_path, "sim_sr_%s.tif" % file_identifier)
-                                tools.save_tiff(r.img_sr, fname, dtype='float32', datetime=start_time)
-
-                                fname = os.path.join(sim_results_path, "deconvolved_%s.tif" % file_identifier)
-                                tools.save_tiff(r.widefield_deconvolution, fname, dtype='float32', datetime=start_time)
-                            else:
-                                # store sr and deconvolved
-                                imgs_sr.append(r.img_sr)
-                                imgs_deconvolved.append(r.widefield_deconvolution)
-
-                            # save reconstruction summary data
-                            r.save_result(os.path.join(sim_diagnostics_path, "sim_reconstruction_params.pkl"))
-
-                        tend = time.process_time()
-                        print("%d/%d from %s in %0.2fs" % (counter, ncolors * nt_used * nxy_used * nz_used, folder, tend - tstart))
-
-                        counter += 1
+                        sim_diagnostics_path = os.path.join(sim_results_path, identifier)
+                        if not os.path.exists(sim_diagnostics_path):
+                            os.mkdir(sim_diagnostics_path)
+                    else:
+                        sim_diagnostics_path = None
+
+                    profile_fields = {'channel': kk, 'time': ii, 'xy': bb, 'z': aa}
+                    if pool is None:
+                        profiler = tools.Profiler(trace_memory=trace_memory, **profile_fields)
+                        results, elapsed_time = reconstruct_sim_frame(channel_settings[kk], imgs_sim,
+                                                                      sim_diagnostics_path, widefield_only,
+                                                                      parameter_trackers[kk], profiler=profiler,
+                                                                      **kwargs)
+                        store_results(frame, results, elapsed_time, profiler.records)
+                    else:
+                        pending.append((frame, pool.submit(_reconstruct_frame_worker, kk, imgs_sim,
+                                                           sim_diagnostics_path, widefield_only, profile_fields)))
+
+                        # collect results in order. Limit the number of frames in flight to bound memory use
+                        while len(pending) > 2 * n_workers or (pending and pending[0][1].done()):
+                            frame_done, future_done = pending.popleft()
+                            store_results(frame_done, *future_done.result())
+
+                # collect remaining results
+                while pending:
+                    frame_done, future_done = pending.popleft()
+                    store_results(frame_done, *future_done.result())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+            # wait for all results to be written and flushed, also if reconstruction failed, so the writer thread
+            # does not stay blocked and the saved stacks contain all finished frames
+            if writer is not None:
+                writer.close()
 
         # #################################
         # save data for all reconstructed files
         # #################################
-        if saving and save_tif_stack:
+        if writer is not None:
+            if save_tif_stack:
+                imgs_wf = writer.stacks.get('widefield', [])
+                imgs_os = writer.stacks.get('sim_os', [])
+                imgs_sr = writer.stacks.get('sim_sr', [])
+                imgs_deconvolved = writer.stacks.get('deconvolved', [])
+
+        elif saving and save_tif_stack:
 
             # todo: want to include metadata in tif.
             fname = tools.get_unique_name(os.path.join(sim_results_path, 'widefield.tif'))
@@ -382,19 +491,142 @@ def reconstruct_folder(data_root_paths, pixel_size, na, emission_wavelengths, ex
                 tools.save_tiff(deconvolved_to_save, fname, dtype='float32', axes_order='CTZYX', hyperstack=True,
                                 datetime=start_time)
 
+        # #################################
+        # performance report
+        # #################################
+        folder_elapsed_time = time.perf_counter() - folder_tstart
+        io_stats = reader.get_stats()
+        report = {'folder': folder, 'frames': len(stored), 'n_workers': n_workers,
+                  'wall_time_s': folder_elapsed_time, 'frames_per_s': len(stored) / folder_elapsed_time,
+                  'io_wait_time_s': io_stats['wait_time_s'], 'io_load_time_s': io_stats['load_time_s'],
+                  'stages': tools.summarize_profile(profile_records)}
+        print("reconstructed %d images from %s in %0.2fs, %0.3f images/s, waited %0.2fs for images to load" %
+              (len(stored), folder, folder_elapsed_time, report['frames_per_s'], io_stats['wait_time_s']))
+
+        if saving:
+            with open(os.path.join(sim_results_path, "performance_report.json"), "w") as f:
+                json.dump(report, f, indent=2)
+
+            with open(os.path.join(sim_results_path, "performance.jsonl"), "w") as f:
+                for r in profile_records:
+                    f.write(json.dumps(r) + "\n")
+
     return imgs_sr, imgs_wf, imgs_deconvolved, imgs_os
 
+def reconstruct_sim_frame(settings, imgs, save_dir=None, widefield_only=False, parameter_tracker=None,
+                          profiler=None, **kwargs):
+    """
+    Reconstruct a single set of SIM images using the settings of its channel
+
+    :param dict settings: {'options', 'frqs_guess', 'phases_guess', 'otf', 'geometry'}
+    :param imgs: nangles x nphases x ny x nx
+    :param save_dir: directory to save diagnostic figures and reconstruction parameters. If None, nothing is saved
+    :param widefield_only: if True, only compute widefield and optically sectioned images
+    :param parameter_tracker: SimParameterTracker, or None
+    :param profiler: analysis_tools.Profiler. The whole reconstruction is recorded in a span named "frame", with
+    nested spans for each stage. If None, a new profiler is created
+    :param kwargs: passed through to SimImageSet
+    :return results: dictionary of reconstructed images {'widefield', 'sim_os', 'sim_sr', 'deconvolved'}
+    :return elapsed_time: wall time in seconds
+    """
+    if profiler is None:
+        profiler = tools.Profiler()
+
+    with profiler.span("frame") as frame_span:
+        with profiler.span("init"):
+            r = SimImageSet(settings['options'], imgs, settings['frqs_guess'], phases_guess=settings['phases_guess'],
+                            otf=settings['otf'], save_dir=save_dir, geometry=settings['geometry'], profiler=profiler,
+                            **kwargs)
+
+        results = {'widefield': r.widefield, 'sim_os': r.imgs_os}
+
+        if not widefield_only:
+            # do reconstruction
+            if parameter_tracker is not None:
+                parameter_tracker.prepare(r)
+
+            with profiler.span("reconstruct"):
+                r.reconstruct()
+
+            if parameter_tracker is not None:
+                parameter_tracker.update(r)
+
+            with profiler.span("plot"):
+                r.plot_figs()
+
+            results.update({'sim_sr': r.img_sr, 'deconvolved': r.widefield_deconvolution})
+
+            # save reconstruction summary data
+            if save_dir is not None:
+                r.save_result(os.path.join(save_dir, "sim_reconstruction_params.pkl"))
+
+    return results, frame_span.wall_time
+
+def recompute_diagnostics(params_fname, imgs, diagnostics="full", save_dir=None, **kwargs):
+    """
+    Recompute diagnostic arrays and figures for a reconstruction, e.g. one run with diagnostics="none", from the
+    reconstruction parameters saved by SimImageSet.save_result() and the raw images. The SIM frequencies, phases and
+    power spectrum parameters are not fit again, but taken from the saved parameters. As when using fixed phases, the
+    pattern amplitudes are taken to be 1.
+
+    :param params_fname: path to saved reconstruction parameters, typically "sim_reconstruction_params.pkl"
+    :param imgs: raw SIM images used in the original reconstruction, nangles x nphases x ny x nx
+    :param diagnostics: "summary" or "full"
+    :param save_dir: directory to save figures. If None, figures are not saved
+    :param kwargs: passed through to SimImageSet, overriding the saved settings
+    :return sim_image_set: SimImageSet with diagnostics recomputed
+    """
+    with open(params_fname, 'rb') as f:
+        params = pickle.load(f)
+
+    options = {'pixel_size': params['dx'], 'wavelength': params['wavelength'], 'na': params['na']}
+
+    # settings of the original reconstruction
+    settings = {'wiener_parameter': params['wiener_parameter'], 'fbounds': params['fbounds'],
+                'fbounds_shift': params['fbounds_shift'], 'background_counts': params['background_counts'],
+                'normalize_histograms': params['normalize_histograms'],
+                'do_global_phase_correction': params['global_phase_correction'],
+                'size_near_fo_to_remove': params['size_near_fo_to_remove'],
+                # parameters saved before these settings existed used full FFTs in double precision
+                'use_rfft': params.get('use_rfft', False), 'precision': params.get('precision', 'double')}
+    settings.update(kwargs)
+
+    r = SimImageSet(options, imgs, params['frqs'], otf=params['otf'], phases_guess=params['phases'],
+                    pspec_params_guess=params['power_spectrum_params'], use_fixed_frq=True, use_fixed_phase=True,
+                    use_fixed_pspec_params=True, default_to_guess_on_low_mcnr=False, diagnostics=diagnostics,
+                    save_dir=save_dir, **settings)
+    r.reconstruct()
+    r.plot_figs()
+
+    return r
+
+# settings shared by all images processed in a reconstruction worker process
+_worker_settings = {}
+
+def _init_reconstruction_worker(channel_settings, kwargs, trace_memory=False):
+    _worker_settings['channel_settings'] = channel_settings
+    _worker_settings['kwargs'] = kwargs
+    _worker_settings['trace_memory'] = trace_memory
+
+def _reconstruct_frame_worker(channel_index, imgs, save_dir, widefield_only, profile_fields):
+    # profiling records are returned to the parent process, which collects them for the performance report
+    profiler = tools.Profiler(trace_memory=_worker_settings['trace_memory'], **profile_fields)
+    results, elapsed_time = reconstruct_sim_frame(_worker_settings['channel_settings'][channel_index], imgs, save_dir,
+                                                  widefield_only, profiler=profiler, **_worker_settings['kwargs'])
+    return results, elapsed_time, profiler.records
+
 class SimImageSet:
     def __init__(self, options, imgs, frq_sim_guess, otf=None,
                  wiener_parameter=1, fbounds=(0.01, 1), fbounds_shift=(0.01, 1),
-                 use_wicker=True, normalize_histograms=True, background_counts=100,
+                 use_wicker=True, use_fast_frq_fit=False, normalize_histograms=True, background_counts=100,
                  do_global_phase_correction=True, determine_amplitudes=False, find_frq_first=True,
                  default_to_guess_on_bad_phase_fit=True, max_phase_err=20*np.pi/180,
                  default_to_guess_on_low_mcnr=True, min_mcnr=1,
                  size_near_fo_to_remove=0,
                  phases_guess=None, mod_depths_guess=None, pspec_params_guess=None,
-                 use_fixed_phase=False, use_fixed_frq=False, use_fixed_mod_depths=False,
-                 plot_diagnostics=True, interactive_plotting=False, save_dir=None, figsize=(20, 10)):
+                 use_fixed_phase=False, use_fixed_frq=False, use_fixed_mod_depths=False, use_fixed_pspec_params=False,
+                 plot_diagnostics=True, diagnostics=None, interactive_plotting=False, save_dir=None, figsize=(20, 10),
+                 geometry=None, imgs_ft=None, use_rfft=False, precision="double", n_jobs=-1, profiler=None):
         """
         Class for reconstructing a single SIM image
 
@@ -405,12 +637,43 @@ class SimImageSet:
          If None, estimate from NA.
         :param wiener_parameter: Attenuation parameter for Wiener deconvolution. This will attenuate parts of the image
         where |otf(f)|^2 * SNR < wiener_parameter
-        :param plot_diagnostics: Boolean. If True, display figures to visually inspect output.
+        :param use_fast_frq_fit: if True, fit SIM frequencies using fit_modulation_frq_fast(), otherwise use
+        fit_modulation_frq()
+        :param normalize_histograms: True, False or "linear". How to normalize the images of each angle before
+        reconstruction, see preprocess_sim_imgs()
+        :param plot_diagnostics: Boolean. If True, display figures to visually inspect output. Only used if
+        diagnostics is None, in which case True corresponds to diagnostics="full" and False to diagnostics="summary"
+        :param diagnostics: "none", "summary", or "full". Controls which intermediate arrays are kept and which
+        figures plot_figs() generates. At "none", no intermediate arrays are kept and no figures are generated.
+        At "summary", the stacks of shifted components, SNR's and weights used when combining components are not kept,
+        and only figures which do not require them are generated. At "full", all intermediates are kept and all figures
+        are generated. Diagnostics can be recomputed later from the saved reconstruction parameters using
+        recompute_diagnostics()
         :param use_fixed_parameters: Boolean. Whether to do parameter fitting, or to use provided parameters.
         :param phases_guess: If use_fixed_parameters is True, these phases are used. Otherwise they are ignored.
         :param mod_depths_guess: If use_fixed_parameters is True, these modulation depths are used, otherwise they are ignored.
         :param pspec_params_guess: If use_fixed_parameters is True, these power spectrum fit parameters are used, otherwise
         they are ignored.
+        :param use_fixed_pspec_params: If True, use pspec_params_guess instead of fitting the power spectra of the
+        separated components. The modulation depths are taken from these parameters, and only the noise power is
+        re-estimated.
+        :param geometry: dictionary of frequency grids, OTF's and apodization as produced by
+        get_reconstruction_geometry(). These only depend on the image size and optical configuration, so when
+        reconstructing many images they should be computed once and passed here. If None, they will be computed.
+        :param imgs_ft: Fourier transforms of imgs, as produced by get_sim_imgs_ft(). If provided, imgs are assumed
+        to already have been normalized and background subtracted using preprocess_sim_imgs()
+        :param use_rfft: if True, store the Fourier transforms of the raw images as half-planes, which roughly halves
+        their memory use and FFT time. Full planes are computed only for the images currently being processed,
+        e.g. when separating components. If imgs_ft is provided, it must then be computed with
+        get_sim_imgs_ft(imgs, half_plane=True)
+        :param precision: "double" or "single". If "single", images and their Fourier transforms are stored as
+        float32/complex64, and FFT's, Wiener filtering, and shifting and weighting the components are done in single
+        precision. Frequency and phase fitting are still done in double precision.
+        :param n_jobs: number of joblib workers used when fitting SIM frequencies. Set to 1 when several images are
+        already being reconstructed in parallel.
+        :param profiler: analysis_tools.Profiler recording the wall time, CPU time and number of FFT's of each stage
+        of the reconstruction. If None, a new profiler is created, which writes its records to "sim_profile.jsonl"
+        in save_dir if save_dir is not None. Records are available from self.profiler.records
         """
         # #############################################
         # saving information
@@ -424,6 +687,15 @@ class SimImageSet:
         else:
             self.log_file = None
 
+        # profiler created here is closed with the log file. A profiler which was passed in is closed by its owner
+        self._owns_profiler = profiler is None
+        if profiler is None:
+            if self.save_dir is not None:
+                profiler = tools.Profiler(fname=os.path.join(self.save_dir, "sim_profile.jsonl"))
+            else:
+                profiler = tools.Profiler()
+        self.profiler = profiler
+
         # #############################################
         # setup plotting
         # #############################################
@@ -436,6 +708,7 @@ class SimImageSet:
         # #############################################
         self.wiener_parameter = wiener_parameter
         self.use_wicker = use_wicker
+        self.use_fast_frq_fit = use_fast_frq_fit
         self.global_phase_correction = do_global_phase_correction
         self.normalize_histograms = normalize_histograms
         self.size_near_fo_to_remove = size_near_fo_to_remove
@@ -447,16 +720,36 @@ class SimImageSet:
         self.use_fixed_phase = use_fixed_phase
         self.use_fixed_frq = use_fixed_frq
         self.use_fixed_mod_depths = use_fixed_mod_depths
+        self.use_fixed_pspec_params = use_fixed_pspec_params
         self.find_frq_first = find_frq_first
         self.plot_diagnostics = plot_diagnostics
 
+        if diagnostics is None:
+            diagnostics = "full" if plot_diagnostics else "summary"
+
+        if diagnostics not in ["none", "summary", "full"]:
+            raise ValueError("diagnostics must be 'none', 'summary', or 'full', but was '%s'" % diagnostics)
+        self.diagnostics = diagnostics
+        self.use_rfft = use_rfft
+
+        if precision == "double":
+            self.dtype_real = np.float64
+            self.dtype_complex = np.complex128
+        elif precision == "single":
+            self.dtype_real = np.float32
+            self.dtype_complex = np.complex64
+        else:
+            raise ValueError("precision must be 'double' or 'single', but was '%s'" % precision)
+        self.precision = precision
+        self.n_jobs = n_jobs
+
         # #############################################
         # images
         # #############################################
         self.background_counts = background_counts
-        self.imgs = imgs.astype(np.float64)
+        self.imgs = imgs.astype(self.dtype_real)
         self.nangles, self.nphases, self.ny, self.nx = imgs.shape
-        
+
         # #############################################
         # get basic parameters
         # #############################################
@@ -477,12 +770,24 @@ class SimImageSet:
         # #############################################
         # get frequency data and OTF
         # #############################################
-        self.fx = tools.get_fft_frqs(self.nx, self.dx)
-        self.fy = tools.get_fft_frqs(self.ny, self.dy)
-
-        if otf is None:
-            otf = psf.circ_aperture_otf(self.fx[None, :], self.fy[:, None], self.na, self.wavelength)
-        self.otf = otf
+        if geometry is None:
+            geometry = get_reconstruction_geometry(self.nx, self.ny, self.dx, self.na, self.wavelength, otf=otf)
+        elif geometry['otf'].shape != (self.ny, self.nx):
+            raise ValueError("geometry was computed for images of size %dx%d, but images are size %dx%d" %
+                             (geometry['otf'].shape + (self.ny, self.nx)))
+        self.geometry = geometry
+
+        self.fx = self.geometry['fx']
+        self.fy = self.geometry['fy']
+        self.otf = self.geometry['otf']
+
+        # x-frequencies of the stored raw image Fourier transforms
+        if self.use_rfft:
+            self.half_plane_nx = self.nx
+            self.fx_imgs_ft = self.geometry['fx_rft']
+        else:
+            self.half_plane_nx = None
+            self.fx_imgs_ft = self.fx
 
         # #############################################
         # print current time
@@ -493,71 +798,75 @@ class SimImageSet:
         self.print_tee("%d/%02d/%02d %02d:%02d:%02d" % (now.year, now.month, now.day, now.hour, now.minute, now.second), self.log_file)
         self.print_tee("####################################################################################", self.log_file)
 
-        # #############################################
-        # normalize histograms for input images
-        # #############################################
-        if self.normalize_histograms:
-            tstart = time.process_time()
+        if imgs_ft is None:
+            # #############################################
+            # normalize histograms and remove background
+            # #############################################
+            with self.profiler.span("preprocess") as span:
+                # use the raw images, since integer camera data allows faster histogram normalization
+                self.imgs = preprocess_sim_imgs(imgs, self.background_counts,
+                                                self.normalize_histograms).astype(self.dtype_real, copy=False)
 
-            for ii in range(self.nangles):
-                for jj in range(1, self.nphases):
-                    self.imgs[ii, jj] = match_histograms(self.imgs[ii, jj], self.imgs[ii, 0])
-
-            tend = time.process_time()
-            self.print_tee("Normalizing histograms took %0.2fs" % (tend - tstart), self.log_file)
+            self.print_tee("Normalizing histograms and removing background took %0.2fs" % span.wall_time, self.log_file)
 
-        # #############################################
-        # remove background
-        # #############################################
-        self.imgs = self.imgs - self.background_counts
-        self.imgs[self.imgs <= 0] = 1e-12
+            # #############################################
+            # Fourier transform SIM images
+            # #############################################
+            with self.profiler.span("ft") as span:
+                self.imgs_ft = get_sim_imgs_ft(self.imgs, half_plane=self.use_rfft)
 
-        # #############################################
-        # Fourier transform SIM images
-        # #############################################
-        tstart = time.process_time()
-
-        self.imgs_ft = np.zeros((self.nangles, self.nphases, self.ny, self.nx), dtype=np.complex)
-        for jj in range(self.nangles):
-            for kk in range(self.nphases):
-                # use periodic/smooth decomposition instead of traditional apodization
-                img_to_xform, _ = psd.periodic_smooth_decomp(self.imgs[jj, kk])
-                self.imgs_ft[jj, kk] = fft.fftshift(fft.fft2(fft.ifftshift(img_to_xform)))
-
-        tend = time.process_time()
+            self.print_tee("FT images took %0.2fs" % span.wall_time, self.log_file)
+        else:
+            if self.use_rfft:
+                shape_ft = (self.nangles, self.nphases, self.ny, self.nx // 2 + 1)
+            else:
+                shape_ft = self.imgs.shape
 
-        self.print_tee("FT images took %0.2fs" % (tend - tstart), self.log_file)
+            if imgs_ft.shape != shape_ft:
+                raise ValueError("imgs_ft had shape %s, but expected shape %s" % (imgs_ft.shape, shape_ft))
+            self.imgs_ft = imgs_ft.astype(self.dtype_complex, copy=False)
 
         # #############################################
         # get widefield image
         # #############################################
-        tstart = time.process_time()
-
-        self.widefield = get_widefield(self.imgs)
-        wf_to_xform, _ = psd.periodic_smooth_decomp(self.widefield)
-        self.widefield_ft = fft.fftshift(fft.fft2(fft.ifftshift(wf_to_xform)))
+        with self.profiler.span("widefield") as span:
+            self.widefield = get_widefield(self.imgs)
+            wf_to_xform = psd.periodic_component(self.widefield)
+            self.widefield_ft = tools.ft2(wf_to_xform.astype(self.dtype_real, copy=False))
 
-        tend = time.process_time()
-        self.print_tee("Computing widefield image took %0.2fs" % (tend - tstart), self.log_file)
+        self.print_tee("Computing widefield image took %0.2fs" % span.wall_time, self.log_file)
 
         # #############################################
         # get optically sectioned image
         # #############################################
-        tstart = time.process_time()
-
-        sim_os = np.zeros((self.nangles, self.imgs.shape[-2], self.imgs.shape[-1]))
-        for ii in range(self.nangles):
-            sim_os[ii] = sim_optical_section(self.imgs[ii])
-        # todo: maybe want to weight by power/mod depth?
-        self.imgs_os = np.mean(sim_os, axis=0)
+        with self.profiler.span("os") as span:
+            sim_os = np.zeros((self.nangles, self.imgs.shape[-2], self.imgs.shape[-1]))
+            for ii in range(self.nangles):
+                sim_os[ii] = sim_optical_section(self.imgs[ii])
+            # todo: maybe want to weight by power/mod depth?
+            self.imgs_os = np.mean(sim_os, axis=0)
 
-        tend = time.process_time()
-        self.print_tee("Computing OS image took %0.2fs" % (tend - tstart), self.log_file)
+        self.print_tee("Computing OS image took %0.2fs" % span.wall_time, self.log_file)
 
     def __del__(self):
         if self.log_file is not None:
             self.log_file.close()
 
+        if getattr(self, "_owns_profiler", False):
+            self.profiler.close()
+
+    def get_full_plane(self, imgs_ft):
+        """
+        Get full Fourier transforms of raw images, which are stored as half-planes if use_rfft is True
+
+        :param imgs_ft: array of size ... x ny x nx or ... x ny x (nx // 2 + 1)
+        :return imgs_ft_full: array of size ... x ny x nx
+        """
+        if imgs_ft.shape[-1] == self.nx:
+            return imgs_ft
+
+        return tools.expand_rft2(imgs_ft, self.nx)
+
     def reconstruct(self):
         """
         Handle SIM reconstruction, including parameter estimation, image combination, displaying useful information.
@@ -570,56 +879,70 @@ class SimImageSet:
         # estimate SIM parameters
         # #############################################
         # estimate frequencies
-        tstart = time.time()  # since done using joblib, process_time() is not useful...
-
-        if self.use_fixed_frq:
-            self.frqs = self.frqs_guess
-            self.print_tee("using fixed frequencies", self.log_file)
-        else:
-            if self.find_frq_first:
-                self.frqs = self.estimate_sim_frqs(self.imgs_ft, self.imgs_ft, self.frqs_guess)
+        # frequency fitting is done using joblib, so CPU time of this span does not include the worker processes
+        with self.profiler.span("frq_fit") as span:
+            if self.use_fixed_frq:
+                self.frqs = self.frqs_guess
+                self.print_tee("using fixed frequencies", self.log_file)
             else:
-                self.print_tee("doing phase demixing prior to frequency finding", self.log_file)
-                self.separated_components_ft = separate_components(self.imgs_ft, self.phases_guess, np.ones((self.nangles, self.nphases)))
-                imgs1 = np.expand_dims(self.separated_components_ft[:, 0], axis=1)
-                imgs2 = np.expand_dims(self.separated_components_ft[:, 1], axis=1)
-                self.frqs = self.estimate_sim_frqs(imgs1, imgs2, self.frqs_guess)
+                if self.find_frq_first:
+                    self.frqs = self.estimate_sim_frqs(self.imgs_ft, self.imgs_ft, self.frqs_guess)
+                else:
+                    self.print_tee("doing phase demixing prior to frequency finding", self.log_file)
+                    self.separated_components_ft = separate_components(self.imgs_ft, self.phases_guess, np.ones((self.nangles, self.nphases)),
+                                                                       half_plane_nx=self.half_plane_nx)
+                    imgs1 = np.expand_dims(self.separated_components_ft[:, 0], axis=1)
+                    imgs2 = np.expand_dims(self.separated_components_ft[:, 1], axis=1)
+                    self.frqs = self.estimate_sim_frqs(imgs1, imgs2, self.frqs_guess)
 
-        tend = time.time()
-        self.print_tee("fitting frequencies took %0.2fs" % (tend - tstart), self.log_file)
+        self.print_tee("fitting frequencies took %0.2fs" % span.wall_time, self.log_file)
 
         # estimate phases
-        tstart = time.process_time()
-        if self.use_fixed_phase:
-            self.phases = self.phases_guess
-            self.amps = np.ones((self.nangles, self.nphases))
-            self.print_tee("Using fixed phases", self.log_file)
-        else:
-            self.phases, self.amps = self.estimate_sim_phases(self.frqs, self.phases_guess)
+        with self.profiler.span("phase_fit") as span:
+            if self.use_fixed_phase:
+                self.phases = self.phases_guess
+                self.amps = np.ones((self.nangles, self.nphases))
+                self.print_tee("Using fixed phases", self.log_file)
+            else:
+                self.phases, self.amps = self.estimate_sim_phases(self.frqs, self.phases_guess)
 
-        tend = time.process_time()
-        self.print_tee("estimated %d phases in %0.2fs" % (self.nangles * self.nphases, tend - tstart), self.log_file)
+        self.print_tee("estimated %d phases in %0.2fs" % (self.nangles * self.nphases, span.wall_time), self.log_file)
 
         # separate components
-        self.separated_components_ft = separate_components(self.imgs_ft, self.phases, self.amps)
+        self.separated_components_ft = separate_components(self.imgs_ft, self.phases, self.amps,
+                                                           half_plane_nx=self.half_plane_nx)
 
         # estimate modulation depths and power spectrum fit parameters
-        tstart = time.process_time()
-        # for the moment, need to do this feet even if have fixed mod depth, because still need the
-        # power spectrum parameters
-        self.mod_depths, self.power_spectrum_params, self.pspec_masks = self.estimate_mod_depths()
+        with self.profiler.span("mod_depth") as span:
+            if self.use_fixed_pspec_params:
+                # noise power is cheap to estimate, so update it
+                self.power_spectrum_params = np.array(self.power_spectrum_params_guess, copy=True)
+                for ii in range(self.nangles):
+                    for jj in range(self.nphases):
+                        self.power_spectrum_params[ii, jj, -1] = get_noise_power(self.separated_components_ft[ii, jj],
+                                                                                 self.fx, self.fy, self.fmax)
 
-        if self.use_fixed_mod_depths:
-            self.mod_depths = np.zeros((self.nangles, self.nphases))
-            self.mod_depths[:, 0] = 1
-            for jj in range(1, self.nphases):
-                self.mod_depths[:, jj] = self.mod_depths_guess
+                self.mod_depths = np.array(self.power_spectrum_params[:, :, 2], copy=True)
+                self.mod_depths[:, 0] = 1
+                self.pspec_masks = None
+                self.print_tee("using fixed power spectrum parameters", self.log_file)
+            else:
+                # for the moment, need to do this feet even if have fixed mod depth, because still need the
+                # power spectrum parameters
+                self.mod_depths, self.power_spectrum_params, self.pspec_masks = self.estimate_mod_depths()
+                if self.diagnostics == "none":
+                    self.pspec_masks = None
+
+            if self.use_fixed_mod_depths:
+                self.mod_depths = np.zeros((self.nangles, self.nphases))
+                self.mod_depths[:, 0] = 1
+                for jj in range(1, self.nphases):
+                    self.mod_depths[:, jj] = self.mod_depths_guess
 
-                # also correct power spectrum params
-                self.power_spectrum_params[:, jj, 2] = self.mod_depths[:, jj]
+                    # also correct power spectrum params
+                    self.power_spectrum_params[:, jj, 2] = self.mod_depths[:, jj]
 
-        tend = time.process_time()
-        self.print_tee('estimated %d modulation depths in %0.2fs' % (self.nangles, tend - tstart), self.log_file)
+        self.print_tee('estimated %d modulation depths in %0.2fs' % (self.nangles, span.wall_time), self.log_file)
 
         # #############################################
         # estimate modulation contrast to noise ratio for raw images
@@ -627,7 +950,8 @@ class SimImageSet:
         mcnr = np.zeros((self.nangles, self.nphases))
         for ii in range(self.nangles):
             for jj in range(self.nphases):
-                mcnr[ii, jj] = get_mcnr(self.imgs_ft[ii, jj], self.frqs[ii], self.fx, self.fy, self.fmax)
+                mcnr[ii, jj] = get_mcnr(self.imgs_ft[ii, jj], self.frqs[ii], self.fx_imgs_ft, self.fy, self.fmax,
+                                        half_plane_nx=self.half_plane_nx)
 
             # if mcnr is too low (typically < 1), use guess values instead
             if self.default_to_guess_on_low_mcnr and np.min(mcnr[ii]) < self.min_mcnr and self.frqs_guess is not None:
@@ -637,7 +961,8 @@ class SimImageSet:
                           % (ii + 1, self.nangles, np.min(mcnr[ii]), self.min_mcnr), self.log_file)
 
                 for jj in range(self.nphases):
-                    mcnr[ii, jj] = get_mcnr(self.imgs_ft[ii, jj], self.frqs[ii], self.fx, self.fy, self.fmax)
+                    mcnr[ii, jj] = get_mcnr(self.imgs_ft[ii, jj], self.frqs[ii], self.fx_imgs_ft, self.fy, self.fmax,
+                                            half_plane_nx=self.half_plane_nx)
 
         self.mcnr = mcnr
         # for convenience, also save periods and angles
@@ -652,18 +977,39 @@ class SimImageSet:
         # #############################################
         # SIM reconstruction
         # #############################################
-        tstart = time.process_time()
-        self.img_sr, self.img_sr_ft, self.components_deconvolved_ft, self.components_shifted_ft, \
-        self.weights, self.weight_norm, self.snr, self.snr_shifted = self.combine_components()
-        # self.img_sr, self.img_sr_ft, self.components_deconvolved_ft, self.components_shifted_ft, \
-        #      self.weights, self.weight_norm, self.snr, self.snr_shifted = self.combine_components_fairSIM()
-        tend = time.process_time()
+        with self.profiler.span("combine") as span:
+            self.img_sr, self.img_sr_ft, self.components_deconvolved_ft, self.components_shifted_ft, \
+            self.weights, self.weight_norm, self.snr, self.snr_shifted = self.combine_components()
+            # self.img_sr, self.img_sr_ft, self.components_deconvolved_ft, self.components_shifted_ft, \
+            #      self.weights, self.weight_norm, self.snr, self.snr_shifted = self.combine_components_fairSIM()
 
-        self.print_tee("combining components took %0.2fs" % (tend - tstart), self.log_file)
+        self.print_tee("combining components took %0.2fs" % span.wall_time, self.log_file)
 
         # #############################################
         # widefield deconvolution
         # #############################################
+        with self.profiler.span("widefield_deconvolution"):
+            self.deconvolve_widefield()
+
+        # #############################################
+        # print parameters
+        # #############################################
+        self.print_parameters()
+
+        try:
+            self.log_file.close()
+        except AttributeError:
+            pass
+
+        if self._owns_profiler:
+            self.profiler.close()
+
+    def deconvolve_widefield(self):
+        """
+        Wiener deconvolve the widefield image, using the power spectrum exponent fit to the SIM components. The result
+        is upsampled to the size of the SIM reconstruction so the two can be compared directly.
+        :return:
+        """
         # get signal to noise ratio
         wf_noise = get_noise_power(self.widefield_ft, self.fx, self.fy, self.fmax)
         fit_result, self.mask_wf = fit_power_spectrum(self.widefield_ft, self.otf, self.fx, self.fy, self.fmax, self.fbounds,
@@ -671,25 +1017,17 @@ class SimImageSet:
                                                  fixed_params=[False, True, True, True])
 
         self.pspec_params_wf = fit_result['fit_params']
-        ff = np.sqrt(self.fx[None, :]**2 + self.fy[:, None]**2)
-        sig = power_spectrum_fn([self.pspec_params_wf[0], self.pspec_params_wf[1], self.pspec_params_wf[2], 0], ff, 1)
+        sig = power_spectrum_fn([self.pspec_params_wf[0], self.pspec_params_wf[1], self.pspec_params_wf[2], 0],
+                                self.geometry['ff'], 1)
         wf_snr = sig / wf_noise
         # deconvolution
-        wf_decon_ft, wfilter = wiener_deconvolution(self.widefield_ft, self.otf, wf_snr, snr_includes_otf=False)
+        wf_decon_ft, wfilter = wiener_deconvolution(self.widefield_ft, self.otf.astype(self.dtype_real),
+                                                    wf_snr.astype(self.dtype_real), snr_includes_otf=False)
 
         # upsample to make fully comparable to reconstructed image
-        self.widefield_deconvolution_ft = tools.expand_fourier_sp(wf_decon_ft, 2, 2, centered=True)
-        self.widefield_deconvolution = fft.fftshift(fft.ifft2(fft.ifftshift(self.widefield_deconvolution_ft))).real
-
-        # #############################################
-        # print parameters
-        # #############################################
-        self.print_parameters()
-
-        try:
-            self.log_file.close()
-        except AttributeError:
-            pass
+        self.widefield_deconvolution_ft = tools.expand_fourier_sp(wf_decon_ft, self.geometry['f_upsample'],
+                                                                  self.geometry['f_upsample'], centered=True)
+        self.widefield_deconvolution = tools.ift2(self.widefield_deconvolution_ft).real
 
     def combine_components_fairSIM(self):
         pass
@@ -697,6 +1035,11 @@ class SimImageSet:
     def combine_components(self):
         """
         Combine components O(f)otf(f), O(f-fo)otf(f), and O(f+fo)otf(f) to form SIM reconstruction.
+
+        All angles and components are processed together as stacks of size nangles x 3 x ny x nx. The upsampled
+        deconvolved components and shifted SNR's are only used for diagnostics, so they are only kept if
+        diagnostics is "full". The shifted components, SNR's and weights are needed to combine the components, but
+        are also only returned if diagnostics is "full". Otherwise None is returned in their place.
         :return:
         """
 
@@ -705,76 +1048,96 @@ class SimImageSet:
             raise ValueError("Expected shifted_components_ft to have shape (nangles, 3, ny, nx), where components are"
                             "O(f)*otf(f), O(f-fo)*otf(f), O(f+fo)*otf(f). But size of second dimension was not 3.")
 
-        # upsample image before shifting
-        f_upsample = 2
-        otf_us = tools.expand_fourier_sp(self.otf, mx=f_upsample, my=f_upsample, centered=True)
+        keep_diagnostics = self.diagnostics == "full"
 
-        # upsampled frequency data
-        fx_us = tools.get_fft_frqs(f_upsample * self.nx, self.dx / f_upsample)
+        # upsampled OTF and frequency data
+        f_upsample = self.geometry['f_upsample']
+        otf = self.otf.astype(self.dtype_real, copy=False)
+        otf_us = self.geometry['otf_us'].astype(self.dtype_real, copy=False)
+        apodization = self.geometry['apodization'].astype(self.dtype_real, copy=False)
+
+        fx_us = self.geometry['fx_us']
         dfx_us = fx_us[1] - fx_us[0]
-        fy_us = tools.get_fft_frqs(f_upsample * self.ny, self.dx / f_upsample)
+        fy_us = self.geometry['fy_us']
         dfy_us = fy_us[1] - fy_us[0]
-
-        def ff_shift(f): return np.sqrt((self.fx[None, :] - f[0]) ** 2 + (self.fy[:, None] - f[1]) ** 2)
-        def ff_shift_upsample(f): return np.sqrt((fx_us[None, :] - f[0]) ** 2 + (fy_us[:, None] - f[1]) ** 2)
-
+        _, _, ff_us = tools.get_frequency_grids(fx_us, fy_us, dtype=self.dtype_real)
+        ny_us, nx_us = ff_us.shape
+
+        # frequency shifts for components O(f)H(f), m*O(f - f_o)H(f), m*O(f + f_o)H(f). Size nangles x 3 x 2
+        shifts = np.array([0, 1, -1])[None, :, None] * self.frqs[:, None, :]
+
+        # power spectrum parameters, broadcast against the frequency grids. Size nangles x 3 x 1 x 1
+        amps, exponents, mods = [self.power_spectrum_params[..., ii, None, None] for ii in range(3)]
+        noise_power = self.noise_power[..., None, None]
+
+        # SNR of each component on the original frequency grid, where the components are not yet shifted
+        ff_shift = np.sqrt((self.fx - shifts[..., 0, None, None]) ** 2 + (self.fy[:, None] - shifts[..., 1, None, None]) ** 2)
+        snr = (power_spectrum_fn([amps, exponents, mods, 0], ff_shift, 1) / noise_power).astype(self.dtype_real)
+        del ff_shift
+
+        # #############################
+        # weights
+        # #############################
+        # shifted SNR, i.e. the SNR after moving each component to the correct place in frequency space
+        snr_shifted = power_spectrum_fn([amps.astype(self.dtype_real), exponents.astype(self.dtype_real),
+                                         mods.astype(self.dtype_real), 0], ff_us, 1)
+        snr_shifted /= noise_power.astype(self.dtype_real)
+
+        # shift upsampled OTF by the nearest number of pixels, as in tools.translate_pix(..., mode='no-wrap')
+        ix = np.arange(nx_us) + np.round(shifts[..., 0] / dfx_us).astype(int)[..., None]
+        iy = np.arange(ny_us) + np.round(shifts[..., 1] / dfy_us).astype(int)[..., None]
+        otf_shifted = otf_us[np.clip(iy, 0, ny_us - 1)[..., :, None], np.clip(ix, 0, nx_us - 1)[..., None, :]]
+        otf_shifted *= np.logical_and(np.logical_and(iy >= 0, iy < ny_us)[..., :, None],
+                                      np.logical_and(ix >= 0, ix < nx_us)[..., None, :])
+
+        weights = get_snr_weight(otf_shifted, snr_shifted)
+        del otf_shifted
+        if not keep_diagnostics:
+            snr_shifted = None
+
+        # #############################
+        # deconvolve, then shift
+        # #############################
         # wiener filter deconvolution to divide by H(k)
-        # components_deconvolved_ft = np.zeros((self.nangles, 3, self.ny, self.nx), dtype=np.complex)
-        components_deconvolved_ft = np.zeros((self.nangles, 3, self.ny * f_upsample, self.nx * f_upsample), dtype=np.complex)
-        snr = np.zeros((self.nangles, 3, self.ny, self.nx))
-        # shift to correct place in frq space
-        components_shifted_ft = np.zeros((self.nangles, 3, self.ny * f_upsample, self.nx * f_upsample), dtype=np.complex)
-        snr_shifted = np.zeros(components_shifted_ft.shape)
-        # weight and average
-        components_weighted = np.zeros(components_shifted_ft.shape, dtype=np.complex)
-        weights = np.zeros(components_weighted.shape)
-
-        # shift and filter components
-        for ii in range(self.nangles):
-            # loop over components, O(f)H(f), m*O(f - f_o)H(f), m*O(f + f_o)H(f)
-            for jj, eps in enumerate([0, 1, -1]):
-                params = list(self.power_spectrum_params[ii, jj, :-1]) + [0]
-                snr[ii, jj] = power_spectrum_fn(params, ff_shift(self.frqs[ii] * eps), 1) / self.noise_power[ii, jj]
-
-                # get shifted SNR
-                otf_shifted, _, _ = tools.translate_pix(otf_us, eps*self.frqs[ii], dx=dfx_us, dy=dfy_us, mode='no-wrap')
-                snr_shifted[ii, jj] = power_spectrum_fn(params, ff_shift_upsample((0, 0)), 1) / self.noise_power[ii, jj]
-
-                # weights
-                weights[ii, jj] = get_snr_weight(otf_shifted, snr_shifted[ii, jj])
-
-                if True:
-                    # deconvolve, then shift
-
-                    # deconvolve
-                    deconv_temp, _ = \
-                        wiener_deconvolution(self.separated_components_ft[ii, jj] / self.mod_depths[ii, jj], self.otf,
-                                             snr[ii, jj])
-
-                    components_deconvolved_ft[ii, jj] = tools.expand_fourier_sp(deconv_temp, mx=f_upsample, my=f_upsample, centered=True)
-
-                    # shift and expand
-                    components_shifted_ft[ii, jj] = tools.translate_ft(components_deconvolved_ft[ii, jj], eps * self.frqs[ii], self.dx / f_upsample)
-                else:
-                    # shift then deconvolve
-
-                    # shift and expand
-                    components_shifted_ft[ii, jj] = tools.translate_ft(
-                        tools.expand_fourier_sp(self.separated_components_ft[ii, jj], mx=f_upsample, my=f_upsample, centered=True),
-                        eps * self.frqs[ii], self.dc / f_upsample)
-
-                    # deconvolved
-                    components_shifted_ft[ii, jj], _ = \
-                        wiener_deconvolution(components_shifted_ft[ii, jj] / self.mod_depths[ii, jj], otf_shifted,
-                                             snr_shifted[ii, jj])
-
-                # optionally remove frequency data around modulation frequency, to avoid artifacts
-                if self.size_near_fo_to_remove != 0:
-                    to_remove = np.abs(ff_shift_upsample(-self.frqs[ii])) < self.size_near_fo_to_remove * np.linalg.norm(self.frqs[ii])
-                    components_shifted_ft[ii, jj][to_remove] = 0
-
-                    to_remove = np.abs(ff_shift_upsample(self.frqs[ii])) < self.size_near_fo_to_remove * np.linalg.norm(self.frqs[ii])
-                    components_shifted_ft[ii, jj][to_remove] = 0
+        components_deconvolved_ft, _ = wiener_deconvolution(
+            self.separated_components_ft / self.mod_depths[..., None, None].astype(self.dtype_real), otf, snr)
+
+        # zero pad to upsampled size
+        components_deconvolved_ft = tools.expand_fourier_sp(components_deconvolved_ft, mx=f_upsample, my=f_upsample,
+                                                            centered=True)
+
+        # shift to correct place in frq space using the FFT shift theorem, as in tools.translate_ft(). Do this for
+        # all components at once with one FFT pair. The phase factors from skipping the ifftshift before the inverse
+        # FFT and the fftshift after the forward FFT cancel, so the zero frequency stays centered
+        components_shifted_ft = tools.ift2(components_deconvolved_ft, centered=False)
+        if not keep_diagnostics:
+            components_deconvolved_ft = None
+
+        # phase ramp exp(-2*pi*i * shift_frq * r) is separable in x and y, so multiply in place
+        x_us = tools.get_fft_pos(nx_us, self.dx / f_upsample, centered=False, mode='symmetric')
+        y_us = tools.get_fft_pos(ny_us, self.dx / f_upsample, centered=False, mode='symmetric')
+        components_shifted_ft *= np.exp(-1j * 2 * np.pi * shifts[..., 0, None] * x_us).astype(self.dtype_complex)[..., None, :]
+        components_shifted_ft *= np.exp(-1j * 2 * np.pi * shifts[..., 1, None] * y_us).astype(self.dtype_complex)[..., :, None]
+
+        components_shifted_ft = tools.ft2(components_shifted_ft, centered=False)
+
+        # optionally remove frequency data around modulation frequency, to avoid artifacts
+        if self.size_near_fo_to_remove != 0:
+            fo_norms = np.linalg.norm(self.frqs, axis=1)[:, None, None]
+            to_remove = np.logical_or(
+                np.sqrt((fx_us + self.frqs[:, 0, None, None]) ** 2 + (fy_us[:, None] + self.frqs[:, 1, None, None]) ** 2) <
+                self.size_near_fo_to_remove * fo_norms,
+                np.sqrt((fx_us - self.frqs[:, 0, None, None]) ** 2 + (fy_us[:, None] - self.frqs[:, 1, None, None]) ** 2) <
+                self.size_near_fo_to_remove * fo_norms)
+
+            components_shifted_ft[np.broadcast_to(to_remove[:, None], components_shifted_ft.shape)] = 0
+
+        # components of angles which could not be separated are NaN (see separate_components()). Leave these out
+        # of the weighted sum and the normalization
+        valid = np.isfinite(components_shifted_ft).all(axis=(-2, -1))
+        if not np.all(valid):
+            components_shifted_ft[np.logical_not(valid)] = 0
+            weights[np.logical_not(valid)] = 0
 
         # correct for wrong global phases (on shifted components before weighting,
         # but then apply to weighted components)
@@ -783,21 +1146,21 @@ class SimImageSet:
         else:
             self.phase_corrections = np.zeros(self.nangles)
 
+        # #############################
         # combine components
-        components_weighted = components_shifted_ft * weights
-        for ii in range(self.nangles):
-            components_weighted[ii, 1] = np.exp(1j * self.phase_corrections[ii]) * components_weighted[ii, 1]
-            components_weighted[ii, 2] = np.exp(-1j * self.phase_corrections[ii]) * components_weighted[ii, 2]
-
-        # final averaging
+        # #############################
+        # weighted sum without forming the full stack of weighted components
+        phase_factors = np.exp(1j * np.array([0, 1, -1])[None, :] * self.phase_corrections[:, None]).astype(self.dtype_complex)
         weight_norm = np.sum(weights, axis=(0, 1)) + self.wiener_parameter
-        sim_sr_ft = np.nansum(components_weighted, axis=(0, 1)) / weight_norm
+        sim_sr_ft = np.einsum('ij,ijyx,ijyx->yx', phase_factors, components_shifted_ft, weights) / weight_norm
 
         # Fourier transform back to get real-space reconstructed image
-        apod = scipy.signal.windows.tukey(sim_sr_ft.shape[1], alpha=0.1)[None, :] * \
-               scipy.signal.windows.tukey(sim_sr_ft.shape[0], alpha=0.1)[:, None]
+        sim_sr = tools.ift2(sim_sr_ft * apodization).real
 
-        sim_sr = fft.fftshift(fft.ifft2(fft.ifftshift(sim_sr_ft * apod))).real
+        if not keep_diagnostics:
+            components_shifted_ft = None
+            weights = None
+            snr = None
 
         return sim_sr, sim_sr_ft, components_deconvolved_ft, components_shifted_ft,\
                weights, weight_norm, snr, snr_shifted
@@ -813,11 +1176,18 @@ class SimImageSet:
         """
         nangles = fts1.shape[0]
 
+        if self.use_fast_frq_fit:
+            fit_fn = fit_modulation_frq_fast
+        else:
+            fit_fn = fit_modulation_frq
+
         # todo: maybe should take some average/combination of the widefield images to try and improve signal
         # e.g. could multiply each by expected phase values?
-        results = joblib.Parallel(n_jobs=-1, verbose=10, timeout=None)(
-            joblib.delayed(fit_modulation_frq)(
-                fts1[ii, 0], fts2[ii, 0], self.dx, self.fmax, frq_guess=frq_guess[ii])
+        results = joblib.Parallel(n_jobs=self.n_jobs, verbose=10, timeout=None)(
+            joblib.delayed(fit_fn)(
+                self.get_full_plane(fts1[ii, 0]).astype(np.complex128, copy=False),
+                self.get_full_plane(fts2[ii, 0]).astype(np.complex128, copy=False), self.dx, self.fmax,
+                frq_guess=frq_guess[ii])
             for ii in range(nangles)
         )
 
@@ -843,7 +1213,8 @@ class SimImageSet:
                 phase_guess = [None] * self.nangles
 
             for ii in range(self.nangles):
-                phases[ii], amps[ii] = fit_phase_wicker(self.imgs_ft[ii], self.otf, frqs[ii], self.dx, self.fmax,
+                imgs_ft = self.get_full_plane(self.imgs_ft[ii]).astype(np.complex128, copy=False)
+                phases[ii], amps[ii] = fit_phase_wicker(imgs_ft, self.otf, frqs[ii], self.dx, self.fmax,
                                                         phases_guess=phase_guess[ii],
                                                         fit_amps=self.determine_amplitudes)
         else:
@@ -880,49 +1251,64 @@ class SimImageSet:
         return phases, amps
 
     def estimate_mod_depths(self):
-        # todo: this function is the slowest part of reconstruction right now
+        """
+        Estimate the modulation depths by fitting the power spectra of the separated components. Each spectrum is
+        first reduced to an azimuthally binned profile. The exponent is fit to the average unshifted component,
+        after which the remaining parameter of each component is linear in the model and is found in closed form.
 
-        # first average power spectrum of \sum_{angles} O(f)H(f) to get exponent
-        component_zero = np.nanmean(self.separated_components_ft[:, 0], axis=0)
-        noise = get_noise_power(component_zero, self.fx, self.fy, self.fmax)
+        :return mod_depths: array of size nangles x nphases
+        :return power_spectrum_params: array of size nangles x nphases x 4, see power_spectrum_fn()
+        :return masks: points used in fitting each component
+        """
+        if self.nphases != 3:
+            raise NotImplementedError("not implemented for nphases != 3")
 
-        fit_results_avg, mask_avg = fit_power_spectrum(component_zero, self.otf, self.fx, self.fy,
-                                                       self.fmax, self.fbounds,
-                                                       init_params=[None, None, 1, noise],
-                                                       fixed_params=[False, False, True, True])
-        fit_params_avg = fit_results_avg['fit_params']
-        exponent = fit_params_avg[1]
+        # bin labels for unshifted components, and for the shifted component of each angle
+        bins_unshifted = get_cached_power_spectrum_bins(self.geometry, self.fmax, self.fbounds)
+        bins_shifted = [get_cached_power_spectrum_bins(self.geometry, self.fmax, (0, 1), self.fbounds_shift,
+                                                       self.frqs[ii]) for ii in range(self.nangles)]
+
+        # profiles of the average of \sum_{angles} O(f)H(f), and of the unshifted and shifted components
+        component_zero = np.nanmean(self.separated_components_ft[:, 0], axis=0)
+        spectra = [component_zero] + [self.separated_components_ft[ii, jj]
+                                      for jj in range(2) for ii in range(self.nangles)]
+        bins = [bins_unshifted] * (self.nangles + 1) + bins_shifted
+        ps, fmag, otf, npts = bin_power_spectra(spectra, bins)
+
+        noise_avg = get_noise_power(component_zero, self.fx, self.fy, self.fmax)
+        noise = get_noise_power(self.separated_components_ft[:, :2], self.fx, self.fy, self.fmax)
+
+        # first fit exponent from average power spectrum
+        amp_guess = np.sqrt(fit_power_spectrum_scale(ps[:1], fmag[:1], otf[:1], npts[:1], 0.5, noise_avg)[0])
+        with np.errstate(divide="ignore"):
+            sd = 1 / np.sqrt(npts[0])
+        fit_results_avg = fit.fit_model(ps[0], lambda p: power_spectrum_fn(p, fmag[0], otf[0]),
+                                        [amp_guess, 0.5, 1, noise_avg], fixed_params=[False, False, True, True],
+                                        sd=sd, bounds=((0, 0, 0, 0), (np.inf, 1.25, 1, np.inf)),
+                                        model_jacobian=lambda p: power_spectrum_jacobian(p, fmag[0], otf[0]))
+        exponent = fit_results_avg['fit_params'][1]
 
         # now fit each other component using this same exponent
-        power_spectrum_params = np.zeros((self.nangles, self.nangles, 4))
+        scales = fit_power_spectrum_scale(ps[1:], fmag[1:], otf[1:], npts[1:], exponent,
+                                          noise.transpose().ravel()).reshape((2, self.nangles))
+
+        # for unshifted components, fit the amplitude. For shifted components, fit the modulation factor
+        amps = np.sqrt(scales[0])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mods = np.clip(np.sqrt(scales[1]) / amps, 0, 1)
+
+        power_spectrum_params = np.zeros((self.nangles, self.nphases, 4))
+        power_spectrum_params[:, :, 0] = amps[:, None]
+        power_spectrum_params[:, :, 1] = exponent
+        power_spectrum_params[:, 0, 2] = 1
+        power_spectrum_params[:, 1:, 2] = mods[:, None]
+        power_spectrum_params[:, 0, 3] = noise[:, 0]
+        power_spectrum_params[:, 1:, 3] = noise[:, 1, None]
+
         masks = np.zeros(self.separated_components_ft.shape, dtype=np.bool)
+        masks[:, 0] = bins_unshifted["mask"]
         for ii in range(self.nangles):
-            for jj in range(self.nphases):
-                noise = get_noise_power(self.separated_components_ft[ii, jj], self.fx, self.fy, self.fmax)
-
-                if jj == 0:
-                    # for unshifted components, fit the amplitude
-                    init_params = [None, exponent, 1, noise]
-                    fixed_params = [False, True, True, True]
-
-                    fit_results, masks[ii, jj] = fit_power_spectrum(self.separated_components_ft[ii, jj], self.otf,
-                                                           self.fx, self.fy, self.fmax, self.fbounds,
-                                                           init_params=init_params, fixed_params=fixed_params)
-                    power_spectrum_params[ii, jj] = fit_results['fit_params']
-                elif jj == 1:
-                    # for shifted components, fit the modulation factor
-                    init_params = [power_spectrum_params[ii, 0, 0], exponent, 0.5, noise]
-                    fixed_params = [True, True, False, True]
-
-                    fit_results, masks[ii, jj] = fit_power_spectrum(self.separated_components_ft[ii, jj], self.otf,
-                                                           self.fx, self.fy, self.fmax, (0, 1), self.fbounds_shift,
-                                                           self.frqs[ii],
-                                                           init_params=init_params, fixed_params=fixed_params)
-                    power_spectrum_params[ii, jj] = fit_results['fit_params']
-                elif jj == 2:
-                    power_spectrum_params[ii, jj] = power_spectrum_params[ii, 1]
-                else:
-                    raise NotImplementedError("not implemented for nphases > 3")
+            masks[ii, 1] = bins_shifted[ii]["mask"]
 
         # extract mod depths from the structure
         mod_depths = np.zeros((self.nangles, self.nphases))
@@ -1011,9 +1397,13 @@ class SimImageSet:
     # plotting utility functions
     def plot_figs(self):
         """
-        Automate plotting and saving of figures
+        Automate plotting and saving of figures. Which figures are generated depends on the diagnostics level. If it
+        is "none", no figures are generated.
         :return:
         """
+        if self.diagnostics == "none":
+            return [], []
+
         tstart = time.process_time()
 
         saving = self.save_dir is not None
@@ -1056,13 +1446,14 @@ class SimImageSet:
         if not self.hold_figs_open:
             plt.close(figh)
 
-        # plot filters used in reconstruction
-        fighs, fig_names = self.plot_reconstruction_diagnostics(figsize=self.figsize)
-        for fh, fn in zip(fighs, fig_names):
-            if saving:
-                fh.savefig(os.path.join(self.save_dir, "%s.png" % fn))
-            if not self.hold_figs_open:
-                plt.close(fh)
+        # plot filters used in reconstruction. These require the intermediates which are only kept for full diagnostics
+        if self.diagnostics == "full":
+            fighs, fig_names = self.plot_reconstruction_diagnostics(figsize=self.figsize)
+            for fh, fn in zip(fighs, fig_names):
+                if saving:
+                    fh.savefig(os.path.join(self.save_dir, "%s.png" % fn))
+                if not self.hold_figs_open:
+                    plt.close(fh)
 
         # plot reconstruction results
         fig = self.plot_reconstruction(figsize=self.figsize)
@@ -1137,7 +1528,7 @@ class SimImageSet:
                 # plot power spectra
                 ax = plt.subplot(grid[jj, 2*ii + 1])
 
-                ax.imshow(np.abs(self.imgs_ft[ii, jj]) ** 2, norm=PowerNorm(gamma=gamma), extent=extent_ft)
+                ax.imshow(np.abs(self.get_full_plane(self.imgs_ft[ii, jj])) ** 2, norm=PowerNorm(gamma=gamma), extent=extent_ft)
                 circ = matplotlib.patches.Circle((0, 0), radius=self.fmax, color='k', fill=0, ls='--')
                 ax.add_artist(circ)
 
@@ -1376,7 +1767,9 @@ class SimImageSet:
                 # ####################
                 ax = plt.subplot(grid[jj, 1])
 
-                plt.imshow(np.abs(self.components_deconvolved_ft[ii, jj]), norm=LogNorm(), extent=extent)
+                # only stored if diagnostics was "full" during reconstruction
+                if self.components_deconvolved_ft is not None:
+                    plt.imshow(np.abs(self.components_deconvolved_ft[ii, jj]), norm=LogNorm(), extent=extent)
 
                 if jj == 0:
                     plt.scatter(self.frqs[ii, 0], self.frqs[ii, 1], edgecolor='r', facecolor='none')
@@ -1554,18 +1947,25 @@ class SimImageSet:
 
         debug_figs = []
         debug_fig_names = []
+
+        # no fit masks if power spectrum parameters were fixed
+        if self.pspec_masks is None:
+            masks = np.full((self.nangles, self.nphases), None)
+        else:
+            masks = self.pspec_masks
+
         # individual power spectra
         for ii in range(self.nangles):
             fig = plot_power_spectrum_fit(self.separated_components_ft[ii, 0], self.otf,
                                           {'pixel_size': self.dx, 'wavelength': self.wavelength, 'na': self.na},
-                                          self.power_spectrum_params[ii, 0], frq_sim=(0, 0), mask=self.pspec_masks[ii, 0],
+                                          self.power_spectrum_params[ii, 0], frq_sim=(0, 0), mask=masks[ii, 0],
                                           figsize=figsize, ttl_str="Unshifted component, angle %d" % ii)
             debug_figs.append(fig)
             debug_fig_names.append("power_spectrum_unshifted_component_angle=%d" % ii)
 
             fig = plot_power_spectrum_fit(self.separated_components_ft[ii, 1], self.otf,
                                           {'pixel_size': self.dx, 'wavelength': self.wavelength, 'na': self.na},
-                                          self.power_spectrum_params[ii, 1], frq_sim=self.frqs[ii], mask=self.pspec_masks[ii, 1],
+                                          self.power_spectrum_params[ii, 1], frq_sim=self.frqs[ii], mask=masks[ii, 1],
                                           figsize=figsize, ttl_str="Shifted component, angle %d" % ii)
 
             debug_figs.append(fig)
@@ -1585,7 +1985,8 @@ class SimImageSet:
         for ii in range(self.nangles):
 
             if self.find_frq_first:
-                figh = plot_correlation_fit(self.imgs_ft[ii, 0], self.imgs_ft[ii, 0], self.frqs[ii, :],
+                img_ft = self.get_full_plane(self.imgs_ft[ii, 0])
+                figh = plot_correlation_fit(img_ft, img_ft, self.frqs[ii, :],
                                             self.dx, self.fmax,
                                             frqs_guess=self.frqs_guess[ii], figsize=figsize,
                                             ttl_str="Correlation fit, angle %d" % ii)
@@ -1657,7 +2058,7 @@ class SimImageSet:
                               'snr', 'snr_shifted', 'weight_norm',
                               'img_sr', 'img_sr_ft', 'log_file',
                               'mask_wf',
-                              'pspec_masks']
+                              'pspec_masks', 'geometry', 'profiler']
         # get dictionary object with images removed
         results_dict = {}
         for k, v in vars(self).items():
@@ -1675,6 +2076,441 @@ class SimImageSet:
 
         return results_dict
 
+class SimImageSeries:
+    def __init__(self, options, imgs, frq_sim_guess, otf=None, background_counts=100, normalize_histograms=True,
+                 batch_size=10, save_dir=None, parameter_tracking=None, **kwargs):
+        """
+        Reconstruct a series of SIM images which share the same optical configuration, e.g. a time series or z-stack.
+
+        Arrays which only depend on the image geometry (frequency grids, OTF, upsampled OTF, apodization) are computed
+        once and shared between all frames, and the raw images are preprocessed and Fourier transformed for batches of
+        frames at a time. The remaining steps depend on the SIM parameters fit for each frame, so each frame is then
+        reconstructed separately using SimImageSet, which separates, shifts and combines the components of all angles
+        and phases at once.
+
+        :param options: {'pixel_size', 'na', 'wavelength'}. Pixel size and wavelength in um
+        :param imgs: nframes x nangles x nphases x ny x nx
+        :param frq_sim_guess: nangles x 2 array of guess SIM frequency values
+        :param otf: optical transfer function. If None, estimate from NA.
+        :param background_counts: background counts to subtract from each image
+        :param normalize_histograms: whether to normalize the histograms of images with the same angle. True, False or
+        "linear", see preprocess_sim_imgs()
+        :param batch_size: number of frames to preprocess and Fourier transform at once
+        :param save_dir: if not None, diagnostic information for frame ii is saved in save_dir/frame=ii
+        :param parameter_tracking: if not None, a dictionary of keyword arguments for SimParameterTracker. Then SIM
+        parameters are only fully fit on reference frames and reused for the other frames.
+        :param kwargs: passed through to SimImageSet
+        """
+        if imgs.ndim != 5:
+            raise ValueError("imgs must have shape nframes x nangles x nphases x ny x nx, but had %d dimensions" %
+                             imgs.ndim)
+
+        self.imgs = imgs
+        self.nframes, self.nangles, self.nphases, self.ny, self.nx = imgs.shape
+        self.options = options
+        self.frqs_guess = frq_sim_guess
+        self.background_counts = background_counts
+        self.normalize_histograms = normalize_histograms
+        self.batch_size = batch_size
+        self.save_dir = save_dir
+        self.parameter_tracking = parameter_tracking
+        self.kwargs = kwargs
+
+        self.geometry = get_reconstruction_geometry(self.nx, self.ny, options['pixel_size'], options['na'],
+                                                    options['wavelength'], otf=otf)
+
+    def reconstruct(self, plot_figs=False):
+        """
+        Reconstruct all frames
+
+        :param plot_figs: if True, plot and save diagnostic figures for each frame
+        :return:
+        """
+        f_upsample = self.geometry['f_upsample']
+
+        self.imgs_sr = np.zeros((self.nframes, f_upsample * self.ny, f_upsample * self.nx))
+        self.widefield_deconvolution = np.zeros(self.imgs_sr.shape)
+        self.widefield = np.zeros((self.nframes, self.ny, self.nx))
+        self.imgs_os = np.zeros(self.widefield.shape)
+
+        self.frqs = np.zeros((self.nframes, self.nangles, 2))
+        self.phases = np.zeros((self.nframes, self.nangles, self.nphases))
+        self.mod_depths = np.zeros((self.nframes, self.nangles, self.nphases))
+        self.mcnr = np.zeros((self.nframes, self.nangles, self.nphases))
+        self.parameters_fit = np.ones(self.nframes, dtype=bool)
+
+        if self.parameter_tracking is not None:
+            self.parameter_tracker = SimParameterTracker(**self.parameter_tracking)
+        else:
+            self.parameter_tracker = None
+
+        for start in range(0, self.nframes, self.batch_size):
+            stop = min(start + self.batch_size, self.nframes)
+
+            imgs_batch = preprocess_sim_imgs(self.imgs[start:stop], self.background_counts, self.normalize_histograms)
+            if self.kwargs.get('precision', 'double') == 'single':
+                imgs_batch = imgs_batch.astype(np.float32)
+            imgs_ft_batch = get_sim_imgs_ft(imgs_batch, half_plane=self.kwargs.get('use_rfft', False))
+
+            for ii in range(stop - start):
+                frame = start + ii
+
+                if self.save_dir is not None:
+                    frame_dir = os.path.join(self.save_dir, "frame=%d" % frame)
+                    if not os.path.exists(frame_dir):
+                        os.mkdir(frame_dir)
+                else:
+                    frame_dir = None
+
+                r = SimImageSet(self.options, imgs_batch[ii], self.frqs_guess, background_counts=self.background_counts,
+                                normalize_histograms=self.normalize_histograms, save_dir=frame_dir,
+                                geometry=self.geometry, imgs_ft=imgs_ft_batch[ii], **self.kwargs)
+
+                if self.parameter_tracker is not None:
+                    self.parameters_fit[frame] = self.parameter_tracker.prepare(r)
+
+                r.reconstruct()
+
+                if self.parameter_tracker is not None:
+                    self.parameter_tracker.update(r)
+
+                if plot_figs:
+                    r.plot_figs()
+
+                if frame_dir is not None:
+                    r.save_result(os.path.join(frame_dir, "sim_reconstruction_params.pkl"))
+
+                self.imgs_sr[frame] = r.img_sr
+                self.widefield_deconvolution[frame] = r.widefield_deconvolution
+                self.widefield[frame] = r.widefield
+                self.imgs_os[frame] = r.imgs_os
+                self.frqs[frame] = r.frqs
+                self.phases[frame] = r.phases
+                self.mod_depths[frame] = r.mod_depths
+                self.mcnr[frame] = r.mcnr
+
+class SimParameterTracker:
+    def __init__(self, refit_every=None, max_phase_drift=15 * np.pi / 180, min_mcnr_ratio=0.5):
+        """
+        Track SIM parameters across the frames of a time series or z-stack, so that the expensive parameter estimation
+        is only done on reference frames.
+
+        The first frame is fully fit. Later frames reuse the frequencies, phases and power spectrum parameters of the
+        last fit frame. Before reusing them, the phases of the Fourier peaks at the reference frequencies are measured,
+        which is cheap. Phase drift which is common to all phases of an angle is followed. A full fit is triggered if
+        the relative phases drift by more than max_phase_drift, or if the modulation contrast to noise ratio drops
+        below min_mcnr_ratio times its value in the reference frame.
+
+        :param refit_every: if not None, do a full fit at least every refit_every frames
+        :param max_phase_drift: maximum allowed change in relative phase before refitting, in radians
+        :param min_mcnr_ratio: minimum allowed ratio of the mcnr to the mcnr of the reference frame before refitting
+        """
+        self.refit_every = refit_every
+        self.max_phase_drift = max_phase_drift
+        self.min_mcnr_ratio = min_mcnr_ratio
+
+        self.reference = None
+        self.frames_since_fit = 0
+        self.nfits = 0
+        self.fitting = True
+
+    def measure_peaks(self, r, frqs):
+        """
+        Measure the phase and modulation contrast to noise ratio of the Fourier peak at the given frequencies
+
+        :param r: SimImageSet
+        :param frqs: nangles x 2
+        :return peak_phases: nangles x nphases
+        :return mcnr: nangles x nphases
+        """
+        peak_phases = np.zeros((r.nangles, r.nphases))
+        mcnr = np.zeros((r.nangles, r.nphases))
+        for ii in range(r.nangles):
+            for jj in range(r.nphases):
+                peak_phases[ii, jj] = np.angle(get_peak_value_ft(r.imgs_ft[ii, jj], r.fx_imgs_ft, r.fy, frqs[ii], 2,
+                                                                 half_plane_nx=r.half_plane_nx))
+                mcnr[ii, jj] = get_mcnr(r.imgs_ft[ii, jj], frqs[ii], r.fx_imgs_ft, r.fy, r.fmax,
+                                        half_plane_nx=r.half_plane_nx)
+
+        return peak_phases, mcnr
+
+    def prepare(self, r):
+        """
+        Decide if a frame needs a full parameter fit. If not, set up the SimImageSet to use the tracked parameters.
+        Must be called before r.reconstruct()
+
+        :param r: SimImageSet
+        :return fitting: True if the parameters of this frame will be fully fit
+        """
+        self.fitting = self.reference is None or \
+                       (self.refit_every is not None and self.frames_since_fit >= self.refit_every)
+
+        if not self.fitting:
+            peak_phases, mcnr = self.measure_peaks(r, self.reference['frqs'])
+
+            dphis = np.angle(np.exp(1j * (peak_phases - self.reference['peak_phases'])))
+            relative_drift = np.angle(np.exp(1j * (dphis - dphis[:, 0][:, None])))
+            mcnr_ratio = np.min(mcnr / self.reference['mcnr'])
+
+            if np.max(np.abs(relative_drift)) > self.max_phase_drift or mcnr_ratio < self.min_mcnr_ratio:
+                self.fitting = True
+                r.print_tee("maximum relative phase drift=%0.2fdeg and minimum mcnr ratio=%0.2f,"
+                            " so refitting parameters" % (np.max(np.abs(relative_drift)) * 180 / np.pi, mcnr_ratio),
+                            r.log_file)
+            else:
+                r.frqs_guess = np.array(self.reference['frqs'], copy=True)
+                r.use_fixed_frq = True
+                r.phases_guess = self.reference['phases'] + dphis[:, 0][:, None]
+                r.use_fixed_phase = True
+                r.power_spectrum_params_guess = self.reference['power_spectrum_params']
+                r.use_fixed_pspec_params = True
+
+        return self.fitting
+
+    def update(self, r):
+        """
+        Store parameters from a frame which was fully fit. Must be called after r.reconstruct()
+
+        :param r: SimImageSet
+        :return:
+        """
+        if self.fitting:
+            peak_phases, _ = self.measure_peaks(r, r.frqs)
+
+            self.reference = {'frqs': np.array(r.frqs, copy=True),
+                              'phases': np.array(r.phases, copy=True),
+                              'power_spectrum_params': np.array(r.power_spectrum_params, copy=True),
+                              'peak_phases': peak_phases,
+                              'mcnr': np.array(r.mcnr, copy=True)}
+            self.frames_since_fit = 1
+            self.nfits += 1
+        else:
+            self.frames_since_fit += 1
+
+class SimResultWriter:
+    def __init__(self, save_dir, stack_shape=None, start_time=None, max_queue_size=2):
+        """
+        Save reconstructed images in a background thread as soon as they are produced, so they do not need to be held
+        in memory.
+
+        :param save_dir: directory to save results in
+        :param stack_shape: (ncolors, ntimes, nz). If not None, each type of result is written into a memory mapped
+        ImageJ hyperstack, e.g. sim_sr.tif, as soon as it is available. If None, each image is saved in its own file
+        :param start_time: datetime stored in the tiff files
+        :param max_queue_size: maximum number of results waiting to be written. If the queue is full, write()
+        blocks, which bounds the memory used
+        """
+        self.save_dir = save_dir
+        self.stack_shape = stack_shape
+        self.start_time = start_time
+        self.stacks = {}
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, index, file_identifier, results):
+        """
+        Queue results for one set of SIM images to be written
+
+        :param index: (color index, time index, z index) in the stack. Only used if stack_shape is not None
+        :param file_identifier: string identifying these images. Only used if stack_shape is None
+        :param results: dictionary of images, e.g. {'widefield': img_wf, 'sim_sr': img_sr}
+        :return:
+        """
+        if self._error is not None:
+            raise self._error
+
+        self._queue.put((index, file_identifier, results))
+
+    def close(self):
+        """
+        Wait for all queued results to be written and flush them to disk
+        :return:
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+        for v in self.stacks.values():
+            v.flush()
+
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            # keep consuming after an error so producer does not block
+            if self._error is not None:
+                continue
+
+            try:
+                self._write_item(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write_item(self, index, file_identifier, results):
+        for name, img in results.items():
+            if self.stack_shape is None:
+                fname = os.path.join(self.save_dir, "%s_%s.tif" % (name, file_identifier))
+                tools.save_tiff(img, fname, dtype='float32', datetime=self.start_time)
+            else:
+                if name not in self.stacks:
+                    fname = tools.get_unique_name(os.path.join(self.save_dir, "%s.tif" % name))
+                    self.stacks[name] = tools.save_tiff_memmap(fname, tuple(self.stack_shape) + img.shape,
+                                                               dtype='float32', axes_order='CTZYX',
+                                                               datetime=self.start_time)
+                self.stacks[name][tuple(index)] = img
+
+# geometry and preprocessing shared between frames
+def get_reconstruction_geometry(nx, ny, dx, na, wavelength, otf=None, f_upsample=2):
+    """
+    Compute the arrays used during reconstruction which only depend on the image size and optical configuration.
+    When reconstructing many images with the same settings, compute these once and share them.
+
+    :param nx: number of pixels along x
+    :param ny: number of pixels along y
+    :param dx: pixel size in um
+    :param na: numerical aperture
+    :param wavelength: emission wavelength in um
+    :param otf: optical transfer function of size ny x nx. If None, estimate from the NA.
+    :param f_upsample: factor to upsample the reconstructed image by
+    :return geometry: dictionary with entries 'fx', 'fy', 'ff', 'otf', 'f_upsample', 'fx_us', 'fy_us', 'ff_us',
+    'otf_us' and 'apodization'. 'fx_rft' are the x-frequencies of half-plane Fourier transforms computed with
+    tools.rft2()
+    """
+    fx = tools.get_fft_frqs(nx, dx)
+    fx_rft = fft.rfftfreq(nx, dx)
+    fy = tools.get_fft_frqs(ny, dx)
+    _, _, ff = tools.get_frequency_grids(fx, fy)
+
+    if otf is None:
+        otf = psf.circ_aperture_otf(fx[None, :], fy[:, None], na, wavelength)
+
+    if otf.shape != (ny, nx):
+        raise ValueError("otf must have shape (%d, %d), but had shape %s" % (ny, nx, otf.shape))
+
+    # upsampled frequency data
+    fx_us = tools.get_fft_frqs(f_upsample * nx, dx / f_upsample)
+    fy_us = tools.get_fft_frqs(f_upsample * ny, dx / f_upsample)
+    _, _, ff_us = tools.get_frequency_grids(fx_us, fy_us)
+    otf_us = tools.expand_fourier_sp(otf, mx=f_upsample, my=f_upsample, centered=True)
+
+    # apodization applied before transforming the reconstruction back to real space
+    apodization = scipy.signal.windows.tukey(f_upsample * nx, alpha=0.1)[None, :] * \
+                  scipy.signal.windows.tukey(f_upsample * ny, alpha=0.1)[:, None]
+
+    geometry = {'fx': fx, 'fy': fy, 'ff': ff, 'otf': otf, 'fx_rft': fx_rft,
+                'f_upsample': f_upsample, 'fx_us': fx_us, 'fy_us': fy_us, 'ff_us': ff_us, 'otf_us': otf_us,
+                'apodization': apodization}
+
+    return geometry
+
+def preprocess_sim_imgs(imgs, background_counts=100, normalize_histograms=True):
+    """
+    Normalize histograms of images with the same angle and subtract background
+
+    :param imgs: array of size ... x nangles x nphases x ny x nx
+    :param background_counts: background to subtract
+    :param normalize_histograms: if True, match the histograms of each phase to the first phase of the same angle.
+    For integer images with values less than 2^16, such as raw camera data, this is done with lookup tables built
+    from the image counts, which gives the same result as skimage.exposure.match_histograms() but is much faster.
+    If "linear", only match the mean and variance of each phase to the first phase of the same angle. If False,
+    do not normalize.
+    :return imgs_processed: array of the same size as imgs
+    """
+    if not (normalize_histograms == "linear" or normalize_histograms is True or normalize_histograms is False or
+            isinstance(normalize_histograms, np.bool_)):
+        raise ValueError("normalize_histograms must be True, False, or 'linear', but was '%s'" % normalize_histograms)
+
+    imgs_raw = np.asarray(imgs)
+    imgs = np.array(imgs_raw, dtype=np.float64)
+    nangles, nphases = imgs.shape[-4:-2]
+
+    if normalize_histograms == "linear":
+        means = np.mean(imgs, axis=(-2, -1), keepdims=True)
+        sds = np.std(imgs, axis=(-2, -1), keepdims=True)
+        imgs -= means
+        imgs *= sds[..., :1, :, :] / sds
+        imgs += means[..., :1, :, :]
+
+    elif normalize_histograms:
+        use_lut = imgs_raw.dtype.kind in "ui" and imgs_raw.size > 0 and \
+                  np.min(imgs_raw) >= 0 and np.max(imgs_raw) < 2**16
+
+        imgs_temp = imgs.reshape((-1, nangles, nphases) + imgs.shape[-2:])
+        if use_lut:
+            imgs_raw_temp = imgs_raw.reshape(imgs_temp.shape)
+
+        for ff in range(len(imgs_temp)):
+            for ii in range(nangles):
+                if use_lut:
+                    imgs_temp[ff, ii, 1:] = match_histograms_lut(imgs_raw_temp[ff, ii, 1:], imgs_raw_temp[ff, ii, 0])
+                else:
+                    for jj in range(1, nphases):
+                        imgs_temp[ff, ii, jj] = match_histograms(imgs_temp[ff, ii, jj], imgs_temp[ff, ii, 0])
+
+    imgs -= background_counts
+    imgs[imgs <= 0] = 1e-12
+
+    return imgs
+
+def match_histograms_lut(imgs, reference):
+    """
+    Match the histograms of non-negative integer images to a reference image. This gives the same result as
+    skimage.exposure.match_histograms(), but instead of sorting each image the counts of each value are found with
+    np.bincount(), and all images are mapped through their lookup tables in one step.
+
+    :param imgs: non-negative integer array of size n x ny x nx
+    :param reference: non-negative integer array of size ny x nx
+    :return imgs_matched: float array of size n x ny x nx
+    """
+    imgs = np.asarray(imgs)
+    reference = np.asarray(reference)
+    nimgs = imgs.shape[0]
+    nvals = int(max(np.max(imgs), np.max(reference))) + 1
+
+    # quantiles of the values present in the reference image
+    ref_counts = np.bincount(reference.ravel(), minlength=nvals)
+    ref_values = np.flatnonzero(ref_counts)
+    ref_quantiles = np.cumsum(ref_counts[ref_values]) / reference.size
+
+    # lookup table mapping each value present in an image to the reference value at the same quantile
+    luts = np.zeros((nimgs, nvals))
+    for ii in range(nimgs):
+        counts = np.bincount(imgs[ii].ravel(), minlength=nvals)
+        values = np.flatnonzero(counts)
+        quantiles = np.cumsum(counts[values]) / imgs[ii].size
+        luts[ii, values] = np.interp(quantiles, ref_quantiles, ref_values)
+
+    imgs_matched = luts[np.arange(nimgs)[:, None, None], imgs]
+
+    return imgs_matched
+
+def get_sim_imgs_ft(imgs, half_plane=False):
+    """
+    Fourier transform SIM images, using the periodic/smooth decomposition instead of traditional apodization
+
+    :param imgs: array of size ... x ny x nx
+    :param half_plane: if True, only compute the non-negative x-frequencies using tools.rft2(). Since the images are
+    real, the other frequencies can be recovered using tools.expand_rft2()
+    :return imgs_ft: Fourier transforms, with zero frequency in the center. If half_plane is True, the array has size
+    ... x ny x (nx // 2 + 1)
+    """
+    # single precision images are transformed in single precision
+    imgs_periodic = psd.periodic_component(np.asarray(imgs))
+
+    if half_plane:
+        imgs_ft = tools.rft2(imgs_periodic)
+    else:
+        imgs_ft = tools.ft2(imgs_periodic, axes=(-1, -2))
+
+    return imgs_ft
+
 # compute widefield image
 def get_widefield(imgs):
     """
@@ -1783,15 +2619,15 @@ def fit_modulation_frq(ft1, ft2, dx, fmax=None, exclude_res=0.7, frq_guess=None,
     # coords
     x = tools.get_fft_pos(nx, dx, centered=False, mode='symmetric')
     y = tools.get_fft_pos(ny, dy, centered=False, mode='symmetric')
-    xx, yy = np.meshgrid(x, y)
+    xx = x[None, :]
+    yy = y[:, None]
 
     # get frequency data
     fxs = tools.get_fft_frqs(ft1.shape[1], dx)
     dfx = fxs[1] - fxs[0]
     fys = tools.get_fft_frqs(ft1.shape[0], dy)
     dfy = fys[1] - fys[0]
-    fxfx, fyfy = np.meshgrid(fxs, fys)
-    ff = np.sqrt(fxfx ** 2 + fyfy ** 2)
+    fxfx, fyfy, ff = tools.get_frequency_grids(fxs, fys)
 
     if fmax is None:
         fmax = ff.max()
@@ -1800,11 +2636,10 @@ def fit_modulation_frq(ft1, ft2, dx, fmax=None, exclude_res=0.7, frq_guess=None,
         max_frq_shift = dfx * roi_pix_size
 
     # mask
-    mask = np.ones(ft1.shape, dtype=np.bool)
     if frq_guess is None:
-        mask[ff > fmax] = 0
-        mask[ff < exclude_res * fmax] = 0
+        mask = np.array(tools.get_frequency_mask(fxs, fys, fmax, fmin=exclude_res * fmax))
     else:
+        mask = np.ones(ft1.shape, dtype=np.bool)
         # account for frq_guess
         f_dist_guess = np.sqrt( (fxfx - frq_guess[0])**2 + (fyfy - frq_guess[1])**2)
         mask[f_dist_guess > max_frq_shift] = 0
@@ -1849,9 +2684,10 @@ def fit_modulation_frq(ft1, ft2, dx, fmax=None, exclude_res=0.7, frq_guess=None,
 
 
     # do fitting
-    img2 = fft.fftshift(fft.ifft2(fft.ifftshift(ft2)))
+    img2 = tools.ift2(ft2)
     # compute ft2(f + fo)
-    def fft_shifted(f): return fft.fftshift(fft.fft2(np.exp(-1j*2*np.pi * (f[0] * xx + f[1] * yy)) * fft.ifftshift(img2)))
+    img2_uncentered = fft.ifftshift(img2)
+    def fft_shifted(f): return fft.fftshift(tools.ft2(np.exp(-1j*2*np.pi * (f[0] * xx + f[1] * yy)) * img2_uncentered, centered=False))
     # cross correlation
     # todo: conjugating ft2 instead of ft1, as in typical definition of cross correlation. Doesn't matter bc taking norm
     def cc_fn(f): return np.sum(ft1 * fft_shifted(f).conj())
@@ -1863,8 +2699,8 @@ def fit_modulation_frq(ft1, ft2, dx, fmax=None, exclude_res=0.7, frq_guess=None,
     # as evaluating the jacobian is equivalent to ~4 function evaluations. So even though having the jacobian reduces
     # the number of function evaluations by a factor of ~3, this increase wins.
     # todo: need to check these now that added second fn to correlator
-    def dfx_fft_shifted(f): return fft.fftshift(fft.fft2(-1j * 2 * np.pi * xx * np.exp(-1j * 2 * np.pi * (f[0] * xx + f[1] * yy)) * img2))
-    def dfy_fft_shifted(f): return fft.fftshift(fft.fft2(-1j * 2 * np.pi * yy * np.exp(-1j * 2 * np.pi * (f[0] * xx + f[1] * yy)) * img2))
+    def dfx_fft_shifted(f): return fft.fftshift(tools.ft2(-1j * 2 * np.pi * xx * np.exp(-1j * 2 * np.pi * (f[0] * xx + f[1] * yy)) * img2, centered=False))
+    def dfy_fft_shifted(f): return fft.fftshift(tools.ft2(-1j * 2 * np.pi * yy * np.exp(-1j * 2 * np.pi * (f[0] * xx + f[1] * yy)) * img2, centered=False))
     def dfx_cc(f): return np.sum(ft2 * dfx_fft_shifted(f).conj())
     def dfy_cc(f): return np.sum(ft2 * dfy_fft_shifted(f).conj())
     def dfx_min_fn(f): return -2 * (cc_fn(f) * dfx_cc(f).conj()).real / fft_norm
@@ -1889,6 +2725,121 @@ def fit_modulation_frq(ft1, ft2, dx, fmax=None, exclude_res=0.7, frq_guess=None,
 
     return fit_frqs, mask
 
+def fit_modulation_frq_fast(ft1, ft2, dx, fmax=None, exclude_res=0.7, frq_guess=None, roi_pix_size=5,
+                            max_frq_shift=None, force_start_from_guess=False, zoom_factor=10, n_zoom_steps=3):
+    """
+    Find SIM frequency from image by maximizing the same cross correlation as fit_modulation_frq(),
+    C(f) = \sum_k img_ft(k) x img_ft*(k+f) = N * \sum_r img1(r) img2^*(r) exp(2*pi*i * f * r),
+    but without full-size FFT's for each trial frequency.
+
+    C(f) is the Fourier transform of the product of the real-space images, so it can be evaluated at arbitrary
+    frequencies by a matrix DFT. The peak is first located on the DFT frequency grid. If frq_guess is provided, C(f)
+    is only evaluated in the ROI around the guess, otherwise it is computed with one FFT. The peak is then refined
+    by repeatedly evaluating C(f) on a grid zoom_factor times finer than the last one, centered on the current
+    maximum, and finally interpolating the peak with a parabola.
+
+    :param ft1: 2D Fourier space image
+    :param ft2: 2D Fourier space image to be cross correlated with ft1
+    :param dx: pixel size
+    :param fmax:
+    :param exclude_res: frequencies less than this fraction of fmax are excluded from peak finding
+    :param frq_guess: frequency guess [fx, fy]. Can be None.
+    :param roi_pix_size: half-size of the region of interest around frq_guess used to estimate the peak location. This
+    parameter is only used if frq_guess is provided.
+    :param max_frq_shift: maximum distance from frq_guess of the frequencies considered in the initial peak finding.
+    If None, roi_pix_size frequency pixels
+    :param force_start_from_guess: if True, start refinement from frq_guess instead of the peak on the DFT grid
+    :param zoom_factor: ratio of the grid spacings of successive refinement steps
+    :param n_zoom_steps: number of refinement steps
+    :return fit_frqs:
+    :return mask: mask detailing region used in fitting
+    """
+
+    ny, nx = ft1.shape
+
+    # coords
+    x = tools.get_fft_pos(nx, dx, centered=False, mode='symmetric')
+    y = tools.get_fft_pos(ny, dx, centered=False, mode='symmetric')
+
+    # get frequency data
+    fxs = tools.get_fft_frqs(nx, dx)
+    dfx = fxs[1] - fxs[0]
+    fys = tools.get_fft_frqs(ny, dx)
+    dfy = fys[1] - fys[0]
+    _, _, ff = tools.get_frequency_grids(fxs, fys)
+
+    if fmax is None:
+        fmax = ff.max()
+
+    if max_frq_shift is None:
+        max_frq_shift = dfx * roi_pix_size
+
+    # mask
+    if frq_guess is None:
+        mask = np.array(tools.get_frequency_mask(fxs, fys, fmax, fmin=exclude_res * fmax))
+    else:
+        mask = np.ones(ft1.shape, dtype=bool)
+        f_dist_guess = np.sqrt((fxs[None, :] - frq_guess[0]) ** 2 + (fys[:, None] - frq_guess[1]) ** 2)
+        mask[f_dist_guess > max_frq_shift] = 0
+
+    # product of real space images, with origin at the edge to match the coordinates x and y
+    img_prod = tools.ift2(fft.ifftshift(ft1), centered=False) * tools.ift2(fft.ifftshift(ft2), centered=False).conj()
+
+    def cc_fn(fx_pts, fy_pts):
+        # C(f) on the grid fx_pts x fy_pts, using a matrix DFT
+        ex = np.exp(1j * 2 * np.pi * fx_pts[:, None] * x[None, :])
+        ey = np.exp(1j * 2 * np.pi * fy_pts[:, None] * y[None, :])
+        return ey.dot(img_prod.dot(ex.transpose()))
+
+    # #############################
+    # find peak on DFT frequency grid
+    # #############################
+    if frq_guess is None:
+        # C(f) at all DFT frequencies at once
+        cc = np.abs(fft.fftshift(tools.ift2(img_prod, centered=False)))
+        iy, ix = np.unravel_index(np.argmax(cc * mask), cc.shape)
+        init_params = np.array([fxs[ix], fys[iy]])
+
+        # since images are typically real, also peak at [-fx, -fy]. Return frequency with positive fy.
+        # If fy=0, return with positive fx.
+        if init_params[1] < 0 or (init_params[1] == 0 and init_params[0] < 0):
+            init_params = -init_params
+    elif force_start_from_guess:
+        init_params = np.array(frq_guess, dtype=float)
+    else:
+        # only evaluate C(f) in the ROI around the guess
+        ys_roi, xs_roi = [np.arange(inds.min(), inds.max() + 1) for inds in np.nonzero(mask)]
+        cc = np.abs(cc_fn(fxs[xs_roi], fys[ys_roi])) * mask[ys_roi[:, None], xs_roi[None, :]]
+        iy, ix = np.unravel_index(np.argmax(cc), cc.shape)
+        init_params = np.array([fxs[xs_roi[ix]], fys[ys_roi[iy]]])
+
+    # #############################
+    # refine on successively finer grids
+    # #############################
+    fit_frqs = init_params
+    spacing_x = dfx
+    spacing_y = dfy
+    steps = np.arange(-zoom_factor, zoom_factor + 1)
+    for _ in range(n_zoom_steps):
+        spacing_x = spacing_x / zoom_factor
+        spacing_y = spacing_y / zoom_factor
+        fx_pts = fit_frqs[0] + spacing_x * steps
+        fy_pts = fit_frqs[1] + spacing_y * steps
+
+        cc = np.abs(cc_fn(fx_pts, fy_pts))
+        iy, ix = np.unravel_index(np.argmax(cc), cc.shape)
+        fit_frqs = np.array([fx_pts[ix], fy_pts[iy]])
+
+    # parabolic interpolation of peak on final grid
+    if 0 < ix < len(steps) - 1:
+        c_left, c_mid, c_right = cc[iy, ix - 1:ix + 2]
+        fit_frqs[0] += 0.5 * spacing_x * (c_left - c_right) / (c_left - 2 * c_mid + c_right)
+    if 0 < iy < len(steps) - 1:
+        c_left, c_mid, c_right = cc[iy - 1:iy + 2, ix]
+        fit_frqs[1] += 0.5 * spacing_y * (c_left - c_right) / (c_left - 2 * c_mid + c_right)
+
+    return fit_frqs, mask
+
 def plot_correlation_fit(img1_ft, img2_ft, frqs, dx, fmax=None, frqs_guess=None, roi_size=31,
                          peak_pixels=2, figsize=(20, 10), ttl_str=""):
     """
@@ -2127,10 +3078,10 @@ def fit_phase_wicker(imgs_ft, otf, sim_frq, dxy, fmax, phases_guess=None, fit_am
     by additionally looking at the peak phase for one pattern
 
     # todo: currently hardcoded for 3 phases
-    # todo: can I improve the fitting by adding jacobian?
-    # todo: can get this using d(M^{-1})dphi1 = - M^{-1} * (dM/dphi1) * M^{-1}
-    # todo: probably not necessary, because phases should always be close to equally spaced, so initial
-    # guess should be good
+
+    There are only three distinct frequency shifts (0, fo, -fo), so the shifted OTF's, weights, and shifted image
+    spectra are computed once for each shift. The cross correlations are then computed as batched inner products, and
+    the optimization uses the analytic gradient, obtained from d(M^{-1})/dp = - M^{-1} * (dM/dp) * M^{-1}
 
     See https://doi.org/10.1364/OE.21.002032 for more details about this method.
     :param imgs_ft: 3 x ny x nx. o(f), o(f-fo), o(f+fo)
@@ -2154,86 +3105,89 @@ def fit_phase_wicker(imgs_ft, otf, sim_frq, dxy, fmax, phases_guess=None, fit_am
     dfy = fy[1] - fy[0]
 
     # compute cross correlations of data
-    cross_corrs = np.zeros((3, 3, 3), dtype=np.complex)
     # C_i(k) = S(k - i*p)
     # this is the order set by matrix M, i.e.
     # M * [S(k), S(k-i*p), S(k + i*p)]
-    inds = [0, 1, -1]
-    for ii, mi in enumerate(inds):  # [0, 1, 2] -> [0, 1, -1]
-        for jj, mj in enumerate(inds):
-            for ll, ml in enumerate(inds):
-
-                # get shifted otf -> otf(f - l * fo)
-                # pix_shift = [int(np.round((ml) * sim_frq[0] / dfx)),
-                #              int(np.round((ml) * sim_frq[1] / dfy))]
-                # otf_shift = tools.translate_pix(otf, pix_shift, mode='no-wrap')
-
-                # pix_shift = [int(np.round((ml) * sim_frq[0] / dfx)),
-                #              int(np.round((ml) * sim_frq[1] / dfy))]
-                otf_shift, _, _ = tools.translate_pix(otf, -ml*sim_frq, dx=dfx, dy=dfy, mode='no-wrap')
-
-                weight = otf * otf_shift.conj() / (np.abs(otf_shift)**2 + np.abs(otf)**2)
-                weight[np.isnan(weight)] = 0
-                weight / np.sum(weight)
-
-                # shifted component C_j(f - l*fo)
-                cshift = tools.translate_ft(imgs_ft[jj], -ml * sim_frq, dxy, dxy)
-                # compute weighted cross correlation
-                cross_corrs[ii, jj, ll] = np.sum(imgs_ft[ii] * cshift.conj() * weight) / np.sum(weight)
-
-                # plt.figure()
-                # nrows = 2
-                # ncols = 2
-                # plt.suptitle("ii = %d, jj = %d, ll = %d" % (mi, mj, ml))
-                #
-                # plt.subplot(nrows, ncols, 1)
-                # plt.imshow(np.abs(imgs_ft[ii]), norm=PowerNorm(gamma=0.1))
-                # plt.title("D_i(k)")
-                #
-                # plt.subplot(nrows, ncols, 2)
-                # plt.imshow(np.abs(cshift), norm=PowerNorm(gamma=0.1))
-                # plt.title("D_j(k-lp)")
-                #
-                # plt.subplot(nrows, ncols, 3)
-                # plt.imshow(otf_shift)
-                # plt.title('otf_j(k-lp)')
-                #
-                # plt.subplot(nrows, ncols, 4)
-                # plt.imshow(np.abs(imgs_ft[ii] * cshift.conj()), norm=PowerNorm(gamma=0.1))
-                # plt.title("D_i(k) x D_j^*(k-lp)")
-
-                # remove extra noise correlation expected from same images
-                if ml == 0 and ii == jj:
-                    noise_power = get_noise_power(imgs_ft[ii], fx, fy, fmax)
-                    cross_corrs[ii, jj, ll] = cross_corrs[ii, jj, ll] - noise_power
-
-    # optimize
-    if fit_amps:
-        def minv(p): return np.linalg.inv(get_kmat([p[0], p[1], p[2]], [1, 1, 1], [1, p[3], p[4]]))
-        # minv = lambda p: np.linalg.inv(get_kmat([p[0], p[1], p[2]], [p[3], p[4], p[5]], [1, p[6], p[7]]))
-    else:
-        def minv(p): return np.linalg.inv(get_kmat(p, [1, 1, 1]))
+    inds = np.array([0, 1, -1])
+    sim_frq = np.asarray(sim_frq)
 
-    # remove i = (j + l) terms
-    ii_minus_jj = np.array(inds)[:, None] - np.array(inds)[None, :]
+    # only three distinct shifts, so compute shifted otf -> otf(f - l * fo) and weights once for each
+    otf_shift = np.stack([tools.translate_pix(otf, -ml * sim_frq, dx=dfx, dy=dfy, mode='no-wrap')[0] for ml in inds])
 
-    def fn_sum(p, ll): return np.sum(np.abs(minv(p).dot(cross_corrs[:, :, ll]).dot(minv(p).conj().transpose()) *
-                                        (ii_minus_jj != inds[ll]))**0.5)
+    weights = otf * otf_shift.conj() / (np.abs(otf_shift)**2 + np.abs(otf)**2)
+    weights[np.isnan(weights)] = 0
+    weights = weights / np.sum(weights, axis=(-1, -2), keepdims=True)
 
-    def fn(p): return np.sum([fn_sum(p, ll) for ll in range(3)])
+    # shifted components C_j(f - l*fo), size l x j x ny x nx. No shift required for l = 0
+    cshift = np.concatenate((imgs_ft[None, ...],
+                             tools.translate_ft(imgs_ft, -inds[1:, None, None] * sim_frq, dxy, dxy)), axis=0)
+
+    # compute weighted cross correlations as batched inner products
+    # cross_corrs[ii, jj, ll] = \sum_k D_i(k) D_j^*(k - l*fo) w_l(k)
+    cross_corrs = np.matmul((imgs_ft[None, ...] * weights[:, None]).reshape(3, 3, ny * nx),
+                            cshift.reshape(3, 3, ny * nx).conj().transpose(0, 2, 1)).transpose(1, 2, 0)
+
+    # remove extra noise correlation expected from same images
+    cross_corrs[[0, 1, 2], [0, 1, 2], 0] -= get_noise_power(imgs_ft, fx, fy, fmax)
+
+    # #############################
+    # objective function and its gradient
+    # #############################
+    # remove i = (j + l) terms
+    ii_minus_jj = inds[:, None] - inds[None, :]
+    masks = np.stack([ii_minus_jj != ml for ml in inds])
+
+    def get_kmat_and_derivs(p):
+        # derivatives of M with respect to phases and (optionally) the amplitudes of the second and third images
+        phases = p[:3]
+        if fit_amps:
+            amps = np.concatenate((np.array([1]), p[3:]))
+        else:
+            amps = np.ones(3)
+
+        kmat = get_kmat(phases, [1, 1, 1], amps)
+
+        dkmat = np.zeros((len(p), 3, 3), dtype=complex)
+        for rr in range(3):
+            dkmat[rr, rr] = amps[rr] * np.array([0, 0.5j * np.exp(1j * phases[rr]), -0.5j * np.exp(-1j * phases[rr])])
+        if fit_amps:
+            for rr in range(1, 3):
+                dkmat[rr + 2, rr] = kmat[rr] / amps[rr]
+
+        return kmat, dkmat
+
+    def fn_and_jac(p):
+        kmat, dkmat = get_kmat_and_derivs(p)
+        minv = np.linalg.inv(kmat)
+        # d(M^{-1}) = - M^{-1} dM M^{-1}
+        dminv = -np.matmul(np.matmul(minv, dkmat), minv)
+
+        # terms M^{-1} C_l M^{-1}^H, size l x i x j
+        corrs_l = cross_corrs.transpose(2, 0, 1)
+        xmat = np.matmul(np.matmul(minv, corrs_l), minv.conj().transpose())
+        dxmat = np.matmul(np.matmul(dminv[:, None], corrs_l[None, :]), minv.conj().transpose())
+        dxmat = dxmat + np.matmul(np.matmul(minv, corrs_l)[None, :], dminv[:, None].conj().transpose(0, 1, 3, 2))
+
+        xabs = np.abs(xmat[masks])
+        val = np.sum(xabs**0.5)
+        # d|x|^(1/2) = 0.5 * |x|^(-3/2) * Re(x^* dx). This diverges for x = 0, where |x|^(1/2) is not
+        # differentiable, so leave these terms out of the gradient instead of producing inf * 0 = nan
+        dxabs = np.zeros(xabs.shape)
+        nonzero = xabs > 0
+        dxabs[nonzero] = 0.5 * xabs[nonzero]**(-1.5)
+        jac = np.sum(dxabs * (xmat[masks].conj() * dxmat[:, masks]).real, axis=-1)
+
+        return val, jac
 
     # can also include amplitudes and modulation depths in optimization process
     if fit_amps:
-        result = scipy.optimize.minimize(fn, np.concatenate((phases_guess, np.array([1, 1]))))
+        result = scipy.optimize.minimize(fn_and_jac, np.concatenate((phases_guess, np.array([1, 1]))), jac=True)
         phases = result.x[0:3]
-        # mods = result.x[3:6]
-        # amps = np.concatenate((np.array([1]), result.x[6:]))
         amps = np.concatenate((np.array([1]), result.x[3:]))
     else:
-        result = scipy.optimize.minimize(fn, phases_guess)
+        result = scipy.optimize.minimize(fn_and_jac, phases_guess, jac=True)
         phases = result.x
         amps = np.array([1, 1, 1])
-        # mods = np.array([1, 1, 1])
 
     # estimate absolute phase by looking at phase of peak
     phase_offsets = np.angle(tools.get_peak_value(imgs_ft[0], fx, fy, sim_frq, peak_pixel_size=2))
@@ -2244,27 +3198,78 @@ def fit_phase_wicker(imgs_ft, otf, sim_frq, dxy, fmax, phases_guess=None, fit_am
     return phases, amps
 
 # power spectrum and modulation depths
-def get_noise_power(img_ft, fxs, fys, fmax):
+def get_half_plane_weights(nx):
+    """
+    Get the number of times each column of a half-plane Fourier transform, as produced by tools.rft2(),
+    appears in the full Fourier transform. Columns with 0 < fx < nyquist frequency appear twice, at f and -f.
+
+    :param nx: number of pixels along x of the real image
+    :return weights: array of size nx // 2 + 1
+    """
+    weights = 2 * np.ones(nx // 2 + 1)
+    weights[0] = 1
+    if np.mod(nx, 2) == 0:
+        weights[-1] = 1
+
+    return weights
+
+def get_noise_power(img_ft, fxs, fys, fmax, half_plane_nx=None):
     """
     Get average noise power outside OTF support for an image
 
-    :param img_ft: Fourier transform of image
+    :param img_ft: Fourier transform of image. If this has more than two dimensions, the noise power of each image
+    along the last two axes is computed
     :param fxs: 1D array, x-frequencies
     :param fys: 1D array, y-frequencies
     :param fmax: maximum frequency where signal may be present, i.e. (0.5*wavelength/NA)^{-1}
+    :param half_plane_nx: if not None, img_ft is a half-plane as produced by tools.rft2() for an image with this many
+    pixels along x, and fxs are the corresponding non-negative frequencies
     :return noise_power:
     """
 
-    ps = np.abs(img_ft) ** 2
+    # only use regions of frequency space outside the OTF support, i.e. with |f| > fmax strictly
+    inds = tools.get_frequency_inds(fxs, fys, np.inf, fmin=np.nextafter(fmax, np.inf))
+    ps = np.abs(np.take(img_ft.reshape(img_ft.shape[:-2] + (-1,)), inds, axis=-1)) ** 2
 
-    # exclude regions of frequency space
-    fxfx, fyfy = np.meshgrid(fxs, fys)
-    ff = np.sqrt(fxfx ** 2 + fyfy ** 2)
-    noise_power = np.mean(ps[ff > fmax])
+    if half_plane_nx is None:
+        noise_power = np.mean(ps, axis=-1)
+    else:
+        weights = get_half_plane_weights(half_plane_nx)[np.mod(inds, len(fxs))]
+        noise_power = np.average(ps, axis=-1, weights=weights)
 
     return noise_power
 
-def get_mcnr(img_ft, frqs, fxs, fys, fmax):
+def get_peak_value_ft(img_ft, fxs, fys, frq, peak_pixel_size=1, half_plane_nx=None):
+    """
+    Estimate the value of a Fourier transform at a frequency which is not aligned to the pixel grid, using
+    tools.get_peak_value()
+
+    :param img_ft: Fourier transform of image
+    :param fxs: 1D array, x-frequencies
+    :param fys: 1D array, y-frequencies
+    :param frq: [fx, fy]
+    :param peak_pixel_size: passed through to tools.get_peak_value()
+    :param half_plane_nx: if not None, img_ft is a half-plane as produced by tools.rft2() for an image with this many
+    pixels along x, and fxs are the corresponding non-negative frequencies
+    :return peak_value:
+    """
+    if half_plane_nx is None:
+        return tools.get_peak_value(img_ft, fxs, fys, frq, peak_pixel_size=peak_pixel_size)
+
+    # half-plane only contains fx >= 0, and img_ft(-f) = img_ft(f).conj()
+    if frq[0] < 0:
+        return get_peak_value_ft(img_ft, fxs, fys, -np.asarray(frq), peak_pixel_size, half_plane_nx).conj()
+
+    # add columns of negative frequencies, so peaks near fx = 0 are averaged the same as for the full plane
+    npad = 3 * peak_pixel_size
+    ny = len(fys)
+    iy_neg = np.mod(2 * (ny // 2) - np.arange(ny), ny)
+    img_ft_pad = np.concatenate((img_ft[iy_neg, 1:npad + 1][:, ::-1].conj(), img_ft), axis=1)
+    fxs_pad = np.concatenate((-fxs[1:npad + 1][::-1], fxs))
+
+    return tools.get_peak_value(img_ft_pad, fxs_pad, fys, frq, peak_pixel_size=peak_pixel_size)
+
+def get_mcnr(img_ft, frqs, fxs, fys, fmax, half_plane_nx=None):
     """
     Get ratio of modulation contrast to noise, which is a measure of quality of SIM contrast.
 
@@ -2277,11 +3282,13 @@ def get_mcnr(img_ft, frqs, fxs, fys, fmax):
     :param fxs:
     :param fys:
     :param fmax:
+    :param half_plane_nx: if not None, img_ft is a half-plane as produced by tools.rft2() for an image with this many
+    pixels along x, and fxs are the corresponding non-negative frequencies
     :return mcnr:
     """
 
-    peak_height = np.abs(tools.get_peak_value(img_ft, fxs, fys, frqs, peak_pixel_size=1))
-    noise = np.sqrt(get_noise_power(img_ft, fxs, fys, fmax))
+    peak_height = np.abs(get_peak_value_ft(img_ft, fxs, fys, frqs, peak_pixel_size=1, half_plane_nx=half_plane_nx))
+    noise = np.sqrt(get_noise_power(img_ft, fxs, fys, fmax, half_plane_nx=half_plane_nx))
 
     mcnr = peak_height / noise
 
@@ -2314,8 +3321,157 @@ def power_spectrum_jacobian(p, fmag, otf):
             2 * p[2] * p[0]**2 * np.abs(fmag)**(-2*p[1]) * np.abs(otf)**2,
             np.ones(fmag.shape)]
 
+def get_power_spectrum_bins(otf, fxs, fys, fmax, fbounds, fbounds_shift=None, frq_sim=None, bin_size=None):
+    """
+    Get the label map used to reduce a power spectrum to an azimuthally binned profile about frq_sim. The region
+    of frequency space considered is the same as in fit_power_spectrum(). Since the label map only depends on the
+    frequency grid and the bounds, it can be computed once and reused for every spectrum with the same frq_sim.
+
+    :param otf: optical transfer function
+    :param fxs:
+    :param fys:
+    :param fmax:
+    :param fbounds: tuple of upper and lower bounds in units of fmax. See fit_power_spectrum()
+    :param fbounds_shift: tuple of upper and lower bounds in units of fmax centered about frq_sim
+    :param frq_sim:
+    :param bin_size: width of bins in |f - frq_sim|. If None, a quarter of the frequency spacing is used, which is
+    small enough that the few distinct distances near the center fall in separate bins
+    :return bins: dictionary with entries "labels", the bin index of each point (-1 for points not used), "n_bins",
+    "npts", the number of points in each bin, "fmag", the mean of |f - frq_sim| in each bin, "otf",
+    the root mean square of the otf in each bin, and "mask", the points used
+    """
+
+    if fbounds_shift is None:
+        fbounds_shift = fbounds
+
+    if frq_sim is None:
+        frq_sim = [0, 0]
+
+    if bin_size is None:
+        bin_size = 0.25 * min(fxs[1] - fxs[0], fys[1] - fys[0])
+
+    _, _, ff = tools.get_frequency_grids(fxs, fys)
+    ff_shift = np.sqrt((fxs[None, :] - frq_sim[0])**2 + (fys[:, None] - frq_sim[1])**2)
+
+    in_normal_bounds = tools.get_frequency_mask(fxs, fys, fmax * fbounds[1], fmin=fmax * fbounds[0])
+    in_shifted_bounds = np.logical_and(ff_shift <= fmax * fbounds_shift[1], ff_shift >= fmax * fbounds_shift[0])
+    mask = np.logical_and(ff != 0, np.logical_and(in_normal_bounds, in_shifted_bounds))
+
+    labels = np.full(ff.shape, -1, dtype=int)
+    labels[mask] = np.floor(ff_shift[mask] / bin_size).astype(int)
+
+    n_bins = np.max(labels) + 1
+    npts = np.bincount(labels[mask], minlength=n_bins).astype(float)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fmag = np.bincount(labels[mask], ff_shift[mask], minlength=n_bins) / npts
+        otf_rms = np.sqrt(np.bincount(labels[mask], np.abs(otf[mask])**2, minlength=n_bins) / npts)
+
+    bins = {"labels": labels, "n_bins": n_bins, "npts": npts, "fmag": fmag, "otf": otf_rms, "mask": mask}
+
+    return bins
+
+# number of power spectrum bin label maps kept for each reconstruction geometry
+power_spectrum_bins_cache_size = 16
+
+def get_cached_power_spectrum_bins(geometry, fmax, fbounds, fbounds_shift=None, frq_sim=None):
+    """
+    Get the label map computed by get_power_spectrum_bins() for the frequency grid and OTF of a reconstruction
+    geometry. Label maps are stored in the geometry dictionary, so they are reused by every reconstruction which shares
+    this geometry. The label map about zero frequency is the same for every image, and label maps about the SIM
+    frequencies are reused when the frequencies are fixed between frames.
+
+    :param geometry: dictionary produced by get_reconstruction_geometry()
+    :param fmax:
+    :param fbounds: tuple of upper and lower bounds in units of fmax. See fit_power_spectrum()
+    :param fbounds_shift: tuple of upper and lower bounds in units of fmax centered about frq_sim
+    :param frq_sim:
+    :return bins: see get_power_spectrum_bins(). This is shared between callers, so must not be modified
+    """
+    cache = geometry.setdefault("_power_spectrum_bins", collections.OrderedDict())
+
+    key = (float(fmax), tuple(fbounds),
+           None if fbounds_shift is None else tuple(fbounds_shift),
+           None if frq_sim is None else tuple(float(f) for f in frq_sim))
+
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    bins = get_power_spectrum_bins(geometry['otf'], geometry['fx'], geometry['fy'], fmax, fbounds,
+                                   fbounds_shift=fbounds_shift, frq_sim=frq_sim)
+    cache[key] = bins
+    while len(cache) > power_spectrum_bins_cache_size:
+        cache.popitem(last=False)
+
+    return bins
+
+def bin_power_spectra(imgs_ft, bins):
+    """
+    Reduce power spectra to azimuthally binned profiles. All spectra are binned in a single pass of np.bincount
+
+    :param imgs_ft: array of size n x ny x nx
+    :param bins: list of n dictionaries produced by get_power_spectrum_bins(), one for each spectrum. The same
+    dictionary may be used for several spectra
+    :return ps: array of size n x n_bins giving the mean power in each bin. Profiles with fewer bins than the
+    longest profile are padded with NaNs, as are empty bins.
+    :return fmag: array of size n x n_bins giving the mean |f - frq_sim| in each bin
+    :return otf: array of size n x n_bins giving the root mean square of the otf in each bin
+    :return npts: array of size n x n_bins giving the number of points in each bin
+    """
+
+    nimgs = len(imgs_ft)
+    if len(bins) != nimgs:
+        raise ValueError("len(bins)=%d must match the number of spectra %d" % (len(bins), nimgs))
+
+    n_bins = max([b["n_bins"] for b in bins])
+
+    # offset the labels of each spectrum so all profiles are computed with one call to bincount
+    inds = np.concatenate([b["labels"][b["mask"]] + ii * n_bins for ii, b in enumerate(bins)])
+    pows = np.concatenate([np.abs(img_ft[b["mask"]])**2 for img_ft, b in zip(imgs_ft, bins)])
+
+    npts = np.zeros((nimgs, n_bins))
+    fmag = np.full((nimgs, n_bins), np.nan)
+    otf = np.full((nimgs, n_bins), np.nan)
+    for ii, b in enumerate(bins):
+        npts[ii, :b["n_bins"]] = b["npts"]
+        fmag[ii, :b["n_bins"]] = b["fmag"]
+        otf[ii, :b["n_bins"]] = b["otf"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ps = np.bincount(inds, pows, minlength=nimgs * n_bins).reshape((nimgs, n_bins)) / npts
+
+    return ps, fmag, otf, npts
+
+def fit_power_spectrum_scale(ps, fmag, otf, npts, exponent, noise):
+    """
+    Fit binned power spectra to power_spectrum_fn() with the exponent and noise fixed. In this case the model is
+    linear in m^2 * A^2, so the weighted least squares solution can be found in closed form for all spectra at once.
+
+    :param ps: binned power spectra, array of size n x n_bins, as produced by bin_power_spectra()
+    :param fmag: array of size n x n_bins
+    :param otf: array of size n x n_bins
+    :param npts: number of points in each bin, used to weight the fit. Array of size n x n_bins
+    :param exponent: power spectrum exponent B. Either a float or an array of size n
+    :param noise: noise power. Either a float or an array of size n
+    :return scale: m^2 * A^2 for each spectrum, array of size n. This is constrained to be non-negative
+    """
+    exponent = np.broadcast_to(exponent, (ps.shape[0],))
+    noise = np.broadcast_to(noise, (ps.shape[0],))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        basis = power_spectrum_fn([1, exponent[:, None], 1, 0], fmag, otf)
+    to_use = np.logical_and(npts > 0, np.isfinite(ps))
+    basis = np.where(to_use, basis, 0)
+    ps = np.where(to_use, ps, 0)
+
+    scale = np.sum(npts * basis * (ps - noise[:, None]), axis=1) / np.sum(npts * basis**2, axis=1)
+    scale[scale < 0] = 0
+
+    return scale
+
 def fit_power_spectrum(img_ft, otf, fxs, fys, fmax, fbounds, fbounds_shift=None,
-                       frq_sim=None, init_params=None, fixed_params=None, bounds=None):
+                       frq_sim=None, init_params=None, fixed_params=None, bounds=None, half_plane_nx=None):
     """
     Fit power spectrum, P = |img_ft(f-fsim) * otf(f)|**2 to the form m^2 A^2*|f-fsim|^{-2B}*otf(f) + N
     A and B are the two fit parameters, and N is determined from values of img_ft in the region where the otf does not
@@ -2336,6 +3492,9 @@ def fit_power_spectrum(img_ft, otf, fxs, fys, fmax, fbounds, fbounds_shift=None,
     is True init_params must be provided.
     :param fixed_params:
     :param bounds:
+    :param half_plane_nx: if not None, img_ft and otf are half-planes as produced by tools.rft2() for an image with
+    this many pixels along x, and fxs are the corresponding non-negative frequencies. Points are weighted by the
+    number of times they appear in the full plane, so the fit is the same as for the full plane.
 
     :return fit_results: fit results dictionary object. See analysis_tools.fit_model() for more details.
     :return mask: mask indicating region that is used for fitting
@@ -2347,12 +3506,11 @@ def fit_power_spectrum(img_ft, otf, fxs, fys, fmax, fbounds, fbounds_shift=None,
     if frq_sim is None:
         frq_sim = [0, 0]
 
-    fxfx, fyfy = np.meshgrid(fxs, fys)
-    ff = np.sqrt(fxfx**2 + fyfy**2)
-    ff_shift = np.sqrt((fxfx - frq_sim[0])**2 + (fyfy - frq_sim[1])**2)
+    _, _, ff = tools.get_frequency_grids(fxs, fys)
+    ff_shift = np.sqrt((fxs[None, :] - frq_sim[0])**2 + (fys[:, None] - frq_sim[1])**2)
 
     # exclude points outside of bounds, and at zero frequency (because power spectrum fn is singular there)
-    in_normal_bounds = np.logical_and(ff <= fmax*fbounds[1], ff >= fmax*fbounds[0])
+    in_normal_bounds = tools.get_frequency_mask(fxs, fys, fmax * fbounds[1], fmin=fmax * fbounds[0])
     in_shifted_bounds = np.logical_and(ff_shift <= fmax*fbounds_shift[1], ff_shift >= fmax * fbounds_shift[0])
     in_bounds = np.logical_and(in_normal_bounds, in_shifted_bounds)
     mask = np.logical_and(ff != 0, in_bounds)
@@ -2364,7 +3522,7 @@ def fit_power_spectrum(img_ft, otf, fxs, fys, fmax, fbounds, fbounds_shift=None,
     if np.any([ip is None for ip in init_params]):
         img_guess, _, f_guess, _, _, _ = tools.azimuthal_avg(np.abs(img_ft) ** 2, ff_shift, [0, 0.1*fmax])
 
-        noise_guess = get_noise_power(img_ft, fxs, fys, fmax)
+        noise_guess = get_noise_power(img_ft, fxs, fys, fmax, half_plane_nx=half_plane_nx)
         amp_guess = np.sqrt(img_guess[0] * f_guess[0])
         guess_params = [amp_guess, 0.5, 1, noise_guess]
 
@@ -2384,8 +3542,14 @@ def fit_power_spectrum(img_ft, otf, fxs, fys, fmax, fbounds, fbounds_shift=None,
 
     jac_fn = lambda p: power_spectrum_jacobian(p, ff_shift[mask], otf[mask])
 
+    if half_plane_nx is None:
+        sd = None
+    else:
+        weights = np.broadcast_to(get_half_plane_weights(half_plane_nx)[None, :], img_ft.shape)
+        sd = 1 / np.sqrt(weights[mask])
+
     # do fitting
-    fit_results = fit.fit_model(ps, fit_fn, init_params, fixed_params=fixed_params,
+    fit_results = fit.fit_model(ps, fit_fn, init_params, fixed_params=fixed_params, sd=sd,
                                   bounds=bounds, model_jacobian=jac_fn)
 
     return fit_results, mask
@@ -2612,7 +3776,7 @@ def mult_img_matrix(imgs, matrix):
 
     return imgs_out
 
-def separate_components(imgs_ft, phases, mod_depths=None, amps=None):
+def separate_components(imgs_ft, phases, mod_depths=None, amps=None, half_plane_nx=None):
     """
     Do noisy inversion of SIM data, i.e. determine
     [[S(k)H(k)], [S(k-p)H(k)], [S(k+p)H(k)]] = M^{-1} * [[D_1(k)], [D_2(k)], [D_3(k)]]
@@ -2624,9 +3788,14 @@ def separate_components(imgs_ft, phases, mod_depths=None, amps=None):
     :param phases: nangles x nphases
     :param mod_depths: list of length nangles. Optional. If not provided, set to 1.
     :param amps:
-    :return components_ft:
+    :param half_plane_nx: if not None, imgs_ft are half-planes as produced by tools.rft2() for images with this
+    many pixels along x. The separated components are not Fourier transforms of real images, so they are returned as
+    full planes. Only the images for one angle are expanded at a time
+    :return components_ft: nangles x nphases x ny x nx
     """
     nangles, nphases, ny, nx = imgs_ft.shape
+    if half_plane_nx is not None:
+        nx = half_plane_nx
 
     # default parameters
     if mod_depths is None:
@@ -2639,15 +3808,20 @@ def separate_components(imgs_ft, phases, mod_depths=None, amps=None):
     if nphases != 3:
         raise NotImplementedError("only implemented for nphases=3, but nphases=%d" % nphases)
 
-    components_ft = np.empty((nangles, nphases, ny, nx), dtype=np.complex) * np.nan
+    # keep precision of input images
+    dtype = np.result_type(imgs_ft.dtype, np.complex64)
+    components_ft = np.empty((nangles, nphases, ny, nx), dtype=dtype) * np.nan
 
     # try to do inversion
     for ii in range(nangles):
         kmat = get_kmat(phases[ii], mod_depths[ii], amps[ii])
 
         try:
-            kmat_inv = np.linalg.inv(kmat)
-            components_ft[ii] = mult_img_matrix(imgs_ft[ii], kmat_inv)
+            kmat_inv = np.linalg.inv(kmat).astype(dtype)
+            if half_plane_nx is None:
+                components_ft[ii] = mult_img_matrix(imgs_ft[ii], kmat_inv)
+            else:
+                components_ft[ii] = mult_img_matrix(tools.expand_rft2(imgs_ft[ii], nx), kmat_inv)
 
         except np.linalg.LinAlgError:
             warnings.warn("warning, inversion matrix for angle index=%d is singular. This data will be ignored in SIM reconstruction" % ii)
@@ -2709,23 +3883,25 @@ def get_snr_weight(otf, snr):
 
     w[k] = |otf(k)|**2 * signal_power/noise_power
 
-    :param otf: optical transfer function.
+    :param otf: optical transfer function. May also be a stack of OTF's, in which case the weights are computed
+     for each image along the last two axes
     :param snr: ratio of signal power to noise power spectral density. Can be supplied as either a single
-     number, or an array of the same size as otf
+     number, or an array which can be broadcast to the same size as otf
     :return filter: array the same size as otf
     """
     # filter
     weight = snr * np.abs(otf) ** 2
 
     # deal with any diverging points by averaging nearest pixels
-    if np.any(np.isinf(weight)):
-        xx, yy = np.meshgrid(range(weight.shape[1]), range(weight.shape[0]))
-        xinds = xx[np.isinf(weight)]
-        yinds = yy[np.isinf(weight)]
+    inf_inds = np.nonzero(np.isinf(weight))
+    if inf_inds[0].size > 0:
+        other_inds = inf_inds[:-2]
+        yinds, xinds = inf_inds[-2:]
 
         # todo: not handling case where these points might be outside ROI
-        for xi, yi in zip(xinds, yinds):
-            weight[yi, xi] = np.mean([weight[yi + 1, xi], weight[yi - 1, xi], weight[yi, xi+1], weight[yi, xi-1]])
+        weight[inf_inds] = np.mean([weight[other_inds + (yinds + 1, xinds)], weight[other_inds + (yinds - 1, xinds)],
+                                    weight[other_inds + (yinds, xinds + 1)], weight[other_inds + (yinds, xinds - 1)]],
+                                   axis=0)
 
     return weight
 
@@ -2913,8 +4089,8 @@ def get_simulated_sim_imgs(ground_truth, frqs, phases, mod_depths, max_photons,
                                                         phases[ii, jj]))
 
             if not coherent_projection:
-                pattern_ft = fft.fftshift(fft.fft2(fft.ifftshift(pattern)))
-                pattern = fft.fftshift(fft.ifft2(fft.ifftshift(pattern_ft * otf))).real
+                pattern_ft = tools.ft2(pattern)
+                pattern = tools.ift2(pattern_ft * otf).real
 
             sim_imgs[ii, jj], snrs[ii, jj], real_max_photons[ii, jj] = camera_noise.simulated_img(ground_truth * pattern, max_photons, cam_gains,
                                                            cam_offsets, cam_readout_noise_sds, pix_size, otf=otf, **kwargs)
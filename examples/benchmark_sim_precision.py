@@ -0,0 +1,65 @@
+"""
+Compare SIM reconstruction in single and double precision using simulated data. Reports the reconstruction time,
+the size of the combined component arrays, the error of each reconstruction relative to the ground truth, and the
+difference between the single and double precision reconstructions.
+"""
+import time
+import numpy as np
+import sim_reconstruction as sim
+import analysis_tools as tools
+import fit_psf as psf
+
+np.random.seed(0)
+
+# physical parameters
+options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+nx = 512
+frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+mod_depths = np.array([0.85, 0.85, 0.85])
+max_photons = 1000
+
+fx = tools.get_fft_frqs(nx, options['pixel_size'])
+otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+# ground truth of sparse point emitters
+gt = np.zeros((nx, nx))
+inds = np.random.randint(0, nx, size=(1000, 2))
+gt[inds[:, 0], inds[:, 1]] = 1
+
+imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, max_photons, 1, 100, 0,
+                                        options['pixel_size'], otf=otf, use_otf=True)
+
+# ground truth on the upsampled grid of the reconstruction, limited to the frequencies SIM can recover
+f_upsample = 2
+geometry = sim.get_reconstruction_geometry(nx, nx, options['pixel_size'], options['na'], options['wavelength'],
+                                           otf=otf, f_upsample=f_upsample)
+fmax = 1 / (0.5 * options['wavelength'] / options['na'])
+gt_ft = tools.expand_fourier_sp(tools.ft2(gt), mx=f_upsample, my=f_upsample, centered=True)
+gt_ft[geometry['ff_us'] > fmax + np.max(np.linalg.norm(frqs, axis=1))] = 0
+gt_us = tools.ift2(gt_ft).real
+
+
+def rel_error(img, ref):
+    # allow for an overall scale factor between the reconstruction and ground truth
+    scale = np.sum(img * ref) / np.sum(img * img)
+    return np.linalg.norm(scale * img - ref) / np.linalg.norm(ref)
+
+
+results = {}
+for precision in ["double", "single"]:
+    r = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases, precision=precision,
+                        geometry=geometry, diagnostics="full")
+
+    tstart = time.perf_counter()
+    r.reconstruct()
+    tend = time.perf_counter()
+
+    results[precision] = r
+    print("%s precision: reconstruction took %0.2fs, shifted components use %0.1fMB, error vs. ground truth = %0.4f" %
+          (precision, tend - tstart, r.components_shifted_ft.nbytes / 1e6, rel_error(r.img_sr, gt_us)))
+
+img_double = results["double"].img_sr
+img_single = results["single"].img_sr
+print("max difference between single and double precision = %0.3g (relative to max intensity)" %
+      (np.max(np.abs(img_single - img_double)) / np.max(np.abs(img_double))))
@@ -0,0 +1,287 @@
+"""
+Benchmark SIM reconstruction on simulated data. For each image size and photon number, simulated SIM images are
+generated with get_simulated_sim_imgs() and reconstructed with SimImageSet. The wall time and peak resident memory of
+each stage of the reconstruction are recorded, together with the error of the reconstruction relative to the
+ground truth. Results are stored as JSON, so runs from different commits can be compared.
+
+Run "python benchmark_sim_reconstruction.py -h" for help with parameters. For example
+python benchmark_sim_reconstruction.py --sizes 256 512 --photons 100 1000 -o results_new.json
+python benchmark_sim_reconstruction.py --compare results_old.json results_new.json
+"""
+import os
+import sys
+import time
+import json
+import datetime
+import platform
+import subprocess
+import threading
+import argparse
+import numpy as np
+import psutil
+import scipy
+
+import sim_reconstruction as sim
+import analysis_tools as tools
+import fit_psf as psf
+
+# stages of the reconstruction. Stages after "init" are methods of SimImageSet called by reconstruct()
+stage_methods = {"frq_fit": "estimate_sim_frqs",
+                 "phase_fit": "estimate_sim_phases",
+                 "mod_depth": "estimate_mod_depths",
+                 "combine": "combine_components",
+                 "widefield_deconvolution": "deconvolve_widefield"}
+
+
+class RssMonitor(threading.Thread):
+    """
+    Sample the resident set size of this process in a background thread, so the peak memory use during any time
+    interval can be found after the fact
+    """
+    def __init__(self, interval=0.002):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.process = psutil.Process()
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.samples.append((time.perf_counter(), self.process.memory_info().rss))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def peak(self, tstart, tend):
+        rss = [r for t, r in self.samples if tstart <= t <= tend]
+        rss.append(self.process.memory_info().rss)
+        return max(rss)
+
+
+class StageTimer:
+    """
+    Record wall time and peak resident memory of named stages
+    """
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.stages = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        rss_start = self.monitor.process.memory_info().rss
+        tstart = time.perf_counter()
+        result = fn(*args, **kwargs)
+        tend = time.perf_counter()
+
+        self.stages[name] = {"wall_time_s": tend - tstart,
+                             "rss_start_mb": rss_start / 1e6,
+                             "peak_rss_mb": self.monitor.peak(tstart, tend) / 1e6}
+        return result
+
+    def wrap(self, name, fn):
+        return lambda *args, **kwargs: self.run(name, fn, *args, **kwargs)
+
+
+def get_ground_truth(nx, pattern):
+    """
+    Ground truth image with values between 0 and 1
+
+    :param nx: image size
+    :param pattern: "points" for sparse point emitters, or "lines" for line pairs of decreasing separation at
+    several angles, as generated by get_lines_test_pattern()
+    :return gt:
+    """
+    if pattern == "points":
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(int(np.round(nx**2 / 64)), 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+    elif pattern == "lines":
+        # line pattern has a fixed size, so generate on a large enough grid and crop
+        n = max(nx, 512)
+        patterns, _ = sim.get_lines_test_pattern((n, n), angles=(0, 45, 90, 135))
+        gt = np.max(patterns, axis=0).astype(float)
+        start = (n - nx) // 2
+        gt = gt[start:start + nx, start:start + nx]
+    else:
+        raise ValueError("pattern must be 'points' or 'lines', but was '%s'" % pattern)
+
+    return gt
+
+
+def rel_error(img, ref):
+    # allow for an overall scale factor between the reconstruction and ground truth
+    scale = np.sum(img * ref) / np.sum(img * img)
+    return float(np.linalg.norm(scale * img - ref) / np.linalg.norm(ref))
+
+
+def run_benchmark(nx, max_photons, precision, pattern, monitor, options, use_rfft=False):
+    """
+    Simulate SIM images and time each stage of their reconstruction
+
+    :return result: dictionary of benchmark results
+    """
+    frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+    phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+    mod_depths = np.array([0.85, 0.85, 0.85])
+
+    fx = tools.get_fft_frqs(nx, options['pixel_size'])
+    otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+    gt = get_ground_truth(nx, pattern)
+    imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, max_photons, 1, 100, 0,
+                                            options['pixel_size'], otf=otf, use_otf=True)
+    imgs = np.round(imgs).astype(np.uint16)
+
+    timer = StageTimer(monitor)
+    rss_start = monitor.process.memory_info().rss
+    tstart = time.perf_counter()
+
+    geometry = timer.run("geometry", sim.get_reconstruction_geometry, nx, nx, options['pixel_size'],
+                         options['na'], options['wavelength'], otf=otf)
+    imgs_pre = timer.run("preprocess", sim.preprocess_sim_imgs, imgs)
+    if precision == "single":
+        imgs_pre = imgs_pre.astype(np.float32)
+    imgs_ft = timer.run("ft", sim.get_sim_imgs_ft, imgs_pre, half_plane=use_rfft)
+
+    r = timer.run("init", sim.SimImageSet, options, imgs_pre, frqs + 0.05, otf=otf, phases_guess=phases,
+                  geometry=geometry, imgs_ft=imgs_ft, use_rfft=use_rfft, precision=precision, diagnostics="none")
+
+    # time stages of reconstruct() by wrapping the methods of this instance
+    for name, method in stage_methods.items():
+        setattr(r, method, timer.wrap(name, getattr(r, method)))
+    timer.run("reconstruct", r.reconstruct)
+
+    tend = time.perf_counter()
+
+    # ground truth on the upsampled grid of the reconstruction, limited to the frequencies SIM can recover
+    fmax = 1 / (0.5 * options['wavelength'] / options['na'])
+    gt_ft = tools.expand_fourier_sp(tools.ft2(gt), mx=geometry['f_upsample'], my=geometry['f_upsample'],
+                                    centered=True)
+    gt_ft[geometry['ff_us'] > fmax + np.max(np.linalg.norm(frqs, axis=1))] = 0
+    gt_us = tools.ift2(gt_ft).real
+
+    result = {"nx": nx,
+              "max_photons": max_photons,
+              "precision": precision,
+              "pattern": pattern,
+              "use_rfft": use_rfft,
+              "stages": timer.stages,
+              "total_wall_time_s": tend - tstart,
+              "rss_start_mb": rss_start / 1e6,
+              "peak_rss_mb": monitor.peak(tstart, tend) / 1e6,
+              "error_sim": rel_error(r.img_sr, gt_us),
+              "error_widefield_deconvolution": rel_error(r.widefield_deconvolution, gt_us),
+              "frq_error": float(np.max(np.linalg.norm(r.frqs - frqs, axis=1)))}
+
+    return result
+
+
+def get_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"commit": commit,
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "total_memory_mb": psutil.virtual_memory().total / 1e6,
+            "fft_backend": tools.get_fft_backend()}
+
+
+def compare(fname_old, fname_new):
+    """
+    Print the ratio of the wall times and peak memory of each stage between two benchmark runs
+    """
+    with open(fname_old, "r") as f:
+        old = json.load(f)
+    with open(fname_new, "r") as f:
+        new = json.load(f)
+
+    print("old: commit %s, %s" % (old["metadata"]["commit"], old["metadata"]["date"]))
+    print("new: commit %s, %s" % (new["metadata"]["commit"], new["metadata"]["date"]))
+
+    def key(res):
+        return res["nx"], res["max_photons"], res["precision"], res["pattern"], res["use_rfft"]
+
+    old_results = {}
+    for res in old["results"]:
+        old_results.setdefault(key(res), []).append(res)
+
+    for res_new in new["results"]:
+        k = key(res_new)
+        if k not in old_results:
+            continue
+        res_old = old_results[k][0]
+
+        print("nx=%d, photons=%d, %s precision, %s, rfft=%s: error %0.4f -> %0.4f" %
+              (k + (res_old["error_sim"], res_new["error_sim"])))
+        for stage, v_new in res_new["stages"].items():
+            if stage not in res_old["stages"]:
+                continue
+            v_old = res_old["stages"][stage]
+            print("    %-25s %8.3fs -> %8.3fs (x%0.2f), peak rss %8.1fMB -> %8.1fMB" %
+                  (stage, v_old["wall_time_s"], v_new["wall_time_s"], v_new["wall_time_s"] / v_old["wall_time_s"],
+                   v_old["peak_rss_mb"], v_new["peak_rss_mb"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark SIM reconstruction on simulated data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024, 2048],
+                        help="image sizes in pixels")
+    parser.add_argument("--photons", type=int, nargs="+", default=[100, 1000],
+                        help="maximum photon numbers, which set the SNR of the simulated images")
+    parser.add_argument("--precision", type=str, nargs="+", choices=["double", "single"], default=["double"])
+    parser.add_argument("--pattern", type=str, choices=["points", "lines"], default="points",
+                        help="ground truth used to simulate the SIM images")
+    parser.add_argument("--rfft", action="store_true", help="store the raw image spectra as half-planes")
+    parser.add_argument("--repeats", type=int, default=1, help="number of times to run each benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="JSON file to save results to. If not provided, a file name including the time is used")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two JSON results files instead of running benchmarks")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        sys.exit()
+
+    options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+
+    monitor = RssMonitor()
+    monitor.start()
+
+    results = []
+    try:
+        for nx in args.sizes:
+            for max_photons in args.photons:
+                for precision in args.precision:
+                    for rr in range(args.repeats):
+                        np.random.seed(args.seed + rr)
+                        res = run_benchmark(nx, max_photons, precision, args.pattern, monitor, options,
+                                            use_rfft=args.rfft)
+                        res["repeat"] = rr
+                        results.append(res)
+
+                        print("nx=%d, photons=%d, %s precision: %0.2fs, peak rss %0.1fMB, error = %0.4f" %
+                              (nx, max_photons, precision, res["total_wall_time_s"], res["peak_rss_mb"],
+                               res["error_sim"]))
+                        for stage, v in res["stages"].items():
+                            print("    %-25s %8.3fs, peak rss %8.1fMB" % (stage, v["wall_time_s"], v["peak_rss_mb"]))
+    finally:
+        monitor.stop()
+
+        fname = args.output
+        if fname is None:
+            fname = "%s_sim_benchmark.json" % tools.get_timestamp()
+
+        with open(fname, "w") as f:
+            json.dump({"metadata": get_metadata(), "results": results}, f, indent=2)
+        print("saved results to %s" % fname)
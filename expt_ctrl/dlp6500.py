@@ -11,12 +11,23 @@ combine_patterns() function was inspired by https://github.com/csi-dcsc/Pycrafte
 TODO: would love to use the SDK, http://www.ti.com/tool/DLP-ALC-LIGHTCRAFTER-SDK, not very well document, and produces
 static library, not dll so can't easily use with ctypes.
 """
-import pywinusb.hid as pyhid
+import os
 import struct
 import time
+import json
+import hashlib
+import threading
+import collections
+import concurrent.futures
 import numpy as np
 import copy
 
+# only needed to communicate with the DMD on windows, not for encoding patterns
+try:
+    import pywinusb.hid as pyhid
+except ImportError:
+    pyhid = None
+
 ##############################################
 # compress DMD pattern data
 ##############################################
@@ -82,84 +93,160 @@ def split_combined_patterns(combined_patterns):
 
     return patterns
 
-def encode_erle(pattern):
+def _get_rgb_pattern(pattern):
     """
-
-    'erle': enhanced run length encoding. Similar to RLE, but now the number of repeats byte is given by
-    either one or two bytes.
-
-    specification:
-    ctrl byte 1, ctrl byte 2, ctrl byte 3, description
-    0          , 0          , n/a        , end of image
-    0          , 1          , n          , copy n pixels from the same position on the previous line
-    0          , n>1        , n/a        , n uncompressed RGB pixels follow
-    n>1        , n/a        , n/a        , repeat following pixel n times
+    Check pattern is uint8 and expand 2D patterns to RGB, with pattern in B layer and RG=0
 
     :param pattern: uint8 3 x Ny x Nx array of RGB values, or Ny x Nx array
-    :return:
+    :return rgb_pattern: 3 x Ny x Nx array
     """
-
     # pattern must be uint8
     if pattern.dtype != np.uint8:
         raise Exception('pattern must be of type uint8')
 
     # if 2D pattern, expand this to RGB with pattern in B layer and RG=0
     if pattern.ndim == 2:
-        pattern = np.concatenate((np.zeros((1,) + pattern.shape, dtype=np.uint8),
-                                  np.zeros((1,) + pattern.shape, dtype=np.uint8),
-                                  np.array(pattern[None, :, :], copy=True)), axis=0)
+        pattern = np.concatenate((np.zeros((2,) + pattern.shape, dtype=np.uint8), pattern[None, :, :]), axis=0)
 
-    if pattern.ndim != 3 and pattern.shape[0] != 3:
+    if pattern.ndim != 3 or pattern.shape[0] != 3:
         raise Exception("Image data is wrong shape. Must be 3 x ny x nx, with RGB values in each layer.")
 
-    pattern_compressed = []
+    return pattern
+
+def _get_runs(pattern, copy_mode="rows"):
+    """
+    Split each row of an RGB pattern into runs of identical pixels, and into pixels copied from the previous row.
+    All rows are processed at once.
+
+    :param pattern: 3 x Ny x Nx uint8 array
+    :param copy_mode: "rows" to copy entire rows which are the same as the previous row, "partial" to also copy
+    parts of rows which are the same as the previous row when this makes the encoded pattern shorter, or "none"
+    :return starts: indices of the first pixel of each run in the flattened image, in increasing order
+    :return lens: length of each run
+    :return is_copy: whether each run is copied from the previous row
+    :return rgb: 3 x nruns, pixel value of each run
+    """
     _, ny, nx = pattern.shape
+    npix = ny * nx
+
+    # combine RGB values so a change in any color is a change in value
+    vals = (pattern[0].astype(np.uint32) << 16) | (pattern[1].astype(np.uint32) << 8) | pattern[2]
 
+    # every row starts a new run
+    run_start = np.ones((ny, nx), dtype=bool)
+    run_start[:, 1:] = vals[:, 1:] != vals[:, :-1]
 
-    # todo: not sure if this is allowed to cross row_rgb boundaries? If so, could pattern.ravel() instead of looping
-    # todo: don't think above suggestion works, but if last n pixels of above row_rgb are same as first n of this one
-    # todo: then with ERLE encoding I can use \x00\x01 Hex(n). But checking this may not be so easy. Right now
-    # todo: only implemented if entire rows are the same!
-    # todo: erle and rle are different enough probably should split apart more
-    # loop over pattern rows
-    for ii in range(pattern.shape[1]):
-        row_rgb = pattern[:, ii, :]
-
-        # if this row_rgb is the same as the last row_rgb, can communicate this by sending length of row_rgb
-        # and then \x00\x01 (copy n pixels from previous line)
-        # todo: can also do this for shorter sequences than the entire row_rgb
-        if ii > 0 and np.array_equal(row_rgb, pattern[:, ii - 1, :]):
-            msb, lsb = erle_len2bytes(nx)
-            pattern_compressed += [0x00, 0x01, msb, lsb]
+    if copy_mode == "none":
+        starts = np.flatnonzero(run_start)
+        is_copy = np.zeros(starts.shape, dtype=bool)
+    else:
+        # pixels which are the same as the pixel above
+        same = np.zeros((ny, nx), dtype=bool)
+        same[1:] = vals[1:] == vals[:-1]
+
+        if copy_mode == "rows":
+            rows, = np.nonzero(np.all(same, axis=1))
+            copy_starts = rows * nx
+            copy_ends = copy_starts + nx
+        elif copy_mode == "partial":
+            # segments of consecutive pixels in the same row which are the same as the pixels above
+            edges = np.diff(np.pad(same, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+            rows, cols = np.nonzero(edges == 1)
+            _, cols_end = np.nonzero(edges == -1)
+            copy_starts = rows * nx + cols
+            copy_ends = rows * nx + cols_end
+
+            # number of bytes needed to encode the runs starting in each segment
+            starts_all = np.flatnonzero(run_start)
+            lens_all = np.diff(np.append(starts_all, npix))
+            run_bytes = np.zeros(npix + 1, dtype=np.int64)
+            run_bytes[starts_all + 1] = 4 + (lens_all >= 128)
+            run_bytes = np.cumsum(run_bytes)
+            bytes_runs = run_bytes[copy_ends] - run_bytes[copy_starts]
+
+            # copying a segment requires a new run to start after it, unless one already does
+            next_start = np.append(starts_all, npix)[np.searchsorted(starts_all, copy_ends, side="left")]
+            new_run = np.logical_and(copy_ends % nx != 0, next_start != copy_ends)
+            next_start = np.append(starts_all, npix)[np.searchsorted(starts_all, copy_ends, side="right")]
+            bytes_new_run = new_run * (4 + (next_start - copy_ends >= 128))
+
+            bytes_copy = 3 + (copy_ends - copy_starts >= 128)
+            use_copy = bytes_copy + bytes_new_run < bytes_runs
+
+            copy_starts = copy_starts[use_copy]
+            copy_ends = copy_ends[use_copy]
         else:
+            raise ValueError("copy_mode must be 'none', 'rows', or 'partial', but was '%s'" % copy_mode)
 
-            # find points along row where pixel value changes
-            # for RGB image, change happens when ANY pixel value changes
-            value_changed = np.sum(np.abs(np.diff(row_rgb, axis=1)), axis=0) != 0
-            # also need to include zero, as this will need to be encoded.
-            # add one to index to get position of first new value instead of last old value
-            inds_change = np.concatenate((np.array([0]), np.where(value_changed)[0] + 1))
+        # runs inside copied segments are replaced by the copy, and a new run starts after each copied segment
+        covered = np.zeros(npix + 1, dtype=np.int32)
+        np.add.at(covered, copy_starts, 1)
+        np.add.at(covered, copy_ends, -1)
+        covered = np.cumsum(covered[:-1]) > 0
 
-            # get lengths for each repeat, including last one which extends until end of the line
-            run_lens = np.concatenate((np.array(inds_change[1:] - inds_change[:-1]),
-                                       np.array([nx - inds_change[-1]])))
+        run_start = run_start.ravel()
+        run_start[covered] = False
+        run_start[copy_starts] = True
+        run_start[copy_ends[copy_ends < npix]] = True
 
-            # now build compressed list
-            for ii, rlen in zip(inds_change, run_lens):
-                v = row_rgb[:, ii]
-                length_bytes = erle_len2bytes(rlen)
-                pattern_compressed += length_bytes + [v[0], v[1], v[2]]
+        starts = np.flatnonzero(run_start)
+        is_copy = np.zeros(npix, dtype=bool)
+        is_copy[copy_starts] = True
+        is_copy = is_copy[starts]
 
-            # for ii in range(len(run_lens)):
-            #     v = vals[:, ii]
-            #     length_bytes = erle_len2bytes(run_lens[ii])
-            #     pattern_compressed += length_bytes + [v[0], v[1], v[2]]
+    lens = np.diff(np.append(starts, npix))
+    rgb = pattern.reshape(3, npix)[:, starts]
+
+    return starts, lens, is_copy, rgb
+
+def encode_erle(pattern, copy_mode="rows"):
+    """
+
+    'erle': enhanced run length encoding. Similar to RLE, but now the number of repeats byte is given by
+    either one or two bytes.
+
+    specification:
+    ctrl byte 1, ctrl byte 2, ctrl byte 3, description
+    0          , 0          , n/a        , end of image
+    0          , 1          , n          , copy n pixels from the same position on the previous line
+    0          , n>1        , n/a        , n uncompressed RGB pixels follow
+    n>1        , n/a        , n/a        , repeat following pixel n times
+
+    Runs are found for the whole image at once, and the encoded bytes are written directly to a preallocated array.
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, or Ny x Nx array
+    :param copy_mode: "rows" to encode rows which are the same as the previous row by copying the previous row.
+    "partial" to also copy parts of rows from the previous row, whenever this makes the encoded pattern shorter.
+    :return pattern_compressed: bytearray
+    """
+    pattern = _get_rgb_pattern(pattern)
+    starts, lens, is_copy, rgb = _get_runs(pattern, copy_mode=copy_mode)
+
+    if np.any(lens > 2 ** 15 - 1):
+        raise Exception('length is negative or too large to be encoded.')
+
+    # each run is [length bytes, R, G, B] and each copy is [0x00, 0x01, length bytes]
+    # lengths are encoded as one byte if < 128, and otherwise two bytes, see erle_len2bytes()
+    two_byte = lens >= 128
+    nbytes = 4 + two_byte - is_copy
+    offsets = np.concatenate(([0], np.cumsum(nbytes)))
 
     # bytes indicating image end
-    #pattern_compressed += [0x00]
-    pattern_compressed += [0x00, 0x01, 0x00]
+    pattern_compressed = np.zeros(offsets[-1] + 3, dtype=np.uint8)
+    pattern_compressed[-3:] = [0x00, 0x01, 0x00]
+
+    len_pos = offsets[:-1] + 2 * is_copy
+    pattern_compressed[len_pos] = np.where(two_byte, (lens & 0x7F) | 0x80, lens)
+    pattern_compressed[len_pos[two_byte] + 1] = lens[two_byte] >> 7
+
+    pattern_compressed[offsets[:-1][is_copy] + 1] = 0x01
 
-    return pattern_compressed
+    is_run = np.logical_not(is_copy)
+    rgb_pos = len_pos[is_run] + 1 + two_byte[is_run]
+    for ii in range(3):
+        pattern_compressed[rgb_pos + ii] = rgb[ii, is_run]
+
+    return bytearray(pattern_compressed)
 
 def encode_rle(pattern):
     """
@@ -183,159 +270,286 @@ def encode_rle(pattern):
     n>0        , n/a       , repeat following RGB pixel n times
 
     :param pattern:
-    :return:
+    :return pattern_compressed: bytearray
     """
-    # pattern must be uint8
-    if pattern.dtype != np.uint8:
-        raise Exception('pattern must be of type uint8')
-
-    # if 2D pattern, expand this to RGB with pattern in B layer and RG=0
-    if pattern.ndim == 2:
-        pattern = np.concatenate((np.zeros((1,) + pattern.shape, dtype=np.uint8),
-                                  np.zeros((1,) + pattern.shape, dtype=np.uint8),
-                                  np.array(pattern[None, :, :], copy=True)), axis=0)
-
-    if pattern.ndim != 3 and pattern.shape[0] != 3:
-        raise Exception("Image data is wrong shape. Must be 3 x ny x nx, with RGB values in each layer.")
-
-    pattern_compressed = []
+    pattern = _get_rgb_pattern(pattern)
     _, ny, nx = pattern.shape
+    starts, lens, is_copy, rgb = _get_runs(pattern, copy_mode="rows")
 
-    # loop over pattern rows
-    for ii in range(pattern.shape[1]):
-        row_rgb = pattern[:, ii, :]
+    # rows which are the same as the previous row are encoded with the ERLE copy command
+    # todo: is this correct for RLE?
+    if np.any(is_copy) and nx < 128:
+        raise Exception("rows shorter than 128 pixels cannot be copied")
 
-        # if this row_rgb is the same as the last row_rgb, can communicate this by sending length of row_rgb
-        # and then \x00\x01 (copy n pixels from previous line)
-        # todo: can also do this for shorter sequences than the entire row_rgb
-        if ii > 0 and np.array_equal(row_rgb, pattern[:, ii - 1, :]):
-            msb, lsb = erle_len2bytes(nx)
-            pattern_compressed += [0x00, 0x01, msb, lsb]
-        else:
+    # runs longer than 255 pixels are broken up into runs of 255 pixels followed by the remainder
+    nchunks = np.where(is_copy, 1, (lens + 254) // 255)
+    chunk_run = np.repeat(np.arange(len(lens)), nchunks)
+    chunk_index = np.arange(len(chunk_run)) - np.repeat(np.cumsum(nchunks) - nchunks, nchunks)
+    chunk_lens = np.minimum(lens[chunk_run] - 255 * chunk_index, 255)
 
-            # find points along row where pixel value changes
-            # for RGB image, change happens when ANY pixel value changes
-            value_changed = np.sum(np.abs(np.diff(row_rgb, axis=1)), axis=0) != 0
-            # also need to include zero, as this will need to be encoded.
-            # add one to index to get position of first new value instead of last old value
-            inds_change = np.concatenate((np.array([0]), np.where(value_changed)[0] + 1))
-
-            # get lengths for each repeat, including last one which extends until end of the line
-            run_lens = np.concatenate((np.array(inds_change[1:] - inds_change[:-1]),
-                                       np.array([nx - inds_change[-1]])))
-
-            # now build compressed list
-            for ii, rlen in zip(inds_change, run_lens):
-                v = row_rgb[:, ii]
-                if rlen <= 255:
-                    pattern_compressed += [rlen, v[0], v[1], v[2]]
-                else:  # if run is longer than one byte, need to break it up
-
-                    counter = 0
-                    while counter < rlen:
-                        end_pt = np.min([counter + 255, rlen]) - 1
-                        current_len = end_pt - counter + 1
-                        pattern_compressed += [current_len, v[0], v[1], v[2]]
-
-                        counter = end_pt + 1
-            # todo: do I need an end of line character?
+    pattern_compressed = np.zeros((len(chunk_run), 4), dtype=np.uint8)
+    pattern_compressed[:, 0] = chunk_lens
+    pattern_compressed[:, 1:] = rgb[:, chunk_run].transpose()
 
-    # todo: is this correct for RLE?
-    # bytes indicating image end
-    pattern_compressed += [0x00]
+    copy_row = is_copy[chunk_run]
+    pattern_compressed[copy_row] = [0x00, 0x01, (nx & 0x7F) | 0x80, nx >> 7]
 
-    return pattern_compressed
+    # todo: do I need an end of line character?
+    # bytes indicating image end
+    return bytearray(pattern_compressed.tobytes() + b"\x00")
 
 def decode_erle(dmd_size, pattern_bytes):
     """
     Decode pattern from ERLE or RLE.
 
+    The byte stream is parsed in a single pass which only records the position, length and data offset of each run.
+    Runs and uncompressed pixels are then written at once, and copies from the previous line are applied in order.
+
     :param dmd_size: [ny, nx]
-    :param pattern_bytes: list of bytes representing encoded pattern
-    :return:
+    :param pattern_bytes: bytes, bytearray, or list of bytes representing encoded pattern
+    :return rgb_pattern: 3 x ny x nx array
     """
+    ny, nx = dmd_size
+    pattern_bytes = bytes(bytearray(pattern_bytes))
+    nbytes = len(pattern_bytes)
 
-    ii = 0 # counter tracking position in compressed byte array
-    line_no = 0 # counter tracking line number
-    line_pos = 0 # counter tracking next position to write in line
-    current_line = np.zeros((3, dmd_size[1]), dtype=np.uint8)
-    rgb_pattern = np.zeros((3, 0, dmd_size[1]), dtype=np.uint8)
-    # todo: maybe should rewrite popping everything to avoid dealing with at least one counter?
-    while ii < len(pattern_bytes):
-
-        # reset each new line
-        if line_pos == dmd_size[1]:
-            rgb_pattern = np.concatenate((rgb_pattern, current_line[:, None, :]), axis=1)
-            current_line = np.zeros((3, dmd_size[1]), dtype=np.uint8)
-            line_pos = 0
-            line_no += 1
-        elif line_pos >= dmd_size[1]:
-            raise Exception("While reading line %d, length of line exceeded expected value" % line_no)
+    # position, length, and offset of data in pattern_bytes for each run of pixels
+    # offset is -1 for pixels copied from the previous line
+    positions = []
+    lens = []
+    offsets = []
+    strides = []
 
+    ii = 0 # counter tracking position in compressed byte array
+    pos = 0 # counter tracking next pixel to write in flattened image
+    while ii < nbytes:
         # end of image denoted by single 0x00 byte
-        if ii == len(pattern_bytes) - 1:
+        if ii == nbytes - 1:
             if pattern_bytes[ii] == 0:
                 break
             else:
                 raise Exception('Image not terminated with 0x00')
 
+        copy_line = False
+        stride = 0
         # control byte of zero indicates special response
         if pattern_bytes[ii] == 0:
-
             # end of line
             if pattern_bytes[ii + 1] == 0:
-                ii += 1
+                pos = -(-pos // nx) * nx
+                ii += 2
                 continue
 
-            # copy bytes from previous lines
+            # copy bytes from same position in previous line
             elif pattern_bytes[ii + 1] == 1:
-                if pattern_bytes[ii + 2] < 128:
-                    n_to_copy = pattern_bytes[ii + 2]
-                    ii += 3
-                else:
-                    n_to_copy = erle_bytes2len(pattern_bytes[ii + 2 : ii + 4])
-                    ii += 4
-
-                # copy bytes from same position in previous line
-                current_line[:, line_pos:line_pos + n_to_copy] = rgb_pattern[:, line_no-1, line_pos:line_pos + n_to_copy]
-                line_pos += n_to_copy
-
+                copy_line = True
+                ii += 2
             # next n bytes unencoded
             else:
-                if pattern_bytes[ii + 1] < 128:
-                    n_unencoded = pattern_bytes[ii + 1]
-                    ii += 2
-                else:
-                    n_unencoded = erle_bytes2len(pattern_bytes[ii + 1 : ii + 3])
-                    ii += 3
+                stride = 3
+                ii += 1
 
-                for jj in range(n_unencoded):
-                    current_line[0, line_pos + jj] = int(pattern_bytes[ii + 3*jj])
-                    current_line[1, line_pos + jj] = int(pattern_bytes[ii + 3*jj + 1])
-                    current_line[2, line_pos + jj] = int(pattern_bytes[ii + 3*jj + 2])
+        # get block len
+        n = pattern_bytes[ii]
+        if n < 128:
+            ii += 1
+        else:
+            n = erle_bytes2len(pattern_bytes[ii:ii + 2])
+            ii += 2
 
-                ii += 3 * n_unencoded
-                line_pos += n_unencoded
+        if copy_line:
+            offset = -1
+        else:
+            offset = ii
+            ii += 3 if stride == 0 else 3 * n
 
+        if n == 0:
             continue
 
-        # control byte != 0, regular decoding
-        # get block len
-        if pattern_bytes[ii] < 128:
-            block_len = pattern_bytes[ii]
-            ii += 1
+        if pos // nx != (pos + n - 1) // nx:
+            raise Exception("While reading line %d, length of line exceeded expected value" % (pos // nx))
+
+        positions.append(pos)
+        lens.append(n)
+        offsets.append(offset)
+        strides.append(stride)
+        pos += n
+
+    if pos > ny * nx:
+        raise Exception("Decoded %d pixels, but expected at most %d" % (pos, ny * nx))
+
+    positions = np.array(positions, dtype=np.int64)
+    lens = np.array(lens, dtype=np.int64)
+    offsets = np.array(offsets, dtype=np.int64)
+    strides = np.array(strides, dtype=np.int64)
+
+    rgb_pattern = np.zeros((3, ny * nx), dtype=np.uint8)
+    data = np.frombuffer(pattern_bytes, dtype=np.uint8)
+
+    # write runs and uncompressed pixels
+    is_copy = offsets < 0
+    decoded = np.logical_not(is_copy)
+    run_lens = lens[decoded]
+    within = np.arange(np.sum(run_lens)) - np.repeat(np.cumsum(run_lens) - run_lens, run_lens)
+    pix = np.repeat(positions[decoded], run_lens) + within
+    src = np.repeat(offsets[decoded], run_lens) + np.repeat(strides[decoded], run_lens) * within
+    for jj in range(3):
+        rgb_pattern[jj, pix] = data[src + jj]
+
+    # copies refer to earlier lines, so are complete once earlier copies have been applied
+    for pos, n in zip(positions[is_copy], lens[is_copy]):
+        if pos < nx:
+            raise Exception("Cannot copy pixels from previous line while reading first line")
+        rgb_pattern[:, pos:pos + n] = rgb_pattern[:, pos - nx:pos - nx + n]
+
+    return rgb_pattern.reshape(3, ny, nx)
+
+# compressed patterns, keyed by a hash of the combined pattern and compression settings
+compressed_pattern_cache_size = 256
+compressed_pattern_cache_max_bytes = 500e6
+_compressed_pattern_cache = collections.OrderedDict()
+_compressed_pattern_cache_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+_compressed_pattern_cache_lock = threading.Lock()
+# version of the compressed pattern format, included in the hash. Increment whenever the output of encode_erle(),
+# encode_rle() or the uncompressed packing changes, so patterns compressed by older versions are not loaded from disk
+pattern_encoder_version = 1
+
+def get_pattern_hash(pattern, compression_mode="erle", copy_mode="rows"):
+    """
+    Hash identifying a pattern and how it is compressed, including the version of the compressed format
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, or Ny x Nx array
+    :param compression_mode: 'erle', 'rle', or 'none'
+    :param copy_mode: passed to encode_erle()
+    :return hash: hexadecimal string
+    """
+    pattern = np.ascontiguousarray(pattern)
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(("%d_%s_%s_%s_%s" % (pattern_encoder_version, compression_mode, copy_mode, pattern.dtype.str,
+                                  pattern.shape)).encode())
+    h.update(pattern.data)
+
+    return h.hexdigest()
+
+def encode_pattern(pattern, compression_mode="erle", copy_mode="rows", cache_dir=None):
+    """
+    Compress a pattern, reusing the result if the same pattern has been compressed before. Compressed patterns are
+    kept in memory, and if cache_dir is not None, are also stored in and loaded from this directory. Patterns can be
+    compressed ahead of time using encode_dmd_patterns.py
+
+    :param pattern: uint8 3 x Ny x Nx array of RGB values, or Ny x Nx array, typically produced by combine_patterns()
+    :param compression_mode: 'erle', 'rle', or 'none'
+    :param copy_mode: passed to encode_erle()
+    :param cache_dir: directory to store compressed patterns in. If None, they are only kept in memory
+    :return pattern_compressed: bytearray
+    """
+    key = get_pattern_hash(pattern, compression_mode, copy_mode)
+
+    with _compressed_pattern_cache_lock:
+        if key in _compressed_pattern_cache:
+            _compressed_pattern_cache.move_to_end(key)
+            _compressed_pattern_cache_stats["hits"] += 1
+            return bytearray(_compressed_pattern_cache[key])
+
+    fname = None if cache_dir is None else os.path.join(cache_dir, "%s.%s" % (key, compression_mode))
+    if fname is not None and os.path.exists(fname):
+        with open(fname, "rb") as f:
+            pattern_compressed = f.read()
+        stat = "disk_hits"
+    else:
+        if compression_mode == 'erle':
+            pattern_compressed = bytes(encode_erle(pattern, copy_mode=copy_mode))
+        elif compression_mode == 'rle':
+            pattern_compressed = bytes(encode_rle(pattern))
+        elif compression_mode == 'none':
+            pattern_compressed = np.packbits(pattern.ravel()).tobytes()
         else:
-            block_len = erle_bytes2len(pattern_bytes[ii : ii + 2])
-            ii += 2
+            raise ValueError("compression_mode must be 'erle', 'rle', or 'none', but was '%s'" % compression_mode)
+        stat = "misses"
+
+        if fname is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
 
-        # write values to lists for rgb colors
-        current_line[0, line_pos:line_pos + block_len] = np.asarray([pattern_bytes[ii]] * block_len, dtype=np.uint8)
-        current_line[1, line_pos:line_pos + block_len] = np.asarray([pattern_bytes[ii + 1]] * block_len, dtype=np.uint8)
-        current_line[2, line_pos:line_pos + block_len] = np.asarray([pattern_bytes[ii + 2]] * block_len, dtype=np.uint8)
-        ii += 3
-        line_pos += block_len
+            # write to temporary file first, so other processes never read a partial file
+            with open(fname + ".tmp", "wb") as f:
+                f.write(pattern_compressed)
+            os.replace(fname + ".tmp", fname)
 
-    return rgb_pattern
+    with _compressed_pattern_cache_lock:
+        _compressed_pattern_cache_stats[stat] += 1
+        _compressed_pattern_cache[key] = pattern_compressed
+
+        # evict least recently used patterns
+        nbytes = sum(len(v) for v in _compressed_pattern_cache.values())
+        while len(_compressed_pattern_cache) > 1 and (len(_compressed_pattern_cache) > compressed_pattern_cache_size or
+                                                      nbytes > compressed_pattern_cache_max_bytes):
+            _, v = _compressed_pattern_cache.popitem(last=False)
+            nbytes -= len(v)
+
+    return bytearray(pattern_compressed)
+
+def get_compressed_pattern_cache_info():
+    """
+    :return info: dictionary {'hits', 'disk_hits', 'misses', 'entries', 'bytes'}
+    """
+    with _compressed_pattern_cache_lock:
+        info = dict(_compressed_pattern_cache_stats)
+        info["entries"] = len(_compressed_pattern_cache)
+        info["bytes"] = sum(len(v) for v in _compressed_pattern_cache.values())
+
+    return info
+
+def clear_compressed_pattern_cache():
+    """
+    Remove all compressed patterns from memory and reset cache statistics. Patterns stored on disk are not removed.
+    """
+    with _compressed_pattern_cache_lock:
+        _compressed_pattern_cache.clear()
+        for k in _compressed_pattern_cache_stats.keys():
+            _compressed_pattern_cache_stats[k] = 0
+
+def iter_encoded_patterns(patterns, indices, compression_mode="erle", cache_dir=None, n_ahead=2, n_workers=1):
+    """
+    Compress patterns in background threads, while the caller works with previously compressed patterns. This allows
+    compressing patterns to overlap with sending them to the DMD. At most n_ahead compressed patterns are kept waiting,
+    so memory use is bounded.
+
+    :param patterns: sequence of patterns, typically produced by combine_patterns()
+    :param indices: indices of patterns to compress, in the order they are needed
+    :param compression_mode: 'erle', 'rle', or 'none'
+    :param cache_dir: directory where compressed patterns are stored, see encode_pattern()
+    :param n_ahead: number of patterns to compress ahead of the one being used. If 0, patterns are compressed in the
+    calling thread when they are needed
+    :param n_workers: number of threads compressing patterns
+    :return: generator yielding (index, pattern_compressed)
+    """
+    indices = list(indices)
+
+    if n_ahead <= 0:
+        for ii in indices:
+            yield ii, encode_pattern(patterns[ii], compression_mode, cache_dir=cache_dir)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = collections.deque()
+        next_index = 0
+        try:
+            while futures or next_index < len(indices):
+                # the pattern being used and up to n_ahead more are compressed or in progress
+                while next_index < len(indices) and len(futures) <= n_ahead:
+                    ii = indices[next_index]
+                    futures.append((ii, executor.submit(encode_pattern, patterns[ii], compression_mode,
+                                                        cache_dir=cache_dir)))
+                    next_index += 1
+
+                ii, future = futures.popleft()
+                yield ii, future.result()
+        finally:
+            # if the caller stops early, do not compress the remaining patterns
+            for _, future in futures:
+                future.cancel()
 
 def erle_len2bytes(length):
     """
@@ -399,6 +613,70 @@ def erle_bytes2len(byte_list):
 
     return length
 
+def _get_sequence_times(times, n, name):
+    """
+    Get list of exposure or dark times for a sequence of n patterns
+
+    :param times: single integer time, which is used for all patterns, or list of n integer times
+    :param n: number of patterns
+    :param name: name of argument, used in error messages
+    :return times: list of n times
+    """
+    if not isinstance(times, (list, np.ndarray)):
+        times = [times]
+    times = list(times)
+
+    if not all(list(map(lambda t: isinstance(t, (int, np.integer)), times))):
+        raise Exception("%s must be a list of integers" % name)
+
+    if n > 1 and len(times) == 1:
+        times = times * n
+
+    if len(times) != n:
+        raise Exception("%s must have length 1 or %d, but had length %d" % (name, n, len(times)))
+
+    return times
+
+def _get_sequence_indices(image_indices, bit_indices, mode):
+    """
+    Check indices of the stored images and bits of the patterns in a sequence
+
+    :param image_indices: single integer or list of integers
+    :param bit_indices: single integer or list of integers
+    :param mode: 'pre-stored' or 'on-the-fly'
+    :return image_indices, bit_indices: lists of the same length
+    """
+    image_indices = list(np.atleast_1d(image_indices))
+    bit_indices = list(np.atleast_1d(bit_indices))
+
+    if len(image_indices) != len(bit_indices):
+        raise Exception("image_indices and bit_indices must be the same length.")
+
+    if mode == 'on-the-fly' and 0 not in bit_indices:
+        raise Exception("Known issue (not with this code, but with DMD) that if 0 is not included in the bit"
+                        "indices, then the patterns displayed will not correspond with the indices supplied.")
+
+    return image_indices, bit_indices
+
+def get_lut_entries(exp_times, dark_times, triggered, clear_pattern_after_trigger, bit_depth, image_indices,
+                    bit_indices):
+    """
+    Get the parameters of each pattern display look up table (LUT) entry of a sequence. Each entry is a tuple of
+    (exposure_time_us, dark_time_us, wait_for_trigger, clear_pattern_after_trigger, bit_depth, stored_image_index,
+    stored_image_bit_index), as passed to dlp6500.pattern_display_lut_definition()
+
+    :param exp_times: list of exposure times in us
+    :param dark_times: list of dark times in us
+    :param triggered: Boolean. Whether or not DMD is to wait to be triggered.
+    :param clear_pattern_after_trigger: Boolean.
+    :param bit_depth: bit depth of patterns
+    :param image_indices: list of indices of the stored images
+    :param bit_indices: list of indices of the bit of the stored image of each pattern
+    :return lut: list of tuples
+    """
+    return [(int(et), int(dt), bool(triggered), bool(clear_pattern_after_trigger), int(bit_depth), int(ii), int(bi))
+            for et, dt, ii, bi in zip(exp_times, dark_times, image_indices, bit_indices)]
+
 ##############################################
 # controlling dmd
 ##############################################
@@ -452,6 +730,9 @@ class dlp6500():
         # USB packet length not including report_id_byte
         self.packet_length_bytes = 64
         self.debug = debug
+        # number of times a pattern sequence was programmed, so SequenceManager can tell if the sequence was changed
+        # without it
+        self.sequence_updates = 0
 
         # find device
         self._get_device(vendor_id, product_id)
@@ -485,6 +766,18 @@ class dlp6500():
         """
         pass
 
+    def _send_raw_packets(self, packets):
+        """
+        Send many USB packets back to back without listening for replies. Derived classes can override this to avoid
+        repeating per-packet work which does not depend on the packet contents.
+
+        :param packets: bytes, bytearray, or NumPy array of uint8. Length must be a multiple of packet_length_bytes
+        :return:
+        """
+        packets = bytes(packets)
+        for ii in range(0, len(packets), self.packet_length_bytes):
+            self._send_raw_packet(list(packets[ii:ii + self.packet_length_bytes]), False)
+
     # sending and receiving commands, no operating system dependence
     def send_raw_command(self, buffer, listen_for_reply=False, timeout=5):
         """
@@ -521,24 +814,16 @@ class dlp6500():
 
         return reply
 
-    def send_command(self, rw_mode, reply, command, data=[], sequence_byte=0x00):
+    def _get_command_header(self, rw_mode, reply, command, data_len, sequence_byte=0x00):
         """
-        Send USB command to DLP6500 DMD. Only works on Windows. For documentation of DMD commands, see dlpu018.pdf,
-        available at http://www.ti.com/product/DLPC900/technicaldocuments
-
-        DMD uses little endian byte order.
-
-        They also use the convention that, when converting from binary to hex the MSB is the rightmost. i.e.
-         \b11000000 = \x03. TODO: is this actually true??? Seems to not be true wrt to flag_byte, but true wrt to
-         pattern defining bytes...maybe only care about this for data that is passed through the DMD?
+        Get the header bytes which precede the data of a USB command. See send_command() for details.
 
         :param rw_mode: 'r' for read, or 'w' for write
         :param reply: boolean
         :param command: two byte integer
-        :param data: data to be transmitted. List of integers, where each integer gives a byte
+        :param data_len: number of data bytes in the command
         :param sequence_byte: integer
-        :param print_commands:
-        :return:
+        :return header: list of 6 bytes
         """
 
         # construct header, 4 bytes long
@@ -570,7 +855,7 @@ class dlp6500():
         # second byte is sequence byte. This is used only to identify responses to given commands.
 
         # third and fourth are length of payload, respectively LSB and MSB bytes
-        len_payload = len(data) + 2
+        len_payload = data_len + 2
         len_lsb, len_msb = struct.unpack('BB', struct.pack('H', len_payload))
 
         # get USB command bytes
@@ -579,6 +864,29 @@ class dlp6500():
         # this does not exactly correspond with what TI calls the header. It is a combination of
         # the report id_byte, the header, and the USB command bytes
         header = [flag_byte, sequence_byte, len_lsb, len_msb, cmd_lsb, cmd_msb]
+        return header
+
+    def send_command(self, rw_mode, reply, command, data=[], sequence_byte=0x00):
+        """
+        Send USB command to DLP6500 DMD. Only works on Windows. For documentation of DMD commands, see dlpu018.pdf,
+        available at http://www.ti.com/product/DLPC900/technicaldocuments
+
+        DMD uses little endian byte order.
+
+        They also use the convention that, when converting from binary to hex the MSB is the rightmost. i.e.
+         \b11000000 = \x03. TODO: is this actually true??? Seems to not be true wrt to flag_byte, but true wrt to
+         pattern defining bytes...maybe only care about this for data that is passed through the DMD?
+
+        :param rw_mode: 'r' for read, or 'w' for write
+        :param reply: boolean
+        :param command: two byte integer
+        :param data: data to be transmitted. List of integers, where each integer gives a byte
+        :param sequence_byte: integer
+        :param print_commands:
+        :return:
+        """
+
+        header = self._get_command_header(rw_mode, reply, command, len(data), sequence_byte)
         buffer = header + data
 
         # print commands during debugging
@@ -1103,6 +1411,30 @@ class dlp6500():
         since the header is 6 bytes and the length of the data is represented using 2 bytes, there are 504 data bytes
         After this, have to send a new command.
 
+        The DMD does not reply to these commands, so all packets are built at once and sent back to back.
+
+        :param compressed_pattern: compressed pattern, as returned by encode_pattern()
+        :param compression_mode: 'erle', 'rle', or 'none'
+        :return:
+        """
+        packets = self.get_pattern_bmp_load_packets(compressed_pattern, compression_mode)
+
+        # printing every byte of the image is very slow, so only summarize the command
+        if self.debug:
+            print("PATMEM_LOAD_DATA_MASTER (0x1a2b): %d bytes sent in %d packets" %
+                  (len(compressed_pattern) + 48, len(packets) // self.packet_length_bytes))
+
+        self._send_raw_packets(packets)
+
+    def get_pattern_bmp_load_packets(self, compressed_pattern, compression_mode):
+        """
+        Get all USB packets sent by pattern_bmp_load(). These are identical to the packets which would be sent by
+        calling send_command('w', False, 0x1A2B, data) for each block of at most 504 data bytes, but are generated
+        in a single buffer without per-byte Python operations.
+
+        :param compressed_pattern: compressed pattern, as returned by encode_pattern()
+        :param compression_mode: 'erle', 'rle', or 'none'
+        :return packets: NumPy array of uint8, with length a multiple of packet_length_bytes
         """
         max_cmd_payload = 504
 
@@ -1124,34 +1456,149 @@ class dlp6500():
         elif compression_mode == 'erle':
             encoding_byte = [0x02]
         else:
-            raise Exception()
+            raise Exception("compression_mode must be 'none', 'rle', or 'erle', but was '%s'" % compression_mode)
 
         general_data = signature_bytes + width_byte + height_byte + num_encoded_bytes + \
                  reserved_bytes + bg_color_bytes + [0x01] + encoding_byte + \
                  [0x01] + [0x00] * 2 + [0x01] + [0x00] * 18 # reserved
 
-        data = general_data + compressed_pattern
+        data = np.concatenate((np.array(general_data, dtype=np.uint8),
+                               np.frombuffer(bytes(compressed_pattern), dtype=np.uint8)))
+
+        # each command is the 6 byte header, 2 bytes giving the length of the data block, and the data block, padded
+        # with zeros to a whole number of packets
+        def get_cmd_start(block_len):
+            return self._get_command_header('w', False, 0x1A2B, block_len + 2) + \
+                   list(struct.unpack('BB', struct.pack('<H', block_len)))
+
+        nstart = 8
+        nfull, nlast = divmod(len(data), max_cmd_payload)
+        full_cmd_len = int(np.ceil((nstart + max_cmd_payload) / self.packet_length_bytes)) * self.packet_length_bytes
+        if nlast > 0:
+            last_cmd_len = int(np.ceil((nstart + nlast) / self.packet_length_bytes)) * self.packet_length_bytes
+        else:
+            last_cmd_len = 0
+
+        packets = np.zeros(nfull * full_cmd_len + last_cmd_len, dtype=np.uint8)
 
-        # send multiple commands, each of maximum size 512 bytes including header
-        data_index = 0
-        command_index = 0
-        while data_index < len(data):
-            # slice data to get block to send in this command
-            data_index_next = np.min([data_index + max_cmd_payload, len(data)])
-            data_current = data[data_index:data_index_next]
+        full_cmds = packets[:nfull * full_cmd_len].reshape(nfull, full_cmd_len)
+        full_cmds[:, :nstart] = get_cmd_start(max_cmd_payload)
+        full_cmds[:, nstart:nstart + max_cmd_payload] = data[:nfull * max_cmd_payload].reshape(nfull, max_cmd_payload)
 
-            # len of current data block
-            data_len_bytes = list(struct.unpack('BB', struct.pack('<H', len(data_current))))
+        if nlast > 0:
+            last_cmd = packets[nfull * full_cmd_len:]
+            last_cmd[:nstart] = get_cmd_start(nlast)
+            last_cmd[nstart:nstart + nlast] = data[nfull * max_cmd_payload:]
 
-            # send command
-            self.send_command('w', False, 0x1A2B, data=data_len_bytes + data_current)
+        return packets
 
-            data_index = data_index_next
-            command_index += 1
+    # programming pattern sequences. These steps are shared with SequenceManager
+    def _check_reply(self, reply):
+        """
+        Check the reply to a command, printing the error description if there was an error
+
+        :param reply: reply returned by send_command()
+        :return error: Boolean
+        """
+        resp = self.decode_response(reply[0])
+        if resp['error']:
+            print(self.read_error_description())
+
+        return resp['error']
+
+    def _stop_sequence(self, mode=None):
+        """
+        Stop the current sequence before programming a new one, and optionally change the pattern mode
+
+        :param mode: pattern mode to set, see set_pattern_mode(). If None, the mode is not changed
+        :return error: Boolean
+        """
+        self.sequence_updates += 1
+        error = False
+
+        # need to issue stop before changing mode. Otherwise DMD will sometimes lock up and not be responsive.
+        self.start_stop_sequence('stop')
+
+        if mode is not None:
+            error = self._check_reply(self.set_pattern_mode(mode))
+
+            # stop any currently running sequences
+            # note: want to stop after changing pattern mode, because otherwise may throw error
+            self.start_stop_sequence('stop')
+
+        return error
+
+    def _define_lut_entries(self, lut, positions=None):
+        """
+        Send pattern display LUT definitions
+
+        :param lut: list of LUT entries, see get_lut_entries()
+        :param positions: sequence positions of the entries to send. If None, send all entries
+        :return error: Boolean
+        """
+        if positions is None:
+            positions = range(len(lut))
+
+        error = False
+        for ii in positions:
+            et, dt, trig, clear, bit_depth, img_ind, bit_ind = lut[ii]
+            error |= self._check_reply(self.pattern_display_lut_definition(ii, exposure_time_us=et, dark_time_us=dt,
+                                                                           wait_for_trigger=trig,
+                                                                           clear_pattern_after_trigger=clear,
+                                                                           bit_depth=bit_depth,
+                                                                           stored_image_index=img_ind,
+                                                                           stored_image_bit_index=bit_ind))
+
+        return error
+
+    def _load_images(self, images, indices, compression_mode='erle', cache_dir=None, n_encode_ahead=2):
+        """
+        Compress and load images into DMD memory for on-the-fly mode. Later images are compressed while earlier ones
+        are sent
+
+        :param images: images, typically 24 bit images produced by combine_patterns()
+        :param indices: indices of the images to load. Images must be loaded in backwards order according to the
+        programming manual
+        :param compression_mode: 'erle', 'rle', or 'none'
+        :param cache_dir: directory where compressed images are stored, see encode_pattern()
+        :param n_encode_ahead: number of images to compress while earlier images are sent, see iter_encoded_patterns()
+        :return error: Boolean
+        """
+        if compression_mode == 'none':
+            raise Exception("compression mode 'none' has not been tested.")
+        elif compression_mode == 'rle':
+            raise Exception("compression mode 'rle' as not been tested.")
+
+        error = False
+        encoded_images = iter_encoded_patterns(images, indices, compression_mode, cache_dir=cache_dir,
+                                               n_ahead=n_encode_ahead)
+        for ii, compressed_pattern in encoded_images:
+            print("sending pattern %d/%d" % (ii + 1, len(images)))
+
+            # pattern has an additional 48 bytes which must be sent also.
+            # # todo: Maybe I should nest the call to init_pattern_bmp_load in pattern_bmp_load?
+            error |= self._check_reply(self.init_pattern_bmp_load(len(compressed_pattern) + 48, pattern_index=ii))
+            self.pattern_bmp_load(compressed_pattern, compression_mode)
+
+        return error
+
+    def _start_sequence(self, triggered):
+        """
+        Start a sequence after programming it
+
+        :param triggered: Boolean. Whether or not DMD is to wait to be triggered.
+        :return:
+        """
+        self.start_stop_sequence('start')
+
+        # some weird behavior where wants to be STOPPED before starting triggered sequence. This seems to happen
+        # intermittently. Probably due to some other DMD setting that I'm not aware of?
+        if triggered:
+            self.start_stop_sequence('stop')
 
     def upload_pattern_sequence(self, patterns, exp_times, dark_times, triggered=False,
                                 clear_pattern_after_trigger=True, bit_depth=1, num_repeats=0, compression_mode='erle',
-                                combine_images=True):
+                                combine_images=True, cache_dir=None, n_encode_ahead=2):
         """
         Upload on-the-fly pattern sequence to DMD.
         # todo: seems I need to call set_pattern_sequence() after this command to actually get sequence running. Why?
@@ -1167,6 +1614,11 @@ class dlp6500():
         :param bit_depth: Bit depth of patterns
         :param num_repeats: Number of repeats. 0 means infinite.
         :param compression_mode: 'erle', 'rle', or 'none'
+        :param combine_images: if True, combine each group of 24 binary patterns into a 24 bit RGB image
+        :param cache_dir: directory where compressed images are stored, see encode_pattern(). Compressed images are
+        always reused from memory if the same images have been uploaded before
+        :param n_encode_ahead: number of images to compress in a background thread while earlier images are sent. If 0,
+        each image is compressed just before it is sent
         :return:
         """
         # #########################
@@ -1176,124 +1628,44 @@ class dlp6500():
             raise Exception('patterns must be of dtype uint8')
         npatterns = len(patterns)
 
-        # if only one exp_times, apply to all patterns
-        if not isinstance(exp_times, (list, np.ndarray)):
-            exp_times = [exp_times]
-
-        if not all(list(map(lambda t: isinstance(t, int), exp_times))):
-            raise Exception("exp_times must be a list of integers")
-
-        if patterns.shape[0] > 1 and len(exp_times) == 1:
-            exp_times = exp_times * patterns.shape[0]
-
-        # if only one dark_times, apply to all patterns
-        if isinstance(dark_times, int):
-            dark_times = [dark_times]
+        # if only one exp_times or dark_times, apply to all patterns
+        exp_times = _get_sequence_times(exp_times, npatterns, "exp_times")
+        dark_times = _get_sequence_times(dark_times, npatterns, "dark_times")
 
-        if not all(list(map(lambda t: isinstance(t, int), dark_times))):
-            raise Exception("dark_times must be a list of integers")
-
-        if patterns.shape[0] > 1 and len(dark_times) == 1:
-            dark_times = dark_times * patterns.shape[0]
+        # can combine images if bit depth = 1
+        # todo: test if things work if I don't combine images
+        if combine_images and bit_depth != 1:
+            raise Exception("Combining multiple images into a 24-bit RGB image is only implemented for bit depth 1.")
 
         # #########################
         # #########################
-
-        # need to issue stop before changing mode. Otherwise DMD will sometimes lock up and not be responsive.
-        self.start_stop_sequence('stop')
-        # buffer = self.start_stop_sequence('stop')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
-
-        # set to on-the-fly mode
-        buffer = self.set_pattern_mode('on-the-fly')[0]
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
-
-        # stop any currently running sequences
-        # note: want to stop after changing pattern mode, because otherwise may throw error
-        self.start_stop_sequence('stop')
-        # buffer = self.start_stop_sequence('stop')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
+        self._stop_sequence('on-the-fly')
 
         # set image parameters for look up table
         # When uploading 1 bit image, each set of 24 images are first combined to a single 24 bit RGB image. pattern_index
         # refers to which 24 bit RGB image a pattern is in, and pattern_bit_index refers to which bit of that image (i.e.
         # in the RGB bytes, it is stored in.
         # todo: decide if is smaller to send compressed as 24 bit RGB or individual image...
-        stored_image_indices = np.zeros(npatterns, dtype=np.int)
-        stored_bit_indices = np.zeros(npatterns, dtype=np.int)
-        for ii, (p, et, dt) in enumerate(zip(patterns, exp_times, dark_times)):
-            stored_image_indices[ii] = ii // 24
-            stored_bit_indices[ii] = ii % 24
-            buffer = self.pattern_display_lut_definition(ii, exposure_time_us=et, dark_time_us=dt, wait_for_trigger=triggered,
-                                                clear_pattern_after_trigger=clear_pattern_after_trigger, bit_depth=bit_depth,
-                                                stored_image_index=stored_image_indices[ii],
-                                                stored_image_bit_index=stored_bit_indices[ii])[0]
-            resp = self.decode_response(buffer)
-            if resp['error']:
-                print(self.read_error_description())
-
-        buffer = self.pattern_display_lut_configuration(npatterns, num_repeats)[0]
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
+        stored_image_indices = np.arange(npatterns) // 24
+        stored_bit_indices = np.arange(npatterns) % 24
+        lut = get_lut_entries(exp_times, dark_times, triggered, clear_pattern_after_trigger, bit_depth,
+                              stored_image_indices, stored_bit_indices)
+        self._define_lut_entries(lut)
+        self._check_reply(self.pattern_display_lut_configuration(npatterns, num_repeats))
 
-        # can combine images if bit depth = 1
-        # todo: test if things work if I don't combine images
         if combine_images:
-            if bit_depth == 1:
-                patterns = combine_patterns(patterns)
-            else:
-                raise Exception("Combining multiple images into a 24-bit RGB image is only implemented for bit depth 1.")
+            patterns = combine_patterns(patterns)
 
         # compress and load images
         # images must be loaded in backwards order according to programming manual
-        for ii, dmd_pattern in reversed(list(enumerate(patterns))):
-            print("sending pattern %d/%d" % (ii + 1, len(patterns)))
-
-            if compression_mode == 'none':
-                raise Exception("compression mode 'none' has not been tested.")
-                compressed_pattern = np.packbits(dmd_pattern.ravel())
-            elif compression_mode == 'rle':
-                raise Exception("compression mode 'rle' as not been tested.")
-                compressed_pattern = encode_rle(dmd_pattern)
-            elif compression_mode == 'erle':
-                compressed_pattern = encode_erle(dmd_pattern)
-
-            # pattern has an additional 48 bytes which must be sent also.
-            # # todo: Maybe I should nest the call to init_pattern_bmp_load in pattern_bmp_load?
-            buffer = self.init_pattern_bmp_load(len(compressed_pattern) + 48, pattern_index=ii)[0]
-            resp = self.decode_response(buffer)
-            if resp['error']:
-                print(self.read_error_description())
-
-            self.pattern_bmp_load(compressed_pattern, compression_mode)
+        self._load_images(patterns, range(len(patterns) - 1, -1, -1), compression_mode, cache_dir=cache_dir,
+                          n_encode_ahead=n_encode_ahead)
 
         # this PAT_CONFIG command is necessary, otherwise subsequent calls to set_pattern_sequence() will not behave
         # as expected.
-        buffer = self.pattern_display_lut_configuration(npatterns, num_repeats)[0]
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
-
-        # start sequence
-        self.start_stop_sequence('start')
-        # buffer = self.start_stop_sequence('start')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
-
-        # test
+        self._check_reply(self.pattern_display_lut_configuration(npatterns, num_repeats))
 
-        # some weird behavior where wants to be STOPPED before starting triggered sequence. This seems to happen
-        # intermittently. Probably due to some other DMD setting that I'm not aware of?
-        if triggered:
-            self.start_stop_sequence('stop')
+        self._start_sequence(triggered)
 
         return stored_image_indices, stored_bit_indices
 
@@ -1317,103 +1689,26 @@ class dlp6500():
         # #########################
         # check arguments
         # #########################
-        if isinstance(image_indices, int) or np.issubdtype(type(image_indices), np.integer):
-            image_indices = [image_indices]
-        elif isinstance(image_indices, np.ndarray):
-            image_indices = list(image_indices)
-
-        if isinstance(bit_indices, int) or np.issubdtype(type(bit_indices), np.integer):
-            bit_indices = [bit_indices]
-        elif isinstance(bit_indices, np.ndarray):
-            bit_indices = list(bit_indices)
-
-        if len(image_indices) != len(bit_indices):
-            raise Exception("image_indices and bit_indices must be the same length.")
-
+        image_indices, bit_indices = _get_sequence_indices(image_indices, bit_indices, mode)
         nimgs = len(image_indices)
 
-        if mode == 'on-the-fly' and 0 not in bit_indices:
-            raise Exception("Known issue (not with this code, but with DMD) that if 0 is not included in the bit"
-                            "indices, then the patterns displayed will not correspond with the indices supplied.")
-
-        # if only one exp_times, apply to all patterns
-        if isinstance(exp_times, int):
-            exp_times = [exp_times]
-
-        if not all(list(map(lambda t: isinstance(t, int), exp_times))):
-            raise Exception("exp_times must be a list of integers")
-
-        if nimgs > 1 and len(exp_times) == 1:
-            exp_times = exp_times * nimgs
-
-        # if only one dark_times, apply to all patterns
-        if isinstance(dark_times, int):
-            dark_times = [dark_times]
-
-        if not all(list(map(lambda t: isinstance(t, int), dark_times))):
-            raise Exception("dark_times must be a list of integers")
-
-        if nimgs > 1 and len(dark_times) == 1:
-            dark_times = dark_times * nimgs
+        # if only one exp_times or dark_times, apply to all patterns
+        exp_times = _get_sequence_times(exp_times, nimgs, "exp_times")
+        dark_times = _get_sequence_times(dark_times, nimgs, "dark_times")
 
         # #########################
         # #########################
-        # need to issue stop before changing mode. Otherwise DMD will sometimes lock up and not be responsive.
-        self.start_stop_sequence('stop')
-        # buffer = self.start_stop_sequence('stop')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
-
-        # set to pattern mode
-        buffer = self.set_pattern_mode(mode)[0]
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
-
-        # stop any currently running sequences
-        # note: want to stop after changing pattern mode, because otherwise may throw error
-        self.start_stop_sequence('stop')
-        # buffer = self.start_stop_sequence('stop')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
-
-        # buffer = self.set_trigger_in1(105, 'rising')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
+        self._stop_sequence(mode)
 
         # set image parameters for look up table_
-        for ii, (et, dt) in enumerate(zip(exp_times, dark_times)):
-            buffer = self.pattern_display_lut_definition(ii, exposure_time_us=et, dark_time_us=dt,
-                                                         wait_for_trigger=triggered,
-                                                         clear_pattern_after_trigger=clear_pattern_after_trigger,
-                                                         bit_depth=bit_depth, stored_image_index=image_indices[ii],
-                                                         stored_image_bit_index=bit_indices[ii])[0]
-            resp = self.decode_response(buffer)
-            if resp['error']:
-                print(self.read_error_description())
+        lut = get_lut_entries(exp_times, dark_times, triggered, clear_pattern_after_trigger, bit_depth,
+                              image_indices, bit_indices)
+        self._define_lut_entries(lut)
 
         #PAT_CONFIG command
-        buffer = self.pattern_display_lut_configuration(nimgs, num_repeat=num_repeats)[0]
-        resp = self.decode_response(buffer)
-        if resp['error']:
-            print(self.read_error_description())
-
-        # start sequence
-        self.start_stop_sequence('start')
-        # buffer = self.start_stop_sequence('start')[0]
-        # resp = self.decode_response(buffer)
-        # if resp['error']:
-        #     print(self.read_error_description())
-
-        # test
+        self._check_reply(self.pattern_display_lut_configuration(nimgs, num_repeat=num_repeats))
 
-        # some weird behavior where wants to be STOPPED before starting triggered sequence. This seems to happen
-        # intermittently. Probably due to some other DMD setting that I'm not aware of?
-        if triggered:
-            self.start_stop_sequence('stop')
+        self._start_sequence(triggered)
 
     # batch files in firmware
     def get_fwbatch_name(self, batch_index):
@@ -1477,6 +1772,9 @@ class dlp6500win(dlp6500):
         :return:
         """
 
+        if pyhid is None:
+            raise ImportError("pywinusb is required to communicate with the DMD on windows")
+
         filter = pyhid.HidDeviceFilter(vendor_id=vendor_id, product_id=product_id)
         devices = filter.get_devices()
         self.dmd = devices[0]
@@ -1484,9 +1782,16 @@ class dlp6500win(dlp6500):
 
         # variable for holding response of dmd
         self._response = []
+        self._response_event = threading.Event()
+        self.dmd.set_raw_data_handler(self._handle_response)
+
+        # output report is the same for every packet
+        self._output_report = self.dmd.find_output_reports()[0]
+
+    def _handle_response(self, data):
         # strip off first return byte
-        response_handler = lambda data: self._response.append(data[1:])
-        self.dmd.set_raw_data_handler(response_handler)
+        self._response.append(data[1:])
+        self._response_event.set()
 
     def _send_raw_packet(self, buffer, listen_for_reply=False, timeout=5):
         """
@@ -1506,22 +1811,15 @@ class dlp6500win(dlp6500):
 
         # clear reply buffer before sending
         self._response = []
+        self._response_event.clear()
 
         # send
-        reports = self.dmd.find_output_reports()
-        reports[0].send(report_id_byte + buffer)
+        self._output_report.send(report_id_byte + list(buffer))
 
-        # only wait for a reply if necessary
+        # only wait for a reply if necessary. Wake up as soon as the reply arrives instead of polling
         if listen_for_reply:
-            tstart = time.time()
-            while self._response == []:
-                time.sleep(0.1)
-                tnow = time.time()
-
-                if timeout is not None:
-                    if (tnow - tstart) > timeout:
-                        print('read command timed out')
-                        break
+            if not self._response_event.wait(timeout):
+                print('read command timed out')
 
         if self._response != []:
             reply = copy.deepcopy(self._response[0])
@@ -1530,6 +1828,23 @@ class dlp6500win(dlp6500):
 
         return reply
 
+    def _send_raw_packets(self, packets):
+        """
+        Send many USB packets back to back without listening for replies
+
+        :param packets: bytes, bytearray, or NumPy array of uint8. Length must be a multiple of packet_length_bytes
+        :return:
+        """
+        packets = bytes(packets)
+        if len(packets) % self.packet_length_bytes != 0:
+            raise ValueError("number of bytes must be a multiple of %d, but was %d" %
+                             (self.packet_length_bytes, len(packets)))
+
+        report_id_byte = [0x00]
+        send = self._output_report.send
+        for ii in range(0, len(packets), self.packet_length_bytes):
+            send(report_id_byte + list(packets[ii:ii + self.packet_length_bytes]))
+
 class dlp6500ix(dlp6500):
     """
     Class for handling dlp6500 on linux os
@@ -1550,18 +1865,237 @@ class dlp6500ix(dlp6500):
 
 class dlp6500dummy(dlp6500):
     """Dummy class, useful for testing command generation when no DMD is connected"""
-    def __init__(self, vendor_id=0, product_id=0, debug=True):
+    def __init__(self, vendor_id=0, product_id=0, debug=True, packet_time_s=0):
+        """
+        :param packet_time_s: simulated time to send each packet of image data with pattern_bmp_load()
+        """
+        self.packet_time_s = packet_time_s
         super(dlp6500dummy, self).__init__(vendor_id=vendor_id, product_id=product_id, debug=debug)
 
     def _get_device(self, vendor_id, product_id):
         pass
 
+    def _send_raw_packets(self, packets):
+        if self.packet_time_s > 0:
+            time.sleep(self.packet_time_s * len(packets) / self.packet_length_bytes)
+        super(dlp6500dummy, self)._send_raw_packets(packets)
+
     def _send_raw_packet(self, buffer, listen_for_reply=False, timeout=5):
-        pass
+        # reply with an empty response without errors, so commands which decode the response can be tested
+        if listen_for_reply:
+            return [0x00] * self.packet_length_bytes
+        else:
+            return []
 
     def read_error_description(self):
         return [['']]
 
+class SequenceManager():
+    """
+    Program pattern sequences on a DMD, keeping track of what is currently in DMD memory so only the commands needed to
+    change from the current sequence to a new one are sent. This tracks the display mode, the contents of each
+    entry of the pattern display look up table (LUT), and in on-the-fly mode a hash of each 24 bit image stored on
+    the DMD. LUT entries and images which are unchanged are not sent again.
+
+    Sequences programmed with the same dlp6500 instance without this manager are detected, and the next sequence is
+    then programmed completely. Otherwise, this relies on nothing else changing the DMD state. In particular, state
+    loaded from a file cannot reflect a power cycle of the DMD or programming by other software. If this may have
+    happened, call invalidate() so the next sequence is programmed completely.
+    """
+
+    def __init__(self, dmd, state_fname=None):
+        """
+        :param dmd: dlp6500 instance
+        :param state_fname: JSON file to store the DMD state in. If this file exists, the state is loaded from it. This
+        allows the state to persist between processes, e.g. successive calls of set_dmd_sim.py. If None, state is only
+        kept in memory
+        """
+        self.dmd = dmd
+        self.state_fname = state_fname
+        # commands sent by the most recent update, see get_changes()
+        self.last_changes = None
+
+        self.invalidate(save=False)
+        if self.state_fname is not None and os.path.exists(self.state_fname):
+            self.load_state()
+
+        # number of sequence updates of the DMD instance the last time this manager programmed it
+        self._sequence_updates = self.dmd.sequence_updates
+
+    def invalidate(self, save=True):
+        """
+        Forget the DMD state, so the next sequence is programmed completely
+
+        :param save: whether to also overwrite the state file
+        :return:
+        """
+        self.mode = None
+        # sequence position -> LUT entry, see get_lut_entries()
+        self.lut = {}
+        # image index -> hash of image stored in on-the-fly mode
+        self.image_hashes = {}
+
+        if save:
+            self.save_state()
+
+    def load_state(self):
+        with open(self.state_fname, "r") as f:
+            state = json.load(f)
+
+        self.mode = state["mode"]
+        self.lut = {int(k): tuple(v) for k, v in state["lut"].items()}
+        self.image_hashes = {int(k): v for k, v in state["image_hashes"].items()}
+
+    def save_state(self):
+        if self.state_fname is None:
+            return
+
+        state = {"mode": self.mode,
+                 "lut": {str(k): list(v) for k, v in self.lut.items()},
+                 "image_hashes": {str(k): v for k, v in self.image_hashes.items()}}
+
+        # write to temporary file first, so a partially written state is never loaded
+        with open(self.state_fname + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_fname + ".tmp", self.state_fname)
+
+    def get_changes(self, mode, lut, image_hashes=None):
+        """
+        Find the commands needed to change the current DMD state to a new sequence
+
+        :param mode: 'on-the-fly' or 'pre-stored'
+        :param lut: list of LUT entries, see get_lut_entries()
+        :param image_hashes: list of hashes of the images to store in on-the-fly mode, see get_pattern_hash()
+        :return changes: dictionary with entries "mode", which is True if the display mode must be set,
+        "lut_entries", a list of sequence positions of the LUT entries to define, and "images", a list of indices of
+        the images to load
+        """
+        if image_hashes is None:
+            image_hashes = []
+
+        # if the DMD was programmed without this manager, its state is not known
+        if self.dmd.sequence_updates != self._sequence_updates:
+            self.invalidate()
+
+        # changing the display mode may change DMD memory, so then everything is programmed
+        if mode != self.mode:
+            current_lut = {}
+            current_images = {}
+        else:
+            current_lut = self.lut
+            current_images = self.image_hashes
+
+        changes = {"mode": mode != self.mode,
+                   "lut_entries": [ii for ii, e in enumerate(lut) if current_lut.get(ii) != e],
+                   "images": [ii for ii, h in enumerate(image_hashes) if current_images.get(ii) != h]}
+
+        return changes
+
+    def _program(self, mode, lut, num_repeats, triggered, images=None, compression_mode='erle', cache_dir=None,
+                 n_encode_ahead=2):
+        """
+        Send the commands needed to change the current DMD state to a new sequence. This follows the same steps as
+        dlp6500.upload_pattern_sequence() and dlp6500.set_pattern_sequence(), skipping unchanged LUT entries and images
+
+        :param mode: 'on-the-fly' or 'pre-stored'
+        :param lut: list of LUT entries, see get_lut_entries()
+        :param num_repeats: number of repeats. 0 means infinite.
+        :param triggered: whether the DMD waits for a trigger before switching pattern
+        :param images: list of 24 bit images to store in on-the-fly mode
+        :param compression_mode: 'erle', 'rle', or 'none'
+        :param cache_dir: directory where compressed images are stored, see encode_pattern()
+        :param n_encode_ahead: number of images to compress while earlier images are sent, see iter_encoded_patterns()
+        :return changes: see get_changes()
+        """
+        if images is None:
+            images = []
+
+        image_hashes = [get_pattern_hash(p, compression_mode) for p in images]
+        changes = self.get_changes(mode, lut, image_hashes)
+        self.last_changes = changes
+
+        try:
+            error = self.dmd._stop_sequence(mode if changes["mode"] else None)
+            error |= self.dmd._define_lut_entries(lut, changes["lut_entries"])
+            error |= self.dmd._check_reply(self.dmd.pattern_display_lut_configuration(len(lut), num_repeats))
+
+            if changes["images"]:
+                # images must be loaded in backwards order according to programming manual
+                error |= self.dmd._load_images(images, changes["images"][::-1], compression_mode,
+                                               cache_dir=cache_dir, n_encode_ahead=n_encode_ahead)
+                # PAT_CONFIG must be sent again after loading images, see dlp6500.upload_pattern_sequence()
+                error |= self.dmd._check_reply(self.dmd.pattern_display_lut_configuration(len(lut), num_repeats))
+
+            self.dmd._start_sequence(triggered)
+        except BaseException:
+            # DMD state is not known if programming was interrupted
+            self.invalidate()
+            raise
+
+        if error:
+            self.invalidate()
+        else:
+            if changes["mode"]:
+                self.mode = mode
+                self.lut = {}
+                self.image_hashes = {}
+            self.lut.update({ii: lut[ii] for ii in changes["lut_entries"]})
+            self.image_hashes.update({ii: image_hashes[ii] for ii in changes["images"]})
+            self._sequence_updates = self.dmd.sequence_updates
+            self.save_state()
+
+        return changes
+
+    def upload_pattern_sequence(self, patterns, exp_times, dark_times, triggered=False,
+                                clear_pattern_after_trigger=True, bit_depth=1, num_repeats=0, compression_mode='erle',
+                                cache_dir=None, n_encode_ahead=2):
+        """
+        Upload on-the-fly pattern sequence to DMD, only sending LUT entries and 24 bit images which differ from those
+        already on the DMD. Parameters are as for dlp6500.upload_pattern_sequence(), except images are always
+        combined.
+
+        :return stored_image_indices, stored_bit_indices: index of the 24 bit image and the bit of that image each
+        pattern is stored in
+        """
+        if patterns.dtype != np.uint8:
+            raise Exception('patterns must be of dtype uint8')
+        npatterns = len(patterns)
+
+        exp_times = _get_sequence_times(exp_times, npatterns, "exp_times")
+        dark_times = _get_sequence_times(dark_times, npatterns, "dark_times")
+
+        if bit_depth != 1:
+            raise Exception("Combining multiple images into a 24-bit RGB image is only implemented for bit depth 1.")
+
+        stored_image_indices = np.arange(npatterns) // 24
+        stored_bit_indices = np.arange(npatterns) % 24
+        lut = get_lut_entries(exp_times, dark_times, triggered, clear_pattern_after_trigger, bit_depth,
+                              stored_image_indices, stored_bit_indices)
+
+        self._program('on-the-fly', lut, num_repeats, triggered, images=combine_patterns(patterns),
+                      compression_mode=compression_mode, cache_dir=cache_dir, n_encode_ahead=n_encode_ahead)
+
+        return stored_image_indices, stored_bit_indices
+
+    def set_pattern_sequence(self, image_indices, bit_indices, exp_times, dark_times, triggered=False,
+                             clear_pattern_after_trigger=True, bit_depth=1, num_repeats=0, mode='pre-stored'):
+        """
+        Setup pattern sequence from patterns previously stored in DMD memory, only sending LUT entries which differ
+        from those already on the DMD. Parameters are as for dlp6500.set_pattern_sequence()
+
+        :return changes: see get_changes()
+        """
+        image_indices, bit_indices = _get_sequence_indices(image_indices, bit_indices, mode)
+        nimgs = len(image_indices)
+
+        exp_times = _get_sequence_times(exp_times, nimgs, "exp_times")
+        dark_times = _get_sequence_times(dark_times, nimgs, "dark_times")
+
+        lut = get_lut_entries(exp_times, dark_times, triggered, clear_pattern_after_trigger, bit_depth,
+                              image_indices, bit_indices)
+
+        return self._program(mode, lut, num_repeats, triggered)
+
 if __name__ == "__main__":
     import time
     # ########################################
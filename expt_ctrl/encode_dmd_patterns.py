@@ -0,0 +1,50 @@
+"""
+Compress DMD patterns ahead of time, so they do not need to be compressed when they are uploaded to the DMD using
+dlp6500.upload_pattern_sequence(..., cache_dir=cache_dir).
+
+Patterns are read from TIF stacks of binary images, such as those saved by dmd_patterns.export_pattern_set().
+As in upload_pattern_sequence(), each group of 24 patterns is combined into one 24 bit RGB image before compression,
+so the compressed images are only reused if the same patterns are uploaded in the same groups.
+
+Run this script from the command line with "python encode_dmd_patterns.py". Run "python encode_dmd_patterns.py -h"
+for help with parameters. For example
+python encode_dmd_patterns.py sim_patterns/sim_patterns_period=6.01_nangles=3_nphases=3.tif
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import tifffile
+
+import dlp6500
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress DMD patterns ahead of time.")
+    parser.add_argument("fnames", type=str, nargs="+",
+                        help="TIF stacks of binary patterns, e.g. as saved by dmd_patterns.export_pattern_set()")
+    parser.add_argument("-o", "--cache_dir", type=str, default=None,
+                        help="directory to store compressed patterns in. By default, a directory named"
+                             " 'compressed_patterns' next to each TIF stack")
+    parser.add_argument("-c", "--compression", type=str, choices=["erle", "rle"], default="erle",
+                        help="compression mode, which must match the compression mode used when uploading")
+    args = parser.parse_args()
+
+    for fname in args.fnames:
+        if args.cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(fname)), "compressed_patterns")
+        else:
+            cache_dir = args.cache_dir
+
+        patterns = tifffile.imread(fname).astype(np.uint8)
+        if patterns.ndim == 2:
+            patterns = patterns[None, :, :]
+
+        tstart = time.perf_counter()
+        combined_patterns = dlp6500.combine_patterns(patterns)
+        nbytes = 0
+        for p in combined_patterns:
+            nbytes += len(dlp6500.encode_pattern(p, args.compression, cache_dir=cache_dir))
+
+        print("compressed %d patterns from %s to %d bytes in %0.2fs, saved to %s" %
+              (len(patterns), fname, nbytes, time.perf_counter() - tstart, cache_dir))
@@ -69,6 +69,14 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--phase", type=int, choices=list(range(nphases)),
                         help="Phase index of SIM pattern. No effect unless --singlepattern option was passed.")
     parser.add_argument("-v", "--verbose", action="store_true", help="print more verbose DMD programming information")
+    parser.add_argument("--statefile", type=str, default=None,
+                        help="file storing the sequence last set on the DMD. If supplied, only the parts of the"
+                             " sequence which differ from the last sequence set using this file are sent. Only use"
+                             " this if nothing else programs the DMD, since the file does not reflect other changes,"
+                             " e.g. if the DMD is power cycled or patterns are uploaded by other software")
+    parser.add_argument("-r", "--reprogram", action="store_true",
+                        help="program the full sequence even if --statefile was supplied, e.g. after the DMD was"
+                             " power cycled")
     args = parser.parse_args()
 
     # ensure arguments are compatible
@@ -169,7 +177,13 @@ if __name__ == "__main__":
     mode_trig2 = dmd.get_trigger_in2()
     print("trigger2 mode=%d" % mode_trig2)
 
-    dmd.set_pattern_sequence(current_pic_inds, current_bit_inds, 105, 0, triggered=args.triggered,
-                             clear_pattern_after_trigger=False, bit_depth=1, num_repeats=0, mode='pre-stored')
+    # if a state file is supplied, only send LUT entries which changed since the last sequence was set
+    manager = dlp6500.SequenceManager(dmd, state_fname=args.statefile)
+    if args.reprogram:
+        manager.invalidate()
 
-    print("finished programming DMD")
\ No newline at end of file
+    changes = manager.set_pattern_sequence(current_pic_inds, current_bit_inds, 105, 0, triggered=args.triggered,
+                                           clear_pattern_after_trigger=False, bit_depth=1, num_repeats=0,
+                                           mode='pre-stored')
+
+    print("finished programming DMD, updated %d LUT entries" % len(changes["lut_entries"]))
\ No newline at end of file
@@ -0,0 +1,320 @@
+import unittest
+import os
+import tempfile
+import threading
+from unittest import mock
+
+import numpy as np
+
+import dlp6500
+
+
+class RecordingDmd(dlp6500.dlp6500dummy):
+    """
+    Dummy DMD which records every USB packet sent
+    """
+    def __init__(self):
+        super(RecordingDmd, self).__init__(debug=False)
+        self.packets = []
+
+    def _send_raw_packet(self, buffer, listen_for_reply=False, timeout=5):
+        self.packets.append(bytes(buffer))
+        return super(RecordingDmd, self)._send_raw_packet(buffer, listen_for_reply, timeout)
+
+
+class TimelineDmd(dlp6500.dlp6500dummy):
+    """
+    Dummy DMD which records the order images are compressed and sent in. If wait_for_next_encode is True, sending
+    each image does not finish until compressing the next image has started, as it would for a slow USB transfer
+    """
+    def __init__(self, images, wait_for_next_encode=False):
+        super(TimelineDmd, self).__init__(debug=False)
+        self.image_indices = {dlp6500.get_pattern_hash(p): ii for ii, p in enumerate(images)}
+        self.wait_for_next_encode = wait_for_next_encode
+        self.events = []
+        self.condition = threading.Condition()
+        self._encode_pattern = dlp6500.encode_pattern
+        self.image_index = None
+
+    def _add_event(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def encode_pattern(self, pattern, *args, **kwargs):
+        self._add_event(("encode_start", self.image_indices[dlp6500.get_pattern_hash(pattern)]))
+        return self._encode_pattern(pattern, *args, **kwargs)
+
+    def init_pattern_bmp_load(self, pattern_length, pattern_index):
+        self.image_index = pattern_index
+        return super(TimelineDmd, self).init_pattern_bmp_load(pattern_length, pattern_index)
+
+    def _send_raw_packets(self, packets):
+        ii = self.image_index
+        self._add_event(("send_start", ii))
+        if self.wait_for_next_encode and ii > 0:
+            with self.condition:
+                self.condition.wait_for(lambda: ("encode_start", ii - 1) in self.events, timeout=10)
+        self._add_event(("send_end", ii))
+
+
+class TestDlp6500(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def test_encode_erle(self):
+        """
+        Test ERLE encoding against a pattern encoded by hand
+        :return:
+        """
+        pattern = np.zeros((3, 3, 130), dtype=np.uint8)
+        pattern[2, :, 1:] = 1
+        # third row is the same as the second
+        pattern[0, 1, 0] = 5
+        pattern[0, 2, 0] = 5
+
+        expected = [1, 0, 0, 0,
+                    (129 & 0x7F) | 0x80, 129 >> 7, 0, 0, 1,
+                    1, 5, 0, 0,
+                    (129 & 0x7F) | 0x80, 129 >> 7, 0, 0, 1,
+                    0, 1, (130 & 0x7F) | 0x80, 130 >> 7,
+                    0, 1, 0]
+        self.assertEqual(list(dlp6500.encode_erle(pattern)), expected)
+
+        # copying the part of the second row which is the same as the first is shorter
+        expected_partial = [1, 0, 0, 0,
+                            (129 & 0x7F) | 0x80, 129 >> 7, 0, 0, 1,
+                            1, 5, 0, 0,
+                            0, 1, (129 & 0x7F) | 0x80, 129 >> 7,
+                            0, 1, (130 & 0x7F) | 0x80, 130 >> 7,
+                            0, 1, 0]
+        self.assertEqual(list(dlp6500.encode_erle(pattern, copy_mode="partial")), expected_partial)
+
+    def test_erle_round_trip(self):
+        """
+        Test decode_erle() recovers patterns encoded with each copy mode
+        :return:
+        """
+        ny = 108
+        nx = 192
+        yy, xx = np.meshgrid(range(ny), range(nx), indexing="ij")
+
+        patterns = []
+        for angle in np.linspace(0, np.pi, 24):
+            patterns.append(np.cos(2 * np.pi * (xx * np.cos(angle) + yy * np.sin(angle)) / 7.3) > 0)
+        patterns = np.array(patterns).astype(np.uint8)
+        combined = dlp6500.combine_patterns(patterns)[0]
+
+        random_pattern = np.random.randint(0, 2, size=(3, ny, nx)).astype(np.uint8)
+        random_pattern[:, 20:30] = random_pattern[:, 19:20]
+
+        for p in [combined, random_pattern, patterns[3]]:
+            rgb = p if p.ndim == 3 else np.stack((np.zeros_like(p), np.zeros_like(p), p))
+
+            for copy_mode in ["none", "rows", "partial"]:
+                encoded = dlp6500.encode_erle(p, copy_mode=copy_mode)
+                self.assertTrue(isinstance(encoded, bytearray))
+                np.testing.assert_array_equal(dlp6500.decode_erle((ny, nx), encoded), rgb)
+
+            self.assertLessEqual(len(dlp6500.encode_erle(p, copy_mode="partial")),
+                                 len(dlp6500.encode_erle(p, copy_mode="rows")))
+
+    def test_compressed_pattern_cache(self):
+        """
+        Test compressed patterns are reused from memory and from disk
+        :return:
+        """
+        patterns = np.random.randint(0, 2, size=(30, 54, 96)).astype(np.uint8)
+        combined = dlp6500.combine_patterns(patterns)
+
+        dlp6500.clear_compressed_pattern_cache()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            try:
+                encoded = [dlp6500.encode_pattern(p, "erle", cache_dir=cache_dir) for p in combined]
+                for p, e in zip(combined, encoded):
+                    self.assertEqual(e, dlp6500.encode_erle(p))
+                self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+                # second time compressed patterns are found in memory
+                encoded_again = [dlp6500.encode_pattern(p, "erle", cache_dir=cache_dir) for p in combined]
+                self.assertEqual(encoded_again, encoded)
+
+                # different compression modes are stored separately
+                self.assertEqual(dlp6500.encode_pattern(combined[0], "rle"), dlp6500.encode_rle(combined[0]))
+
+                # after clearing memory, compressed patterns are loaded from disk
+                dlp6500.clear_compressed_pattern_cache()
+                self.assertEqual([dlp6500.encode_pattern(p, "erle", cache_dir=cache_dir) for p in combined], encoded)
+
+                info = dlp6500.get_compressed_pattern_cache_info()
+                self.assertEqual((info["hits"], info["disk_hits"], info["misses"], info["entries"]), (0, 2, 0, 2))
+
+                # patterns compressed by a different encoder version are not loaded from disk
+                dlp6500.clear_compressed_pattern_cache()
+                with mock.patch.object(dlp6500, "pattern_encoder_version", dlp6500.pattern_encoder_version + 1):
+                    self.assertEqual(dlp6500.encode_pattern(combined[0], "erle", cache_dir=cache_dir), encoded[0])
+                info = dlp6500.get_compressed_pattern_cache_info()
+                self.assertEqual((info["disk_hits"], info["misses"]), (0, 1))
+                self.assertEqual(len(os.listdir(cache_dir)), 3)
+            finally:
+                dlp6500.clear_compressed_pattern_cache()
+
+    def test_pattern_bmp_load_packets(self):
+        """
+        Test packets sent by pattern_bmp_load() are identical to sending each command with send_command()
+        :return:
+        """
+        max_cmd_payload = 504
+
+        # data lengths including the 48 byte image header which fill some commands exactly, or only partially
+        for nbytes in [1, 100, max_cmd_payload - 48, max_cmd_payload - 47, 3 * max_cmd_payload - 48 + 7]:
+            compressed_pattern = bytearray(np.random.randint(0, 256, size=nbytes).astype(np.uint8).tobytes())
+
+            dmd = RecordingDmd()
+            dmd.pattern_bmp_load(compressed_pattern, "erle")
+
+            # send the same data one command at a time
+            dmd_ref = RecordingDmd()
+            header = [0x53, 0x70, 0x6C, 0x64, 0x80, 0x07, 0x38, 0x04] + \
+                     np.array([nbytes], dtype="<u4").view(np.uint8).tolist() + \
+                     [0xFF] * 8 + [0x00] * 4 + [0x01, 0x02, 0x01, 0x00, 0x00, 0x01] + [0x00] * 18
+            data = header + list(compressed_pattern)
+            for ii in range(0, len(data), max_cmd_payload):
+                block = data[ii:ii + max_cmd_payload]
+                dmd_ref.send_command('w', False, 0x1A2B, data=[len(block) & 0xFF, len(block) >> 8] + block)
+
+            self.assertTrue(len(dmd.packets) > 0)
+            self.assertEqual(dmd.packets, dmd_ref.packets)
+
+    def test_upload_pattern_sequence_dummy(self):
+        """
+        Test uploading a pattern sequence with a dummy DMD
+        :return:
+        """
+        patterns = np.random.randint(0, 2, size=(30, 1080, 1920)).astype(np.uint8)
+
+        dmd = RecordingDmd()
+        img_inds, bit_inds = dmd.upload_pattern_sequence(patterns, 105, 0)
+        np.testing.assert_array_equal(img_inds, np.arange(30) // 24)
+        np.testing.assert_array_equal(bit_inds, np.arange(30) % 24)
+
+        # images are sent in reverse order, with an init_pattern_bmp_load command before each
+        combined = dlp6500.combine_patterns(patterns)
+        sent = b"".join(dmd.packets)
+        starts = []
+        for c in combined:
+            expected = dmd.get_pattern_bmp_load_packets(dlp6500.encode_pattern(c, "erle"), "erle").tobytes()
+            starts.append(sent.find(expected))
+        self.assertTrue(starts[0] > starts[1] > 0)
+
+    def test_sequence_manager(self):
+        """
+        Test SequenceManager only sends LUT entries and images which changed
+        :return:
+        """
+        def count_commands(packets, command):
+            # commands defining LUT entries and initializing image loads fit in one packet
+            return sum([p[4] == (command & 0xFF) and p[5] == (command >> 8) for p in packets])
+
+        yy, xx = np.meshgrid(range(1080), range(1920), indexing="ij")
+        patterns = np.array([(xx + ii * yy) % 7 < 3 for ii in range(30)]).astype(np.uint8)
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            state_fname = os.path.join(save_dir, "dmd_state.json")
+
+            dmd = RecordingDmd()
+            manager = dlp6500.SequenceManager(dmd, state_fname=state_fname)
+            img_inds, bit_inds = manager.upload_pattern_sequence(patterns, 105, 0)
+            np.testing.assert_array_equal(img_inds, np.arange(30) // 24)
+            np.testing.assert_array_equal(bit_inds, np.arange(30) % 24)
+            self.assertEqual(manager.last_changes, {"mode": True, "lut_entries": list(range(30)), "images": [0, 1]})
+            self.assertEqual(count_commands(dmd.packets, 0x1A34), 30)
+            self.assertEqual(count_commands(dmd.packets, 0x1A2A), 2)
+
+            # same sequence again sends nothing
+            dmd.packets = []
+            manager.upload_pattern_sequence(patterns, 105, 0)
+            self.assertEqual(manager.last_changes, {"mode": False, "lut_entries": [], "images": []})
+            self.assertEqual(count_commands(dmd.packets, 0x1A34), 0)
+            self.assertEqual(count_commands(dmd.packets, 0x1A2A), 0)
+
+            # only exposure time of one pattern changed
+            exp_times = [105] * 30
+            exp_times[3] = 200
+            manager.upload_pattern_sequence(patterns, exp_times, 0)
+            self.assertEqual(manager.last_changes, {"mode": False, "lut_entries": [3], "images": []})
+
+            # only patterns in second image changed
+            patterns_new = np.array(patterns, copy=True)
+            patterns_new[-1] = 1 - patterns_new[-1]
+            dmd.packets = []
+            manager.upload_pattern_sequence(patterns_new, exp_times, 0)
+            self.assertEqual(manager.last_changes, {"mode": False, "lut_entries": [], "images": [1]})
+            self.assertEqual(count_commands(dmd.packets, 0x1A2A), 1)
+
+            # state is loaded from file by a new manager
+            manager = dlp6500.SequenceManager(RecordingDmd(), state_fname=state_fname)
+            manager.upload_pattern_sequence(patterns_new, exp_times, 0)
+            self.assertEqual(manager.last_changes, {"mode": False, "lut_entries": [], "images": []})
+
+            # changing mode reprograms everything, but changing between pre-stored sequences does not
+            changes = manager.set_pattern_sequence([0, 0, 1], [0, 1, 2], 105, 0)
+            self.assertEqual(changes, {"mode": True, "lut_entries": [0, 1, 2], "images": []})
+            changes = manager.set_pattern_sequence([0, 0, 1, 1], [0, 1, 3, 4], 105, 0)
+            self.assertEqual(changes, {"mode": False, "lut_entries": [2, 3], "images": []})
+
+            manager.invalidate()
+            changes = manager.set_pattern_sequence([0, 0, 1, 1], [0, 1, 3, 4], 105, 0)
+            self.assertEqual(changes["lut_entries"], [0, 1, 2, 3])
+
+            # programming the DMD without the manager makes its state unknown
+            manager.dmd.set_pattern_sequence([0, 0, 1, 1], [0, 1, 3, 5], 105, 0)
+            changes = manager.set_pattern_sequence([0, 0, 1, 1], [0, 1, 3, 4], 105, 0)
+            self.assertEqual(changes, {"mode": True, "lut_entries": [0, 1, 2, 3], "images": []})
+
+    def test_pipelined_upload(self):
+        """
+        Test compressing images while sending others gives the same commands as compressing them one at a time,
+        and that later images are compressed while earlier images are sent
+        :return:
+        """
+        patterns = np.random.randint(0, 2, size=(96, 540, 960)).astype(np.uint8)
+        combined = dlp6500.combine_patterns(patterns)
+
+        # images are sent in backwards order
+        dlp6500.clear_compressed_pattern_cache()
+        encoded = list(dlp6500.iter_encoded_patterns(combined, [3, 2, 1, 0], n_ahead=2))
+        self.assertEqual([ii for ii, _ in encoded], [3, 2, 1, 0])
+        for ii, e in encoded:
+            self.assertEqual(e, dlp6500.encode_erle(combined[ii]))
+
+        packets = []
+        for n_encode_ahead in [0, 2]:
+            dlp6500.clear_compressed_pattern_cache()
+            dmd = RecordingDmd()
+            dmd.upload_pattern_sequence(patterns, 105, 0, n_encode_ahead=n_encode_ahead)
+            packets.append(dmd.packets)
+        self.assertEqual(packets[0], packets[1])
+
+        # record when each image is compressed and sent
+        for n_encode_ahead in [0, 2]:
+            dlp6500.clear_compressed_pattern_cache()
+            dmd = TimelineDmd(combined, wait_for_next_encode=n_encode_ahead > 0)
+            with mock.patch.object(dlp6500, "encode_pattern", dmd.encode_pattern):
+                dmd.upload_pattern_sequence(patterns, 105, 0, n_encode_ahead=n_encode_ahead)
+            dlp6500.clear_compressed_pattern_cache()
+
+            events = dmd.events
+            for ii in [3, 2, 1]:
+                send_end = events.index(("send_end", ii))
+                next_encode_start = events.index(("encode_start", ii - 1))
+                if n_encode_ahead > 0:
+                    # next image is compressed while this one is sent
+                    self.assertLess(next_encode_start, send_end)
+                else:
+                    self.assertGreater(next_encode_start, send_end)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,12 @@
 import unittest
+import os
+import glob
+import json
+import pickle
+import tempfile
+from unittest import mock
 import numpy as np
+import tifffile
 from scipy import fft
 from scipy.signal import fftconvolve
 import matplotlib.pyplot as plt
@@ -8,6 +15,66 @@ from matplotlib.colors import PowerNorm
 import sim_reconstruction as sim
 import analysis_tools as tools
 import fit_psf as psf
+import psd
+
+def write_sim_dataset(root_dir, ntimes=2, nx=128, seed=0):
+    """
+    Write simulated SIM data to disk in the Micro-Manager multipage tiff format expected by reconstruct_folder(),
+    together with the affine, OTF and DMD pattern data files it requires.
+
+    :return data_dir, affine_fname, otf_fname, pattern_fname, options:
+    """
+    np.random.seed(seed)
+
+    options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+    frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+    phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+    mod_depths = np.array([0.85, 0.85, 0.85])
+
+    fx = tools.get_fft_frqs(nx, options['pixel_size'])
+    otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+    gt = np.zeros((nx, nx))
+    inds = np.random.randint(0, nx, size=(100, 2))
+    gt[inds[:, 0], inds[:, 1]] = 1
+
+    data_dir = os.path.join(root_dir, "sim_data")
+    os.mkdir(data_dir)
+
+    imgs = []
+    md = {"Summary": {"IntendedDimensions": {"time": ntimes, "position": 1, "z": 1, "channel": 9},
+                      "UserData": {},
+                      "StartTime": "2021-01-01;00:00:00.000"}}
+    for tt in range(ntimes):
+        imgs_sim, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                    options['pixel_size'], otf=otf, use_otf=True)
+        for ii in range(9):
+            md["FrameKey-%d-%d-0" % (tt, ii)] = {"FileName": "sim_data.tif",
+                                                 "ImageNumber": len(imgs),
+                                                 "PositionName": "Pos-0",
+                                                 "PixelSizeUm": options['pixel_size'],
+                                                 "UserData": {"SimIndex": {"scalar": ii},
+                                                              "ChannelIndex": {"scalar": 0}}}
+            imgs.append(imgs_sim[ii // 3, ii % 3])
+
+    tifffile.imwrite(os.path.join(data_dir, "sim_data.tif"), np.round(np.asarray(imgs)).astype(np.uint16))
+    with open(os.path.join(data_dir, "sim_data_metadata.txt"), "w") as f:
+        json.dump(md, f)
+
+    # DMD frequencies are per mirror and for the electric field
+    affine_fname = os.path.join(root_dir, "affine.pkl")
+    with open(affine_fname, "wb") as f:
+        pickle.dump({"affine_xform": np.eye(3)}, f)
+
+    otf_fname = os.path.join(root_dir, "otf.pkl")
+    with open(otf_fname, "wb") as f:
+        pickle.dump({"fit_params": [0]}, f)
+
+    pattern_fname = os.path.join(root_dir, "patterns.pkl")
+    with open(pattern_fname, "wb") as f:
+        pickle.dump({"frqs": frqs * options['pixel_size'] / 2, "phases": phases / 2, "nx": nx, "ny": nx}, f)
+
+    return data_dir, affine_fname, otf_fname, pattern_fname, options
 
 class TestSIM(unittest.TestCase):
 
@@ -41,6 +108,41 @@ class TestSIM(unittest.TestCase):
         self.assertAlmostEqual(np.abs(frq_extracted[0]), np.abs(frqs[0]), places=5)
         self.assertAlmostEqual(np.abs(frq_extracted[1]), np.abs(frqs[1]), places=5)
 
+    def test_fit_modulation_frq_fast(self):
+        """
+        Test fit_modulation_frq_fast() finds the frequency, and agrees with fit_modulation_frq()
+
+        :return:
+        """
+        np.random.seed(7)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.5, 'na': 1.3}
+        fmax = 1 / (0.5 * options["wavelength"] / options["na"])
+        nx = 301
+        f = 1 / 0.25
+        angle = 30 * np.pi / 180
+        frqs = [f * np.cos(angle), f * np.sin(angle)]
+        phi = 0.2377747474
+
+        x = options['pixel_size'] * np.arange(nx)
+        xx, yy = np.meshgrid(x, x)
+        m = 1 + 0.5 * np.cos(2 * np.pi * (frqs[0] * xx + frqs[1] * yy) + phi)
+        mft = fft.fftshift(fft.fft2(fft.ifftshift(m)))
+
+        # without a guess
+        frq_extracted, _ = sim.fit_modulation_frq_fast(mft, mft, options["pixel_size"], fmax, exclude_res=0.6)
+        np.testing.assert_allclose(frq_extracted, frqs, atol=1e-5)
+
+        # with a guess on noisy images
+        m_noisy = np.random.poisson(100 * m)
+        m_noisy_ft = fft.fftshift(fft.fft2(fft.ifftshift(m_noisy)))
+        frq_guess = np.array(frqs) + 0.02
+        frq_fast, _ = sim.fit_modulation_frq_fast(m_noisy_ft, m_noisy_ft, options["pixel_size"], fmax,
+                                                  frq_guess=frq_guess)
+        frq_slow, _ = sim.fit_modulation_frq(m_noisy_ft, m_noisy_ft, options["pixel_size"], fmax,
+                                             frq_guess=frq_guess)
+        np.testing.assert_allclose(frq_fast, frq_slow, atol=1e-4)
+
     def test_fit_phase_realspace(self):
         """
         Test fit_phase_realspace()
@@ -75,6 +177,70 @@ class TestSIM(unittest.TestCase):
 
         self.assertAlmostEqual(phi, float(phase_guess_center), places=5)
 
+    def test_fit_phase_wicker(self):
+        """
+        Test fit_phase_wicker() recovers the relative phases of simulated SIM images
+        :return:
+        """
+        np.random.seed(8)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        fmax = 1 / (0.5 * options['wavelength'] / options['na'])
+        nx = 256
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + np.array([[0.3], [1.1], [2.5]]) + \
+                 np.random.uniform(-0.2, 0.2, size=(3, 3))
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(1000, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, np.array([0.85, 0.85, 0.85]), 10000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+        imgs_ft = tools.ft2(sim.preprocess_sim_imgs(imgs, 100, True))
+
+        for ii in range(3):
+            for fit_amps in [False, True]:
+                phases_fit, amps = sim.fit_phase_wicker(imgs_ft[ii], otf, frqs[ii], options['pixel_size'], fmax,
+                                                        fit_amps=fit_amps)
+
+                dphases_fit = phases_fit - phases_fit[0]
+                dphases = phases[ii] - phases[ii, 0]
+                self.assertLess(np.max(np.abs(np.angle(np.exp(1j * (dphases_fit - dphases))))), 0.05)
+                np.testing.assert_allclose(amps, 1, atol=0.05)
+
+    def test_fit_phase_wicker_zero_cross_correlation(self):
+        """
+        Test the gradient of the fit_phase_wicker() objective function is finite if cross-correlation terms are zero
+        :return:
+        """
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        fmax = 1 / (0.5 * options['wavelength'] / options['na'])
+        nx = 64
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+        imgs_ft = np.zeros((3, nx, nx), dtype=complex)
+        phases_guess = np.array([0, 2 * np.pi / 3, 4 * np.pi / 3])
+
+        minimize = sim.scipy.optimize.minimize
+        evaluated = []
+        def minimize_and_record(fn, x0, **kwargs):
+            evaluated.append(fn(x0))
+            return minimize(fn, x0, **kwargs)
+
+        with mock.patch.object(sim.scipy.optimize, "minimize", minimize_and_record):
+            for fit_amps in [False, True]:
+                phases_fit, amps = sim.fit_phase_wicker(imgs_ft, otf, [3.5, 0.3], options['pixel_size'], fmax,
+                                                        phases_guess=phases_guess, fit_amps=fit_amps)
+                self.assertTrue(np.all(np.isfinite(phases_fit)))
+
+        for val, jac in evaluated:
+            self.assertEqual(val, 0)
+            np.testing.assert_array_equal(jac, 0)
+
     def test_estimate_phase(self):
         """
         Test estimate_phase() function, which guesses phase from value of image FT
@@ -100,6 +266,118 @@ class TestSIM(unittest.TestCase):
 
         self.assertAlmostEqual(phi, float(phase_guess_center), places=5)
 
+    def test_estimate_mod_depths(self):
+        """
+        Test the binned power spectrum fit recovers the modulation depths of simulated SIM images
+        :return:
+        """
+        np.random.seed(3)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 256
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.6, 0.4])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(3000, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+
+        r = sim.SimImageSet(options, imgs, frqs, otf=otf, phases_guess=phases, use_fixed_frq=True,
+                            use_fixed_phase=True, diagnostics="none")
+        r.frqs = frqs
+        r.separated_components_ft = sim.separate_components(r.imgs_ft, phases, np.ones((3, 3)))
+        mods_fit, pspec_params, masks = r.estimate_mod_depths()
+
+        np.testing.assert_allclose(mods_fit[:, 0], 1)
+        np.testing.assert_allclose(mods_fit[:, 1], mod_depths, atol=0.05)
+        np.testing.assert_allclose(mods_fit[:, 2], mods_fit[:, 1])
+        self.assertEqual(masks.shape, imgs.shape)
+
+        # binned closed form fit should agree with the pixel-wise fit for fixed exponent and noise
+        bins = sim.get_power_spectrum_bins(otf, fx, fx, r.fmax, r.fbounds)
+        ps, fmag, otf_binned, npts = sim.bin_power_spectra(r.separated_components_ft[:, 0], [bins] * 3)
+        noise = pspec_params[:, 0, 3]
+        scales = sim.fit_power_spectrum_scale(ps, fmag, otf_binned, npts, 0.5, noise)
+        for ii in range(3):
+            fit_results, _ = sim.fit_power_spectrum(r.separated_components_ft[ii, 0], otf, fx, fx, r.fmax, r.fbounds,
+                                                    init_params=[None, 0.5, 1, noise[ii]],
+                                                    fixed_params=[False, True, True, True])
+            self.assertAlmostEqual(np.sqrt(scales[ii]) / fit_results['fit_params'][0], 1, places=2)
+
+        # bin label maps are stored in the geometry and reused
+        cache = r.geometry["_power_spectrum_bins"]
+        self.assertEqual(len(cache), 4)
+        bins_cached = sim.get_cached_power_spectrum_bins(r.geometry, r.fmax, r.fbounds)
+        self.assertIs(bins_cached, cache[(r.fmax, tuple(r.fbounds), None, None)])
+        np.testing.assert_array_equal(bins_cached["labels"], bins["labels"])
+
+        mods_fit_again, _, _ = r.estimate_mod_depths()
+        self.assertEqual(len(cache), 4)
+        np.testing.assert_array_equal(mods_fit_again, mods_fit)
+
+    def test_preprocess_sim_imgs(self):
+        """
+        Test histogram normalization of integer images with lookup tables agrees with skimage, and test linear
+        normalization
+        :return:
+        """
+        from skimage.exposure import match_histograms
+        np.random.seed(1)
+
+        imgs = np.random.poisson(np.random.rand(2, 3, 3, 1, 1) * 500 +
+                                 300 * np.random.rand(1, 1, 1, 64, 65)).astype(np.uint16)
+
+        imgs_ref = np.array(imgs, dtype=float)
+        for ind in np.ndindex(imgs.shape[:2]):
+            for jj in range(1, 3):
+                imgs_ref[ind][jj] = match_histograms(imgs_ref[ind][jj], imgs_ref[ind][0])
+        imgs_ref -= 100
+        imgs_ref[imgs_ref <= 0] = 1e-12
+
+        np.testing.assert_allclose(sim.preprocess_sim_imgs(imgs, 100, True), imgs_ref, rtol=1e-12)
+        # float images use skimage directly
+        np.testing.assert_allclose(sim.preprocess_sim_imgs(imgs.astype(float), 100, True), imgs_ref, rtol=1e-12)
+
+        # linear normalization matches means and variances to the first phase
+        imgs_lin = sim.preprocess_sim_imgs(imgs, 0, "linear")
+        np.testing.assert_allclose(np.mean(imgs_lin, axis=(-2, -1)),
+                                   np.broadcast_to(np.mean(imgs[..., :1, :, :], axis=(-2, -1)), imgs.shape[:-2]))
+        np.testing.assert_allclose(np.std(imgs_lin, axis=(-2, -1)),
+                                   np.broadcast_to(np.std(imgs[..., :1, :, :], axis=(-2, -1)), imgs.shape[:-2]))
+
+        with self.assertRaises(ValueError):
+            sim.preprocess_sim_imgs(imgs, 100, "histogram")
+
+    def test_periodic_smooth_decomp(self):
+        """
+        Test the batched periodic/smooth decomposition against computing the DFT of the full boundary image
+        :return:
+        """
+        np.random.seed(0)
+
+        for shape in [(64, 64), (31, 40), (3, 2, 33, 32)]:
+            imgs = np.random.rand(*shape) * 100
+
+            p_ref = np.zeros(shape)
+            for ind in np.ndindex(shape[:-2]):
+                u = imgs[ind]
+                s = np.real(tools.ift2(psd.v2s(tools.ft2(psd.u2v(u), centered=False)), centered=False))
+                p_ref[ind] = u - s
+
+            p, s = psd.periodic_smooth_decomp(imgs)
+            np.testing.assert_allclose(p, p_ref, atol=1e-10)
+            np.testing.assert_allclose(p + s, imgs, atol=1e-12)
+
+            p_single = psd.periodic_component(imgs.astype(np.float32))
+            self.assertEqual(p_single.dtype, np.float32)
+            np.testing.assert_allclose(p_single, p_ref, atol=1e-3)
+
     def test_kmat(self):
         """
         Test that the real-space and Fourier-space pattern generation models agree.
@@ -223,5 +501,491 @@ class TestSIM(unittest.TestCase):
 
             np.testing.assert_allclose(gt, gt_per_angle[ii], atol=1e-14)
 
+    def test_sim_image_series(self):
+        """
+        Test that reconstructing frames with SimImageSeries, which shares geometry and batches FFT's, gives the same
+        result as reconstructing each frame separately with SimImageSet
+        :return:
+        """
+        np.random.seed(0)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nframes = 3
+        nx = 128
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        imgs = np.zeros((nframes, 3, 3, nx, nx))
+        for ii in range(nframes):
+            gt = np.zeros((nx, nx))
+            inds = np.random.randint(0, nx, size=(100, 2))
+            gt[inds[:, 0], inds[:, 1]] = 1
+
+            imgs[ii], _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                        options['pixel_size'], otf=otf, use_otf=True)
+
+        series = sim.SimImageSeries(options, imgs, frqs + 0.05, otf=otf, batch_size=2, phases_guess=phases)
+        series.reconstruct()
+
+        for ii in range(nframes):
+            imgs_ft = sim.get_sim_imgs_ft(sim.preprocess_sim_imgs(imgs[ii]))
+            r = sim.SimImageSet(options, imgs[ii], frqs + 0.05, otf=otf, phases_guess=phases)
+            np.testing.assert_allclose(r.imgs_ft, imgs_ft, atol=1e-8)
+
+            r.reconstruct()
+            np.testing.assert_allclose(series.frqs[ii], r.frqs, atol=1e-4)
+            np.testing.assert_allclose(series.imgs_sr[ii], r.img_sr, rtol=0, atol=1e-3 * np.abs(r.img_sr).max())
+            np.testing.assert_allclose(series.widefield[ii], r.widefield)
+
+    def test_rfft_reconstruction(self):
+        """
+        Test that storing the raw image Fourier transforms as half-planes gives the same reconstruction
+        :return:
+        """
+        np.random.seed(2)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 128
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(100, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+
+        r = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases)
+        r.reconstruct()
+
+        r_half = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases, use_rfft=True)
+        self.assertEqual(r_half.imgs_ft.shape, (3, 3, nx, nx // 2 + 1))
+        np.testing.assert_allclose(r_half.get_full_plane(r_half.imgs_ft), r.imgs_ft, atol=1e-8)
+        r_half.reconstruct()
+
+        np.testing.assert_allclose(r_half.frqs, r.frqs, atol=1e-6)
+        np.testing.assert_allclose(r_half.phases, r.phases, atol=1e-3)
+        np.testing.assert_allclose(r_half.mcnr, r.mcnr, rtol=1e-6)
+        # power law exponent fits to ~0 here, so compare it with an absolute tolerance
+        np.testing.assert_allclose(r_half.power_spectrum_params[..., [0, 2, 3]], r.power_spectrum_params[..., [0, 2, 3]],
+                                   rtol=1e-4)
+        np.testing.assert_allclose(r_half.power_spectrum_params[..., 1], r.power_spectrum_params[..., 1], atol=1e-12)
+        np.testing.assert_allclose(r_half.img_sr, r.img_sr, rtol=0, atol=1e-4 * np.abs(r.img_sr).max())
+
+    def test_single_precision(self):
+        """
+        Test that single precision reconstruction agrees with double precision
+        :return:
+        """
+        np.random.seed(4)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 128
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(100, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+
+        r = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases)
+        r.reconstruct()
+
+        r_single = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases, precision="single")
+        r_single.reconstruct()
+
+        self.assertEqual(r_single.imgs_ft.dtype, np.complex64)
+        self.assertEqual(r_single.components_shifted_ft.dtype, np.complex64)
+        self.assertEqual(r_single.img_sr.dtype, np.float32)
+
+        np.testing.assert_allclose(r_single.frqs, r.frqs, atol=1e-6)
+        np.testing.assert_allclose(r_single.img_sr, r.img_sr, rtol=0, atol=1e-4 * np.abs(r.img_sr).max())
+
+    def test_combine_components(self):
+        """
+        Test that combine_components() agrees with shifting and weighting each component separately, and that
+        the diagnostic intermediates are only kept when requested
+        :return:
+        """
+        np.random.seed(5)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 101
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(100, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+
+        r = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases, plot_diagnostics=True)
+        r.reconstruct()
+
+        # shift and weight one component at a time
+        f_upsample = r.geometry['f_upsample']
+        dfx_us = r.geometry['fx_us'][1] - r.geometry['fx_us'][0]
+        dfy_us = r.geometry['fy_us'][1] - r.geometry['fy_us'][0]
+        for ii in range(r.nangles):
+            for jj, eps in enumerate([0, 1, -1]):
+                params = list(r.power_spectrum_params[ii, jj, :-1]) + [0]
+                ff_shift = np.sqrt((r.fx[None, :] - eps * r.frqs[ii, 0]) ** 2 + (r.fy[:, None] - eps * r.frqs[ii, 1]) ** 2)
+                snr = sim.power_spectrum_fn(params, ff_shift, 1) / r.noise_power[ii, jj]
+                deconvolved, _ = sim.wiener_deconvolution(r.separated_components_ft[ii, jj] / r.mod_depths[ii, jj],
+                                                          otf, snr)
+                deconvolved = tools.expand_fourier_sp(deconvolved, mx=f_upsample, my=f_upsample, centered=True)
+                shifted = tools.translate_ft(deconvolved, eps * r.frqs[ii], r.dx / f_upsample)
+
+                otf_shifted, _, _ = tools.translate_pix(r.geometry['otf_us'], eps * r.frqs[ii], dx=dfx_us, dy=dfy_us,
+                                                        mode='no-wrap')
+                snr_shifted = sim.power_spectrum_fn(params, r.geometry['ff_us'], 1) / r.noise_power[ii, jj]
+                weights = sim.get_snr_weight(otf_shifted, snr_shifted)
+
+                np.testing.assert_allclose(r.components_deconvolved_ft[ii, jj], deconvolved, rtol=1e-12)
+                np.testing.assert_allclose(r.components_shifted_ft[ii, jj], shifted, rtol=0,
+                                           atol=1e-12 * np.abs(shifted).max())
+                np.testing.assert_allclose(r.weights[ii, jj], weights, rtol=1e-12)
+
+        # intermediates only used for diagnostics are not kept
+        r_nodiag = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases, plot_diagnostics=False)
+        r_nodiag.reconstruct()
+
+        self.assertIsNone(r_nodiag.components_deconvolved_ft)
+        self.assertIsNone(r_nodiag.snr_shifted)
+        np.testing.assert_allclose(r_nodiag.img_sr, r.img_sr, rtol=0, atol=1e-12 * np.abs(r.img_sr).max())
+
+    def test_combine_components_singular_angle(self):
+        """
+        Test an angle whose components cannot be separated is left out of the reconstruction, instead of making the
+        whole image NaN
+        :return:
+        """
+        np.random.seed(5)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 101
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(100, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+
+        # all phases of second angle are the same, so the inversion matrix is singular
+        phases_degenerate = np.array(phases, copy=True)
+        phases_degenerate[1] = phases[1, 0]
+
+        r = sim.SimImageSet(options, imgs, frqs, otf=otf, phases_guess=phases_degenerate, use_fixed_frq=True,
+                            use_fixed_phase=True)
+        with self.assertWarns(UserWarning):
+            r.reconstruct()
+
+        self.assertTrue(np.all(np.isnan(r.separated_components_ft[1])))
+        self.assertTrue(np.all(np.isfinite(r.img_sr)))
+        self.assertTrue(np.all(r.weights[1] == 0))
+        self.assertTrue(np.all(np.isfinite(r.weight_norm)))
+        self.assertGreater(np.max(r.img_sr), 0)
+
+    def test_recompute_diagnostics(self):
+        """
+        Test that a reconstruction without diagnostics keeps no intermediates or figures, and that the diagnostics
+        can be recomputed from the saved parameters
+        :return:
+        """
+        np.random.seed(6)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 128
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(100, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+        imgs, _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases, mod_depths, 1000, 1, 100, 0,
+                                                options['pixel_size'], otf=otf, use_otf=True)
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            r = sim.SimImageSet(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases, diagnostics="none",
+                                save_dir=save_dir)
+            r.reconstruct()
+
+            # profiler created by the SimImageSet is closed after reconstructing, and has written all records
+            self.assertIsNone(r.profiler._file)
+            with open(os.path.join(save_dir, "sim_profile.jsonl"), "r") as f:
+                self.assertEqual(len(f.readlines()), len(r.profiler.records))
+
+            figs, _ = r.plot_figs()
+            fname = os.path.join(save_dir, "sim_reconstruction_params.pkl")
+            r.save_result(fname)
+
+            self.assertEqual(figs, [])
+            self.assertEqual(glob.glob(os.path.join(save_dir, "*.png")), [])
+            for field in ["components_deconvolved_ft", "components_shifted_ft", "snr", "snr_shifted", "weights",
+                          "pspec_masks"]:
+                self.assertIsNone(getattr(r, field))
+
+            r_diag = sim.recompute_diagnostics(fname, imgs, diagnostics="full")
+
+            # parameters saved before use_rfft and precision were added
+            with open(fname, "rb") as f:
+                params = pickle.load(f)
+            del params["use_rfft"], params["precision"]
+            fname_old = os.path.join(save_dir, "sim_reconstruction_params_old.pkl")
+            with open(fname_old, "wb") as f:
+                pickle.dump(params, f)
+
+            r_old = sim.recompute_diagnostics(fname_old, imgs, diagnostics="none")
+            self.assertFalse(r_old.use_rfft)
+            self.assertEqual(r_old.precision, "double")
+
+        self.assertEqual(r_diag.components_shifted_ft.shape, (3, 3, 2 * nx, 2 * nx))
+        np.testing.assert_allclose(r_diag.frqs, r.frqs)
+        np.testing.assert_allclose(r_diag.img_sr, r.img_sr, rtol=0, atol=1e-10 * np.abs(r.img_sr).max())
+
+    def test_noise_power_boundary(self):
+        """
+        Test that get_noise_power() only uses frequencies strictly larger than fmax
+        :return:
+        """
+        dx = 0.065
+        nx = 64
+        fx = tools.get_fft_frqs(nx, dx)
+        fmax = fx[nx // 2 + 10]
+
+        # only frequencies on the boundary |f| = fmax are nonzero
+        _, _, ff = tools.get_frequency_grids(fx, fx)
+        img_ft = np.zeros((nx, nx), dtype=complex)
+        img_ft[ff == fmax] = 1
+        self.assertGreater(np.sum(ff == fmax), 0)
+
+        self.assertEqual(sim.get_noise_power(img_ft, fx, fx, fmax), 0)
+        self.assertGreater(sim.get_noise_power(img_ft, fx, fx, np.nextafter(fmax, 0)), 0)
+
+    def test_half_plane_power_spectrum(self):
+        """
+        Test that get_noise_power(), get_mcnr() and fit_power_spectrum() give the same results on half-planes
+        :return:
+        """
+        np.random.seed(3)
+
+        dx = 0.065
+        fmax = 1 / (0.5 * 0.532 / 1.3)
+        for nx in [100, 101]:
+            ny = nx + 4
+            fx = tools.get_fft_frqs(nx, dx)
+            fx_half = fft.rfftfreq(nx, dx)
+            fy = tools.get_fft_frqs(ny, dx)
+            otf = psf.circ_aperture_otf(fx[None, :], fy[:, None], 1.3, 0.532)
+
+            img = np.random.rand(ny, nx) + np.cos(2 * np.pi * (-2.3 * np.arange(nx)[None, :] * dx +
+                                                               1.1 * np.arange(ny)[:, None] * dx))
+            img_ft = tools.ft2(img)
+            img_ft_half = tools.rft2(img)
+            otf_half = psf.circ_aperture_otf(fx_half[None, :], fy[:, None], 1.3, 0.532)
+
+            self.assertAlmostEqual(sim.get_noise_power(img_ft_half, fx_half, fy, fmax, half_plane_nx=nx),
+                                   sim.get_noise_power(img_ft, fx, fy, fmax), places=10)
+
+            self.assertAlmostEqual(sim.get_mcnr(img_ft_half, [-2.3, 1.1], fx_half, fy, fmax, half_plane_nx=nx),
+                                   sim.get_mcnr(img_ft, [-2.3, 1.1], fx, fy, fmax), places=10)
+
+            # amplitude and modulation depth are degenerate, so fix modulation depth
+            fit_half, _ = sim.fit_power_spectrum(img_ft_half, otf_half, fx_half, fy, fmax, (0.1, 1),
+                                                 init_params=[None, None, 1, None],
+                                                 fixed_params=[False, False, True, False], half_plane_nx=nx)
+            fit_full, _ = sim.fit_power_spectrum(img_ft, otf, fx, fy, fmax, (0.1, 1), init_params=[None, None, 1, None],
+                                                 fixed_params=[False, False, True, False])
+            np.testing.assert_allclose(fit_half['fit_params'], fit_full['fit_params'], rtol=1e-5, atol=1e-8)
+
+    def test_parameter_tracking(self):
+        """
+        Test that SimParameterTracker reuses parameters between frames, and refits when the relative phases drift
+        :return:
+        """
+        np.random.seed(1)
+
+        options = {'pixel_size': 0.065, 'wavelength': 0.532, 'na': 1.3}
+        nx = 128
+        frqs = np.array([[3.5, 0.3], [-1.5, 3.1], [-1.9, -2.9]])
+        phases = np.array([[0, 2 * np.pi / 3, 4 * np.pi / 3]] * 3) + 0.3
+        mod_depths = np.array([0.85, 0.85, 0.85])
+
+        fx = tools.get_fft_frqs(nx, options['pixel_size'])
+        otf = psf.circ_aperture_otf(fx[None, :], fx[:, None], options['na'], options['wavelength'])
+
+        gt = np.zeros((nx, nx))
+        inds = np.random.randint(0, nx, size=(100, 2))
+        gt[inds[:, 0], inds[:, 1]] = 1
+
+        # last frame has relative phases shifted by 45 degrees
+        phase_shifts = [0, 0, 0, 45 * np.pi / 180]
+        imgs = np.zeros((len(phase_shifts), 3, 3, nx, nx))
+        for ii, dphi in enumerate(phase_shifts):
+            phases_frame = np.array(phases, copy=True)
+            phases_frame[:, 1] += dphi
+            imgs[ii], _, _ = sim.get_simulated_sim_imgs(gt, frqs, phases_frame, mod_depths, 1000, 1, 100, 0,
+                                                        options['pixel_size'], otf=otf, use_otf=True)
+
+        series = sim.SimImageSeries(options, imgs, frqs + 0.05, otf=otf, phases_guess=phases,
+                                    parameter_tracking={'refit_every': None, 'max_phase_drift': 20 * np.pi / 180},
+                                    default_to_guess_on_bad_phase_fit=False)
+        series.reconstruct()
+
+        np.testing.assert_array_equal(series.parameters_fit, [True, False, False, True])
+        np.testing.assert_allclose(series.frqs[1], series.frqs[0])
+        np.testing.assert_allclose(series.mod_depths[1], series.mod_depths[0], atol=1e-12)
+
+        dphis = np.mod(series.phases[3, :, 1] - series.phases[3, :, 0], 2 * np.pi)
+        np.testing.assert_allclose(dphis, 2 * np.pi / 3 + phase_shifts[3], atol=5 * np.pi / 180)
+
+    def test_reconstruct_folder_streaming(self):
+        """
+        Test that reconstruct_folder() gives the same results whether results are held in memory or streamed to disk
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir, affine_fname, otf_fname, pattern_fname, options = write_sim_dataset(root_dir)
+
+            results = []
+            for streaming in [False, True]:
+                sim.reconstruct_folder([data_dir], options['pixel_size'], options['na'], [options['wavelength']],
+                                       [options['wavelength']], [affine_fname], otf_fname, [pattern_fname],
+                                       img_centers=[[64, 64]], streaming=streaming)
+
+                results_dir = sorted(glob.glob(os.path.join(data_dir, "*_sim_reconstruction")))[-1]
+                results.append({n: tifffile.imread(os.path.join(results_dir, "%s.tif" % n))
+                                for n in ["widefield", "sim_os", "sim_sr", "deconvolved"]})
+
+                # avoid collision with next results directory, which is named by timestamp
+                os.rename(results_dir, results_dir + "_streaming=%d" % streaming)
+
+            for k in results[0].keys():
+                self.assertEqual(results[0][k].shape, results[1][k].shape)
+                np.testing.assert_allclose(results[0][k], results[1][k])
+
+    def test_reconstruct_folder_streaming_error(self):
+        """
+        Test that reconstruct_folder() closes the result writer if reconstructing a frame fails, so the frames already
+        reconstructed are written to disk
+        :return:
+        """
+        writers = []
+        class RecordingWriter(sim.SimResultWriter):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                writers.append(self)
+
+        reconstruct_sim_frame = sim.reconstruct_sim_frame
+        calls = []
+        def reconstruct_first_frame(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise ValueError("failed to reconstruct frame")
+            return reconstruct_sim_frame(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir, affine_fname, otf_fname, pattern_fname, options = write_sim_dataset(root_dir)
+
+            with mock.patch.object(sim, "SimResultWriter", RecordingWriter), \
+                 mock.patch.object(sim, "reconstruct_sim_frame", reconstruct_first_frame):
+                with self.assertRaises(ValueError):
+                    sim.reconstruct_folder([data_dir], options['pixel_size'], options['na'], [options['wavelength']],
+                                           [options['wavelength']], [affine_fname], otf_fname, [pattern_fname],
+                                           img_centers=[[64, 64]], streaming=True)
+
+            self.assertEqual(len(writers), 1)
+            self.assertFalse(writers[0]._thread.is_alive())
+
+            # first frame was written
+            results_dir = sorted(glob.glob(os.path.join(data_dir, "*_sim_reconstruction")))[-1]
+            img_wf = tifffile.imread(os.path.join(results_dir, "widefield.tif")).reshape(2, -1)
+            self.assertTrue(np.any(img_wf[0] != 0))
+            np.testing.assert_array_equal(img_wf[1], 0)
+
+    def test_reconstruct_folder_parallel(self):
+        """
+        Test that reconstruct_folder() gives the same results, in the same order, when images are reconstructed
+        in parallel processes
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir, affine_fname, otf_fname, pattern_fname, options = write_sim_dataset(root_dir, ntimes=3)
+
+            results = []
+            for n_workers in [1, 2]:
+                results.append(sim.reconstruct_folder([data_dir], options['pixel_size'], options['na'],
+                                                      [options['wavelength']], [options['wavelength']],
+                                                      [affine_fname], otf_fname, [pattern_fname],
+                                                      img_centers=[[64, 64]], saving=False, n_workers=n_workers))
+
+            for r_serial, r_parallel in zip(*results):
+                self.assertEqual(len(r_serial), 3)
+                np.testing.assert_allclose(np.asarray(r_serial), np.asarray(r_parallel))
+
+    def test_reconstruct_folder_performance_report(self):
+        """
+        Test that reconstruct_folder() reports progress and saves profiling records for each stage
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as root_dir:
+            data_dir, affine_fname, otf_fname, pattern_fname, options = write_sim_dataset(root_dir, ntimes=2)
+
+            progress = []
+            sim.reconstruct_folder([data_dir], options['pixel_size'], options['na'], [options['wavelength']],
+                                   [options['wavelength']], [affine_fname], otf_fname, [pattern_fname],
+                                   img_centers=[[64, 64]], diagnostics="none", progress_callback=progress.append)
+
+            self.assertEqual([p['frames_done'] for p in progress], [1, 2])
+            self.assertTrue(all(p['frames_total'] == 2 and p['frames_per_s'] > 0 for p in progress))
+
+            results_dir = glob.glob(os.path.join(data_dir, "*_sim_reconstruction"))[0]
+            with open(os.path.join(results_dir, "performance_report.json"), "r") as f:
+                report = json.load(f)
+            with open(os.path.join(results_dir, "performance.jsonl"), "r") as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual(report['frames'], 2)
+        self.assertGreaterEqual(report['io_wait_time_s'], 0)
+        for stage in ["frame", "frame/init/preprocess", "frame/init/ft", "frame/reconstruct/frq_fit",
+                      "frame/reconstruct/phase_fit", "frame/reconstruct/mod_depth", "frame/reconstruct/combine",
+                      "frame/reconstruct/widefield_deconvolution"]:
+            self.assertEqual(report['stages'][stage]['count'], 2)
+
+        # FFT's of the raw images are counted in the enclosing spans
+        self.assertGreaterEqual(report['stages']['frame/init/ft']['ffts'], 2 * 9)
+        self.assertGreaterEqual(report['stages']['frame']['ffts'], report['stages']['frame/init/ft']['ffts'])
+
+        self.assertEqual(sorted({(r['time'], r['channel']) for r in records}), [(0, 0), (1, 0)])
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,6 +3,13 @@ import analysis_tools as tools
 from scipy import fft
 import numpy as np
 import numpy.fft
+import pandas as pd
+import os
+import json
+import tempfile
+import tracemalloc
+import tifffile
+from concurrent.futures import ThreadPoolExecutor
 
 import matplotlib.pyplot as plt
 from matplotlib.colors import PowerNorm
@@ -132,6 +139,313 @@ class TestTools(unittest.TestCase):
             pos_c_symm = tools.get_fft_pos(n, dt, centered=True, mode="symmetric")
             self.assertAlmostEqual(np.max(np.abs(pos - pos_c_symm)), 0, places=12)
 
+    def test_frequency_grid_cache(self):
+        """
+        Test cached frequency grids and masks agree with direct computation, and are reused
+        """
+        tools.clear_frequency_grid_cache()
+
+        fxs = tools.get_fft_frqs(101, 0.065)
+        fys = tools.get_fft_frqs(64, 0.065)
+        ff = np.sqrt(fxs[None, :] ** 2 + fys[:, None] ** 2)
+
+        fxfx, fyfy, ff_cached = tools.get_frequency_grids(fxs, fys)
+        np.testing.assert_array_equal(ff_cached, ff)
+        np.testing.assert_array_equal(fxfx, np.broadcast_to(fxs[None, :], ff.shape))
+        np.testing.assert_array_equal(fyfy, np.broadcast_to(fys[:, None], ff.shape))
+        self.assertFalse(ff_cached.flags.writeable)
+
+        # second call returns the same array
+        _, _, ff_cached2 = tools.get_frequency_grids(fxs, fys)
+        self.assertIs(ff_cached2, ff_cached)
+
+        mask = tools.get_frequency_mask(fxs, fys, 4, fmin=1)
+        np.testing.assert_array_equal(mask, np.logical_and(ff >= 1, ff <= 4))
+        inds = tools.get_frequency_inds(fxs, fys, 4, fmin=1)
+        np.testing.assert_array_equal(inds, np.flatnonzero(mask))
+
+        info = tools.get_frequency_grid_cache_info()
+        self.assertEqual(info["hits"], 3)
+        self.assertEqual(info["misses"], 3)
+        self.assertEqual(info["entries"], 3)
+
+        # grids are not cached for unevenly spaced frequencies
+        fxs_uneven = fxs ** 3
+        _, _, ff_uneven = tools.get_frequency_grids(fxs_uneven, fys)
+        np.testing.assert_array_equal(ff_uneven, np.sqrt(fxs_uneven[None, :] ** 2 + fys[:, None] ** 2))
+        self.assertEqual(tools.get_frequency_grid_cache_info()["entries"], 3)
+
+        # least recently used grids are evicted
+        size_default = tools.frequency_grid_cache_size
+        try:
+            tools.frequency_grid_cache_size = 2
+            tools.get_frequency_grids(fxs, fys)
+            tools.get_frequency_grids(fys, fxs)
+            self.assertEqual(tools.get_frequency_grid_cache_info()["entries"], 2)
+            _, _, ff_again = tools.get_frequency_grids(fxs, fys)
+            self.assertIs(ff_again, ff_cached)
+        finally:
+            tools.frequency_grid_cache_size = size_default
+            tools.clear_frequency_grid_cache()
+
+    def test_profiler(self):
+        """
+        Test Profiler records nested spans, counts FFT's and writes records as JSON lines
+        """
+        with tempfile.TemporaryDirectory() as save_dir:
+            fname = os.path.join(save_dir, "profile.jsonl")
+            profiler = tools.Profiler(fname=fname, trace_memory=True, frame=3)
+
+            with profiler.span("outer") as outer:
+                with profiler.span("inner", stage="ft") as inner:
+                    img_ft = tools.ft2(np.random.rand(4, 32, 32))
+                    arr = np.ones(100000)
+                tools.irft2(tools.rft2(img_ft[0].real), 32)
+
+            profiler.close()
+            tracemalloc.stop()
+            with open(fname, "r") as f:
+                records = [json.loads(line) for line in f]
+
+        # records are added as each span ends
+        self.assertEqual(records, profiler.records)
+        self.assertEqual([r["path"] for r in records], ["outer/inner", "outer"])
+        self.assertEqual(records[0]["stage"], "ft")
+        self.assertTrue(all(r["frame"] == 3 for r in records))
+
+        self.assertEqual(inner.record["ffts"], 4)
+        self.assertEqual(outer.record["ffts"], 6)
+        self.assertGreaterEqual(outer.wall_time, inner.wall_time)
+        self.assertGreaterEqual(inner.record["bytes_allocated"], arr.nbytes)
+        self.assertGreaterEqual(outer.record["peak_bytes"], inner.record["peak_bytes"])
+
+        summary = tools.summarize_profile(records + records)
+        self.assertEqual(summary["outer"]["count"], 2)
+        self.assertEqual(summary["outer/inner"]["ffts"], 8)
+
+    def test_ft2(self):
+        """
+        Test ft2() and ift2() against scipy.fft for each available backend
+        :return:
+        """
+        backends = ["scipy"]
+        if tools.pyfftw is not None:
+            backends.append("pyfftw")
+
+        try:
+            for backend in backends:
+                tools.set_fft_backend(backend, workers=2)
+
+                for shape in [(64, 64), (31, 30), (3, 3, 32, 33)]:
+                    img = np.random.rand(*shape)
+                    img_ft = fft.fftshift(fft.fft2(fft.ifftshift(img, axes=(-1, -2))), axes=(-1, -2))
+
+                    # real input
+                    self.assertTrue(np.max(np.abs(tools.ft2(img) - img_ft)) < 1e-10)
+                    self.assertTrue(np.max(np.abs(tools.ft2(img, centered=False) - fft.fft2(img))) < 1e-10)
+                    # complex input
+                    self.assertTrue(np.max(np.abs(tools.ft2(img * (1 + 1j)) - img_ft * (1 + 1j))) < 1e-10)
+                    # half-plane transform of real input
+                    img_rft = tools.rft2(img)
+                    self.assertEqual(img_rft.shape[-1], shape[-1] // 2 + 1)
+                    self.assertTrue(np.max(np.abs(tools.expand_rft2(img_rft, shape[-1]) - img_ft)) < 1e-10)
+                    self.assertTrue(np.max(np.abs(tools.irft2(img_rft, shape[-1]) - img)) < 1e-12)
+                    self.assertTrue(np.max(np.abs(tools.irft2(tools.rft2(img, centered=False), shape[-1],
+                                                              centered=False) - img)) < 1e-12)
+                    # inverse
+                    self.assertTrue(np.max(np.abs(tools.ift2(img_ft) - img)) < 1e-12)
+        finally:
+            tools.set_fft_backend()
+
+    def test_mm_metadata_cache(self):
+        """
+        Test cached metadata agrees with parsing the metadata files, is invalidated when they change, and that
+        images found using MetadataIndex agree with scanning the table
+        """
+        def write_metadata(data_dir, ntimes):
+            md = {"Summary": {"IntendedDimensions": {"time": ntimes, "position": 1, "z": 2, "channel": 3},
+                              "UserData": {"Note": {"scalar": "test"}}}}
+            for tt in range(ntimes):
+                for zz in range(2):
+                    for cc in range(3):
+                        md["FrameKey-%d-%d-%d" % (tt, cc, zz)] = {"FileName": "data.tif",
+                                                                  "ImageNumber": (tt * 2 + zz) * 3 + cc,
+                                                                  "PositionName": "Pos-0",
+                                                                  "Camera": "cam",
+                                                                  "ROI": [0, 0, 16, 16],
+                                                                  "UserData": {"SimIndex": {"scalar": cc}}}
+            with open(os.path.join(data_dir, "data_metadata.txt"), "w") as f:
+                json.dump(md, f)
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            imgs = np.random.randint(0, 1000, size=(36, 16, 16)).astype(np.uint16)
+            tifffile.imwrite(os.path.join(data_dir, "data.tif"), imgs)
+            write_metadata(data_dir, ntimes=4)
+
+            md, dims, summary = tools.parse_mm_metadata(data_dir)
+            self.assertTrue(os.path.exists(os.path.join(data_dir, tools.metadata_cache_fname)))
+
+            md_cached, dims_cached, summary_cached = tools.parse_mm_metadata(data_dir)
+            md_direct, _, _ = tools.parse_mm_metadata(data_dir, use_cache=False)
+            for m in [md_cached, md_direct]:
+                self.assertEqual(list(m.columns), list(md.columns))
+                for c in md.columns:
+                    self.assertEqual(list(m[c]), list(md[c]))
+            self.assertEqual(dims_cached, dims)
+            self.assertEqual(summary_cached, summary)
+
+            # images found from the index agree with scanning the table
+            index = tools.MetadataIndex(md, ["FrameIndex", "SliceIndex", "UserSimIndex"])
+            for tt, zz in [(0, 0), (2, 1), (3, 0)]:
+                imgs_index = tools.read_dataset(md, time_indices=tt, z_indices=zz,
+                                                user_indices={"UserSimIndex": [0, 1, 2]}, index=index)
+                imgs_scan = tools.read_dataset(md, time_indices=tt, z_indices=zz,
+                                               user_indices={"UserSimIndex": [0, 1, 2]})
+                np.testing.assert_array_equal(imgs_index, imgs_scan)
+                np.testing.assert_array_equal(imgs_index, imgs[(tt * 2 + zz) * 3:(tt * 2 + zz + 1) * 3])
+
+            np.testing.assert_array_equal(index.lookup(FrameIndex=[1, 3], UserSimIndex=2, Camera="cam"),
+                                          [8, 11, 20, 23])
+            self.assertEqual(len(index.lookup(FrameIndex=10)), 0)
+
+            # modifying the metadata invalidates the cache
+            write_metadata(data_dir, ntimes=2)
+            md_new, dims_new, _ = tools.parse_mm_metadata(data_dir)
+            self.assertEqual(len(md_new), 12)
+            self.assertEqual(dims_new["time"], 2)
+
+            # metadata which cannot be stored as JSON is not cached, instead of raising an error
+            md_bad = md_new.copy()
+            md_bad["UserObject"] = pd.Series([np.int64(1), "a"] * 6, dtype=object)
+            fname_bad = os.path.join(data_dir, "bad_" + tools.metadata_cache_fname)
+            with self.assertWarns(UserWarning):
+                tools._save_metadata_cache(fname_bad, data_dir, "signature", md_bad, dims_new, {})
+            self.assertFalse(os.path.exists(fname_bad))
+            self.assertFalse(os.path.exists(fname_bad + ".tmp"))
+
+    def test_read_multi_tiff(self):
+        """
+        Test reading images from uncompressed and compressed TIFF files through the cache of open files
+        """
+        imgs = np.random.randint(0, 4000, size=(10, 32, 24)).astype(np.uint16)
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            fname = os.path.join(save_dir, "imgs.tif")
+            fname_compressed = os.path.join(save_dir, "imgs_compressed.tif")
+            tifffile.imwrite(fname, imgs)
+            tifffile.imwrite(fname_compressed, imgs, compression="zlib")
+
+            try:
+                # uncompressed images are views of a memory map
+                img = tools.read_tiff_frame(fname, 3)
+                np.testing.assert_array_equal(img, imgs[3])
+                self.assertFalse(img.flags.writeable)
+                np.testing.assert_array_equal(tools.read_tiff_frame(fname_compressed, 3), imgs[3])
+
+                fnames = [fname, fname_compressed, fname, fname_compressed]
+                slices = [7, 1, 0, 9]
+                imgs_read = tools.read_multi_tiff(fnames, slices)
+                np.testing.assert_array_equal(imgs_read, imgs[slices])
+
+                out = np.zeros((4, 32, 24), dtype=np.uint16)
+                self.assertIs(tools.read_multi_tiff(fnames, slices, out=out), out)
+                np.testing.assert_array_equal(out, imgs[slices])
+
+                # modified files are opened again
+                imgs_new = imgs[::-1].copy()
+                tifffile.imwrite(fname, imgs_new, compression="zlib")
+                os.utime(fname, ns=(0, 0))
+                np.testing.assert_array_equal(tools.read_multi_tiff([fname], [2]), imgs_new[2:3])
+            finally:
+                # open files must be closed before the directory can be deleted on Windows
+                tools.clear_tiff_file_cache()
+
+    def test_read_multi_tiff_threaded(self):
+        """
+        Test files evicted from the cache of open files while another thread is reading them are opened again
+        """
+        imgs = np.random.randint(0, 4000, size=(6, 5, 16, 12)).astype(np.uint16)
+
+        cache_size = tools.tiff_file_cache_size
+        with tempfile.TemporaryDirectory() as save_dir:
+            fnames = [os.path.join(save_dir, "imgs_%d.tif" % ii) for ii in range(len(imgs))]
+            for ii, fname in enumerate(fnames):
+                tifffile.imwrite(fname, imgs[ii], compression="zlib" if ii % 2 else None)
+
+            try:
+                # entry closed after it was handed out
+                for fname, im in zip(fnames[:2], imgs[:2]):
+                    tif = tools._get_tiff_file(fname)
+                    tools.clear_tiff_file_cache()
+                    np.testing.assert_array_equal(tif.read_page(1), im[1])
+                    img = tif.get_page(1)
+                    if img is not None:
+                        tools.clear_tiff_file_cache()
+                        np.testing.assert_array_equal(img, im[1])
+
+                # cache smaller than the number of files, so entries are evicted while in use by other threads
+                tools.tiff_file_cache_size = 2
+
+                def read(ii):
+                    inds = [(ii + jj) % len(fnames) for jj in range(len(fnames))]
+                    slices = [(ii + jj) % imgs.shape[1] for jj in range(len(fnames))]
+                    return inds, slices, tools.read_multi_tiff([fnames[jj] for jj in inds], slices)
+
+                with ThreadPoolExecutor(8) as pool:
+                    for inds, slices, imgs_read in pool.map(read, range(200)):
+                        np.testing.assert_array_equal(imgs_read, imgs[inds, slices])
+            finally:
+                tools.tiff_file_cache_size = cache_size
+                tools.clear_tiff_file_cache()
+
+    def test_prefetcher(self):
+        """
+        Test Prefetcher returns items in order, loads at most n_ahead items ahead, and raises errors from loading
+        """
+        started = []
+        def load(ii):
+            started.append(ii)
+            if ii == 7:
+                raise ValueError("failed to load")
+            return ii ** 2
+
+        with tools.Prefetcher(load, [(ii,) for ii in range(7)], n_ahead=3) as prefetcher:
+            for ii, result in enumerate(prefetcher):
+                self.assertEqual(result, ii ** 2)
+                self.assertLessEqual(max(started), ii + 3)
+
+            stats = prefetcher.get_stats()
+            self.assertEqual(stats["items"], 7)
+            self.assertGreaterEqual(stats["wait_time_s"], 0)
+
+        with tools.Prefetcher(load, [(6,), (7,)], n_ahead=2) as prefetcher:
+            self.assertEqual(next(prefetcher), 36)
+            with self.assertRaises(ValueError):
+                next(prefetcher)
+
+    def test_save_tiff_memmap(self):
+        """
+        Test writing a hyperstack through save_tiff_memmap() in a non-ImageJ axis order
+        :return:
+        """
+
+        imgs = np.random.rand(2, 3, 4, 16, 12).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as save_dir:
+            fname = os.path.join(save_dir, "stack.tif")
+            stack = tools.save_tiff_memmap(fname, imgs.shape, dtype='float32', axes_order='CTZYX')
+            for ii in range(imgs.shape[0]):
+                for jj in range(imgs.shape[1]):
+                    stack[ii, jj] = imgs[ii, jj]
+            stack.flush()
+            del stack
+
+            imgs_read = tifffile.imread(fname)
+
+        # written in imagej TZCYX order
+        self.assertEqual(imgs_read.shape, (3, 4, 2, 16, 12))
+        self.assertTrue(np.array_equal(imgs_read, imgs.transpose(1, 2, 0, 3, 4)))
+
 
 
 if __name__ == "__main__":